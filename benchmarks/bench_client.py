@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""Microbenchmarks for the hot paths of the client.
+
+Times decoding and encoding values (:func:`cryptol.cryptol._from_value`
+and :func:`cryptol.cryptol._to_value`), converting them to Cryptol
+expressions and templates, loading a module, a round trip of
+``applyFun``, and encrypting with ``tests/AES.cry``. Run from the
+repository root::
+
+    python benchmarks/bench_client.py [--server standin|cryptol]
+        [--json RESULTS] [--baseline BASELINE] [--threshold 0.2]
+
+By default the server benchmarks run against the stand-in server of
+the tests, which answers at once without evaluating anything, so they
+measure the client and transport overhead alone; with ``--server
+cryptol`` they run against ``cryptol-server``, and include Cryptol
+evaluation. In stand-in mode the lambdas of the round trips and of
+the AES benchmarks evaluate to identities, so those send and receive
+the same payloads without encrypting anything.
+
+``--json`` writes the results, the seconds per call of each benchmark,
+to a file; ``--baseline`` compares them with such a file from an
+earlier run, and exits with status 1 if any benchmark became slower by
+more than the ``--threshold`` fraction.
+
+"""
+
+from __future__ import print_function
+from BitVector import BitVector
+import argparse
+import json
+import os
+import platform
+import sys
+import timeit
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tests'))
+from bench_decode import PAYLOADS
+from cryptol import Cryptol
+from cryptol.cryptol import _CryptolModule, _from_value, _to_value
+from cryptol.word import Word
+
+AES_KEY = BitVector(intVal=0x2b7e151628aed2a6abf7158809cf4f3c, size=128)
+AES_PT = BitVector(intVal=0x6bc1bee22e409f96e93d7e117393172a, size=128)
+
+VALUES = {
+    'bytes (64 KiB)': bytes(bytearray(i % 256 for i in range(65536))),
+    'words [4096][32]': [Word(i * 0x01010101, 32) for i in range(4096)],
+    'bitvectors [256][128]': [BitVector(intVal=i, size=128)
+                              for i in range(256)],
+    'records [512]{a, b}': [{'a': Word(i % 256, 8), 'b': True}
+                            for i in range(512)],
+    'AES block (pt, key)': (AES_PT, AES_KEY),
+    }
+"""Python values to encode, by name"""
+
+def offline_benchmarks():
+    """The benchmarks needing no server, as ``(name, function)`` pairs"""
+    for name in sorted(PAYLOADS):
+        payload = PAYLOADS[name]
+        yield ('_from_value ' + name,
+               lambda payload=payload: _from_value(payload))
+        yield ('_from_value int ' + name,
+               lambda payload=payload: _from_value(payload, Word))
+    for name in sorted(VALUES):
+        value = VALUES[name]
+        yield '_to_value ' + name, lambda value=value: _to_value(value)
+        yield ('to_expr ' + name,
+               lambda value=value: _CryptolModule.to_expr(value))
+    table = VALUES['words [4096][32]']
+    yield ('template AES block',
+           lambda: _CryptolModule.template('aesEncrypt (?, ?)',
+                                           (AES_PT, AES_KEY)))
+    yield ('template 16 holes',
+           lambda: _CryptolModule.template(' # '.join(['?'] * 16),
+                                           tuple(range(16))))
+    yield ('template words [4096][32]',
+           lambda: _CryptolModule.template('sum ?', (table,)))
+
+def server_benchmarks(cry):
+    """The benchmarks talking to a server, as ``(name, function)`` pairs"""
+    aes_path = os.path.join(ROOT, 'tests', 'AES.cry')
+    def load():
+        """Load a module in a new worker, and end the worker"""
+        cry.load_module(aes_path).exit()
+    yield 'load_module AES.cry', load
+    prelude = cry.prelude()
+    word_id = prelude.eval('\\(x : [128]) -> x')
+    bytes_id = prelude.eval('\\(x : [4096][8]) -> x')
+    table_id = prelude.eval('\\(x : [4096][32]) -> x')
+    block = VALUES['bytes (64 KiB)'][:4096]
+    table = VALUES['words [4096][32]']
+    yield 'applyFun [128]', lambda: word_id(AES_PT)
+    yield 'applyFun bytes [4096][8]', lambda: bytes_id(block)
+    yield 'applyFun words [4096][32]', lambda: table_id(table)
+    aes = cry.load_module(aes_path)
+    encrypt = aes.eval('\\(pt : [128], key : [128]) -> aesEncrypt (pt, key)')
+    yield 'AES encrypt call', lambda: encrypt((AES_PT, AES_KEY))
+    prepared = aes.prepare('aesEncrypt (?, ?)')
+    yield 'AES encrypt prepared', lambda: prepared(AES_PT, AES_KEY)
+
+def measure(function, repeat):
+    """The fewest seconds per call of ``function``, over ``repeat`` runs"""
+    # enough calls per run to take about a tenth of a second
+    once = min(timeit.repeat(function, number=1, repeat=3))
+    number = max(1, int(0.1 / max(once, 1e-6)))
+    return min(timeit.repeat(function, number=number,
+                             repeat=repeat)) / number
+
+def compare(results, baseline, threshold):
+    """Print the results against a baseline.
+
+    :return: The names of the benchmarks slower than the baseline by
+        more than ``threshold``
+
+    """
+    print('{:<44} {:>12} {:>12} {:>8}'.format(
+        'benchmark', 'seconds', 'baseline', 'change'))
+    slower = []
+    for name in sorted(results):
+        seconds = results[name]
+        if name not in baseline:
+            print('{:<44} {:>12.3e} {:>12} {:>8}'.format(
+                name, seconds, '-', '-'))
+            continue
+        change = seconds / baseline[name] - 1
+        if change > threshold:
+            slower.append(name)
+        print('{:<44} {:>12.3e} {:>12.3e} {:>+7.0%}{}'.format(
+            name, seconds, baseline[name], change,
+            ' !' if change > threshold else ''))
+    return slower
+
+def run(benchmarks, repeat, pattern):
+    """Measure and print each benchmark whose name contains ``pattern``"""
+    results = {}
+    for name, function in benchmarks:
+        if pattern is not None and pattern not in name:
+            continue
+        results[name] = measure(function, repeat)
+        print('{:<44} {:>12.3e}'.format(name, results[name]))
+    return results
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description='Time the hot paths of the Cryptol client.')
+    parser.add_argument('--server', choices=('standin', 'cryptol', 'none'),
+                        default='standin',
+                        help='the server to run the server benchmarks '
+                        'against, or none to skip them')
+    parser.add_argument('--cryptol-server', default='cryptol-server',
+                        help='the cryptol-server executable')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline',
+                        help='compare the results with this results file')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='the slowdown, as a fraction, that fails '
+                        'the comparison')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='the number of runs of each benchmark')
+    parser.add_argument('-k', dest='pattern',
+                        help='run only the benchmarks with this in '
+                        'their name')
+    opts = parser.parse_args(args)
+    results = run(offline_benchmarks(), opts.repeat, opts.pattern)
+    if opts.server == 'standin':
+        from standin_server import StandinServer
+        with StandinServer() as server:
+            cry = Cryptol(cryptol_server=None, port=server.port)
+            try:
+                results.update(run(server_benchmarks(cry), opts.repeat,
+                                   opts.pattern))
+            finally:
+                cry.exit()
+    elif opts.server == 'cryptol':
+        with Cryptol(cryptol_server=opts.cryptol_server) as cry:
+            results.update(run(server_benchmarks(cry), opts.repeat,
+                               opts.pattern))
+    if opts.json is not None:
+        with open(opts.json, 'w') as out:
+            json.dump({'server': opts.server,
+                       'python': platform.python_version(),
+                       'results': results},
+                      out, indent=2, sort_keys=True)
+    if opts.baseline is not None:
+        with open(opts.baseline) as base:
+            baseline = json.load(base)
+        if baseline.get('server') != opts.server:
+            print('warning: the baseline ran against the {} server'.format(
+                baseline.get('server')))
+        print()
+        if compare(results, baseline['results'], opts.threshold):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
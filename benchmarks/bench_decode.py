@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""Microbenchmarks for decoding JSON-formatted Cryptol values.
+
+Compares :func:`cryptol.cryptol._from_value` against the recursive
+decoder it replaced, on large and deeply nested values, both with
+words as ``BitVector`` objects and as :class:`cryptol.Word` objects
+(the ``values='int'`` mode). Run from the
+repository root::
+
+    python benchmarks/bench_decode.py
+
+"""
+
+from __future__ import print_function
+from BitVector import BitVector
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from cryptol.cryptol import _from_value
+from cryptol.word import Word
+
+def recursive_from_value(val):
+    """The recursive decoder, as it was before the rewrite."""
+    if 'bit' in val:
+        return val['bit']
+    if 'record' in val:
+        rec = {}
+        for field in val['record']:
+            rec[field[0]['Name']] = recursive_from_value(field[1])
+        return rec
+    if 'tuple' in val:
+        tup = ()
+        for tval in val['tuple']:
+            tup = tup + (recursive_from_value(tval),)
+        return tup
+    if 'sequence' in val and val['sequence']['isWord']:
+        return BitVector(bitlist=[recursive_from_value(elt)
+                                  for elt in val['sequence']['elements']])
+    if 'sequence' in val and not val['sequence']['isWord']:
+        return [recursive_from_value(elt)
+                for elt in val['sequence']['elements']]
+    if 'word' in val:
+        bv = val['word']['bitvector']
+        intval = int(bv['value'])
+        width = int(bv['width'])
+        if width == 0:
+            return None
+        return BitVector(intVal=intval % (2**width), size=width)
+    if 'function' in val:
+        return None
+    raise ValueError(val)
+
+def word(value, width):
+    """A JSON-formatted word"""
+    return {'word': {'bitvector': {'width': width, 'value': value}}}
+
+def seq(elements, is_word=False):
+    """A JSON-formatted sequence"""
+    return {'sequence': {'isWord': is_word, 'elements': elements}}
+
+def bits(value, width):
+    """A JSON-formatted word given bit by bit"""
+    return seq([{'bit': bool((value >> (width - 1 - i)) & 1)}
+                for i in range(width)], is_word=True)
+
+def deep(depth):
+    """A JSON-formatted value of nested pairs, too deep to recurse into"""
+    val = word(1, 8)
+    for _ in range(depth):
+        val = {'tuple': [val, {'bit': False}]}
+    return val
+
+PAYLOADS = {
+    'bytes [4096][8]': seq([word(i % 256, 8) for i in range(4096)]),
+    'matrix [64][64][32]': seq([seq([word(i * j, 32) for j in range(64)])
+                                for i in range(64)]),
+    'wide tuple (2048 x [16])': {'tuple': [word(i, 16) for i in range(2048)]},
+    'bit-level words [256][64]': seq([bits(i * 7919, 64)
+                                      for i in range(256)]),
+    'records [512]{a, b}': seq([{'record': [[{'Name': 'a'}, word(i, 8)],
+                                            [{'Name': 'b'}, {'bit': True}]]}
+                                for i in range(512)]),
+    'deep nesting (depth 2000)': deep(2000),
+    }
+
+def main():
+    number = 5
+    print('{:<28} {:>15} {:>12} {:>8} {:>12}'.format(
+        'payload', 'recursive', 'iterative', 'speedup', 'int words'))
+    for name in sorted(PAYLOADS):
+        payload = PAYLOADS[name]
+        try:
+            expected = recursive_from_value(payload)
+            old = min(timeit.repeat(lambda: recursive_from_value(payload),
+                                    number=number, repeat=3)) / number
+        except RuntimeError:
+            # recursion limit exceeded
+            expected = None
+            old = None
+        actual = _from_value(payload)
+        if expected is not None:
+            assert actual == expected, name
+        new = min(timeit.repeat(lambda: _from_value(payload),
+                                number=number, repeat=3)) / number
+        ints = min(timeit.repeat(lambda: _from_value(payload, Word),
+                                 number=number, repeat=3)) / number
+        if old is None:
+            old_column, speedup = 'recursion limit', '-'
+        else:
+            old_column = '{:.2f}ms'.format(old * 1000)
+            speedup = '{:.1f}x'.format(old / new)
+        print('{:<28} {:>15} {:>10.2f}ms {:>8} {:>10.2f}ms'.format(
+            name, old_column, new * 1000, speedup, ints * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,21 @@
 # -*- coding: utf-8 -*-
 
+import sys
+
 from .cryptol import (Cryptol, Provers,
                       ProofResult, SatResult, AllSatResult,
-                      CryptolError, CryptolServerError, ProverError)
+                      CryptolError, CryptolServerError, CryptolTimeout,
+                      ProverError, PreparedExpr, ValueHandle)
+from .word import Word
+from .cache import LRUCache, ResultCache
+from .codec import JSONCodec, MsgpackCodec
+from .pool import ModulePool, ShardedCryptol
+from .daemon import SharedCryptol
+from .cegis import Synthesizer
+
+if sys.version_info >= (3, 5):
+    try:
+        from .aio import AsyncCryptol
+    except ImportError:
+        # this version of pyzmq does not provide zmq.asyncio
+        pass
@@ -0,0 +1,529 @@
+# -*- coding: utf-8 -*-
+"""An asyncio interface to the Cryptol interpreter.
+
+This module mirrors :class:`.Cryptol` and the modules it loads, but
+every request to the server is a coroutine running over
+:mod:`zmq.asyncio` sockets, so waiting for Cryptol never blocks the
+event loop. It requires Python 3.5 or newer.
+
+"""
+
+import asyncio
+import atexit
+import time
+import weakref
+import zmq
+import zmq.asyncio
+
+from .cryptol import (Provers, CryptolError, PycryptolInternalError,
+                      _CryptolModule, _free_port, _native_str,
+                      _proof_result_from_response,
+                      _sat_result_from_response, _start_server,
+                      _await_server, _STARTUP_TIMEOUT, _SHUTDOWN_TIMEOUT,
+                      _test_report_from_response, _to_value,
+                      _type_from_response, _value_decoder, _string_types)
+
+class AsyncCryptol(object):
+    """An asyncio Cryptol interpreter session.
+
+    This takes the same arguments as :class:`.Cryptol`, but
+    :meth:`.load_module`, :meth:`.prelude` and :meth:`.exit` are
+    coroutines, as are the methods of the modules they return.
+
+    >>> cry = AsyncCryptol()
+    >>> aes = await cry.load_module('AES.cry')
+    >>> ct = await aes.call('aesEncrypt', (pt, key))
+    >>> await cry.exit()
+
+    :param str cryptol_server: The path to the Cryptol server
+        executable; pass ``None`` to instead connect to an
+        already-running server
+
+    :param str addr: The interface on which to bind the Cryptol server
+
+    :param int port: The port on which to bind the Cryptol server;
+        pass ``None`` to pick a free port automatically when starting
+        a new server
+
+    :param str values: The default representation of words in the
+        modules loaded in this session, ``'bitvector'`` or ``'int'``
+
+    :param float startup_timeout: The number of seconds to wait for
+        the server to accept connections
+
+    :raises CryptolServerError: if the ``cryptol_server`` executable
+        can't be found, exits unexpectedly or does not start in time
+
+    """
+    def __init__(self,
+                 cryptol_server='cryptol-server',
+                 addr='tcp://127.0.0.1',
+                 port=5555,
+                 values='bitvector',
+                 startup_timeout=_STARTUP_TIMEOUT):
+        _value_decoder(values)
+        self.__values = values
+        self.__loaded_modules = []
+        self.__ctx = zmq.asyncio.Context()
+        self.__addr = addr
+
+        if port is None:
+            if cryptol_server is None:
+                raise ValueError(
+                    'A port is required to connect to a running server')
+            port = _free_port(addr)
+        self.__port = port
+
+        start = time.time()
+        if cryptol_server is not None:
+            self.__server = _start_server(cryptol_server, addr, port,
+                                          startup_timeout)
+        else:
+            self.__server = False
+            _await_server(None, addr, port, startup_timeout)
+        self.__startup_latency = time.time() - start
+        self.__shutdown_latency = None
+        self.__main_req = self.__ctx.socket(zmq.REQ)
+        self.__main_req.connect(self.__addr + ':' + str(port))
+        # created on first use, so that it belongs to the running loop
+        self.__control_lock = None
+        atexit.register(self.__close)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.exit()
+
+    def port(self):
+        """The port of the Cryptol server's control socket"""
+        return self.__port
+
+    async def control(self, msg):
+        """Send a control message and return the server's response.
+
+        Control messages from every module of this session share one
+        socket, so each exchange holds a lock.
+
+        """
+        if self.__control_lock is None:
+            self.__control_lock = asyncio.Lock()
+        async with self.__control_lock:
+            await self.__main_req.send_json(msg)
+            return await self.__main_req.recv_json()
+
+    async def load_module(self, filepath, eager=False, values=None):
+        """Load a Cryptol module.
+
+        See :meth:`.Cryptol.load_module`.
+
+        :param str filepath: The filepath of the Cryptol module to load
+
+        :param bool eager: Whether to evaluate every top-level
+            declaration while loading
+
+        :param str values: The representation of words returned by
+            the module; defaults to that of the session
+
+        """
+        if values is None:
+            values = self.__values
+        decode = _value_decoder(values)
+        port, req = await self.__new_client()
+        mod = _AsyncCryptolModule(self, port, req, decode)
+        self.__loaded_modules.append(weakref.ref(mod))
+        await mod._load(filepath, eager)
+        return mod
+
+    async def prelude(self, eager=False, values=None):
+        """Load the Cryptol prelude."""
+        return await self.load_module(None, eager, values)
+
+    async def __new_client(self):
+        """Start up a new REPL session client."""
+        resp = await self.control({'tag': 'connect'})
+        worker_port = resp['port']
+        req = self.__ctx.socket(zmq.REQ)
+        req.connect(self.__addr + ':' + str(worker_port))
+        return (worker_port, req)
+
+    def startup_latency(self):
+        """The number of seconds it took for the server to be ready"""
+        return self.__startup_latency
+
+    def shutdown_latency(self):
+        """The number of seconds :meth:`.exit` took, or ``None``"""
+        return self.__shutdown_latency
+
+    async def exit(self, timeout=_SHUTDOWN_TIMEOUT):
+        """Close the session.
+
+        Any modules loaded in this session will be invalid after
+        calling this method. A server started by this session is
+        asked to exit, and terminated if it has not done so within
+        ``timeout`` seconds, then killed if it ignores that too.
+
+        """
+        if self.__shutdown_latency is not None:
+            return
+        start = time.time()
+        for mod_ref in self.__loaded_modules:
+            mod = mod_ref()
+            if mod is not None:
+                await mod.exit(timeout)
+        if not self.__main_req.closed and self.__server:
+            try:
+                await self.__main_req.send_json({'tag': 'exit'},
+                                                 flags=zmq.NOBLOCK)
+            except zmq.error.ZMQError:
+                pass
+            # give the server time to receive the message and exit
+            # before the sockets are closed
+            await _stop_server_async(
+                self.__server, max(0.0, start + timeout - time.time()))
+        self.__close()
+        self.__shutdown_latency = time.time() - start
+
+    def __close(self):
+        """Close the sockets and stop the server without waiting on it."""
+        if not self.__main_req.closed:
+            self.__main_req.close()
+        if not self.__ctx.closed:
+            self.__ctx.destroy(linger=0)
+        if self.__server and self.__server.poll() is None:
+            self.__server.terminate()
+
+class _AsyncCryptolModule(object):
+    """A Cryptol module loaded in an :class:`.AsyncCryptol` session.
+
+    .. note:: Users of this module should not instantiate this class
+        directly.
+
+    Several coroutines may use the same module at once; their
+    requests are sent to the server worker one at a time, and the
+    options set for a query, such as the prover, are not changed by
+    other coroutines until the query is answered. Cancelling
+    a coroutine that is waiting on the server interrupts the
+    computation, so the worker remains usable.
+
+    """
+    def __init__(self, session, port, req, decode):
+        self.__session = session
+        self.__decode = decode
+        self.__port = port
+        self.__req = req
+        self.__lock = None
+        self.__query_lock = None
+        self.__decls = {}
+        self.__decl_index = {}
+        self.__options = {}
+        self.__option_hits = 0
+        self.__option_misses = 0
+
+    async def _load(self, filepath, eager):
+        """Load the module (or the prelude) and index its declarations."""
+        if filepath is None:
+            load_resp = await self.__request({'tag': 'loadPrelude'})
+        else:
+            load_resp = await self.__request({'tag': 'loadModule',
+                                              'filePath': filepath})
+        if load_resp['tag'] != 'ok':
+            raise CryptolError(load_resp)
+        browse_resp = await self.browse()
+        tl_decls = browse_resp['decls']['ifDecls']
+        for name in tl_decls:
+            # TODO: properly handle polymorphic declarations
+            if len(tl_decls[name]['ifDeclSig']['sVars']) == 0:
+                self.__decl_index[name] = tl_decls[name]
+        if eager:
+            for name in self.__decl_index:
+                await self.decl(name)
+
+    async def __request(self, msg):
+        """Send a request to the worker and wait for its response."""
+        if self.__lock is None:
+            self.__lock = asyncio.Lock()
+        await self.__lock.acquire()
+        release = True
+        try:
+            await self.__req.send_json(msg)
+            try:
+                return await self.__req.recv_json()
+            except asyncio.CancelledError:
+                # Interrupt the server and drain its reply so that the
+                # worker stays usable. The lock is held until that is
+                # done, even if this coroutine is cancelled again.
+                release = False
+                cleanup = asyncio.ensure_future(self.__interrupt())
+                cleanup.add_done_callback(lambda _: self.__lock.release())
+                await asyncio.shield(cleanup)
+                raise
+        finally:
+            if release:
+                self.__lock.release()
+
+    def __queries(self):
+        """The lock held while setting options and running a query."""
+        if self.__query_lock is None:
+            self.__query_lock = asyncio.Lock()
+        return self.__query_lock
+
+    async def __interrupt(self):
+        """Interrupt the worker's current request and drain its reply."""
+        await self.__session.control({'tag': 'interrupt',
+                                      'port': self.__port})
+        await self.__req.recv_json()
+
+    async def __tag_expr(self, tag, expr, fmtargs):
+        """Send a command with a string argument to the Cryptol interpreter."""
+        expr = self.__expand(expr, fmtargs)
+        return await self.__request({'tag': tag, 'expr': expr})
+
+    @staticmethod
+    def __expand(expr, fmtargs):
+        """Fill in the holes of an expression template.
+
+        :raises TypeError: if the given expression is not a string
+
+        """
+        if not isinstance(expr, _string_types):
+            raise TypeError(
+                u'Expected Cryptol expression as string, '
+                'got unsupported type {!r}'.format(type(expr).__name__)
+                )
+        return _CryptolModule.template(expr, fmtargs)
+
+    async def __eval_expr(self, expr):
+        """Evaluate an already-expanded expression."""
+        val = await self.__request({'tag': 'evalExpr', 'expr': expr})
+        if val['tag'] == 'value':
+            return self.__decode(val['value'])
+        elif val['tag'] == 'funValue':
+            return self.__from_funvalue(val['handle'], expr)
+        elif val['tag'] == 'interactiveError':
+            raise CryptolError(val['pp'])
+        else:
+            raise PycryptolInternalError(
+                u'Cryptol evaluation returned a non-value '
+                'message: {}'.format(val))
+
+    def __from_funvalue(self, handle, expr):
+        """Convert a JSON-formatted Cryptol closure to a coroutine function.
+
+        Like the closures of a synchronous module, the result may be
+        applied to several arguments at once.
+
+        """
+        async def clos(*args):
+            """Closure for callable Cryptol function"""
+            if len(args) == 0:
+                raise TypeError(
+                    'Cryptol function expects at least one argument')
+            if len(args) > 1 and expr is not None:
+                try:
+                    full_expr = u'({}) {}'.format(expr, u' '.join(
+                        [u'({})'.format(_CryptolModule.to_expr(arg))
+                         for arg in args]))
+                except TypeError:
+                    # applied one argument at a time instead
+                    pass
+                else:
+                    return await self.__eval_expr(full_expr)
+            val = await self.__request({'tag': 'applyFun',
+                                        'handle': handle,
+                                        'arg': _to_value(args[0])})
+            if val['tag'] == 'value':
+                result = self.__decode(val['value'])
+            elif val['tag'] == 'funValue':
+                result = self.__from_funvalue(val['handle'], None)
+            else:
+                raise PycryptolInternalError(
+                    u'No value returned from applying Cryptol function; '
+                    'instead got {!s}'.format(val))
+            for arg in args[1:]:
+                result = await result(arg)
+            return result
+        clos.__name__ = '<cryptol_closure>'
+        return clos
+
+    async def decl(self, name):
+        """Return a top-level Cryptol declaration in the current module
+
+        Declarations are evaluated the first time they are requested,
+        and the result is reused afterwards.
+
+        :raises CryptolError: if the declaration is not in scope
+
+        """
+        try:
+            return self.__decls[name]
+        except KeyError:
+            pass
+        if name not in self.__decl_index:
+            raise CryptolError(u'Value not in scope: {}'.format(name))
+        val = await self.__eval_expr(u'({})'.format(name))
+        try:
+            val.__name__ = _native_str(name)
+        except AttributeError:
+            pass
+        self.__decls[name] = val
+        return val
+
+    async def call(self, name, *args):
+        """Apply the top-level function ``name`` to ``args``"""
+        fun = await self.decl(name)
+        return await fun(*args)
+
+    async def eval(self, expr, fmtargs=()):
+        """Evaluate a Cryptol expression in this module's context.
+
+        See :meth:`._CryptolModule.eval`.
+
+        """
+        return await self.__eval_expr(self.__expand(expr, fmtargs))
+
+    async def typeof(self, expr, fmtargs=()):
+        """Get the type of a Cryptol expression.
+
+        See :meth:`._CryptolModule.typeof`.
+
+        """
+        resp = await self.__tag_expr('typeOf', expr, fmtargs)
+        return _type_from_response(resp)
+
+    async def check(self, expr, fmtargs=(), limit=100):
+        """Randomly test a Cryptol property.
+
+        See :meth:`._CryptolModule.check`.
+
+        """
+        if expr == '':
+            raise ValueError('Cannot check an empty expression')
+        async with self.__queries():
+            if limit is not None:
+                await self.__setopt('tests', str(limit))
+                cmd = 'check'
+            else:
+                cmd = 'exhaust'
+            resp = await self.__tag_expr(cmd, expr, fmtargs)
+        return _test_report_from_response(resp, self.__decode)
+
+    async def prove(self, expr, fmtargs=(), prover=Provers.CVC4):
+        """Prove validity of a Cryptol property, or find a counterexample.
+
+        See :meth:`._CryptolModule.prove`.
+
+        """
+        async with self.__queries():
+            await self.__setopt('prover', prover.value)
+            resp = await self.__tag_expr('prove', expr, fmtargs)
+        return _proof_result_from_response(resp, self.__decode, prover)
+
+    async def sat(self, expr, fmtargs=(), sat_num=1, prover=Provers.CVC4):
+        """Find satisfying assignments for a Cryptol property.
+
+        See :meth:`._CryptolModule.sat`.
+
+        """
+        async with self.__queries():
+            if sat_num is None:
+                await self.__setopt('satNum', 'all')
+            else:
+                await self.__setopt('satNum', str(sat_num))
+            await self.__setopt('prover', prover.value)
+            resp = await self.__tag_expr('sat', expr, fmtargs)
+        return _sat_result_from_response(resp, sat_num, self.__decode,
+                                         prover)
+
+    async def setopt(self, option, value):
+        """Set an option in the Cryptol session for this module.
+
+        Like :meth:`._CryptolModule.setopt`, setting an option to the
+        value it already has does not contact the server.
+
+        """
+        async with self.__queries():
+            return await self.__setopt(option, value)
+
+    async def __setopt(self, option, value):
+        """Set an option, with the query lock already held."""
+        cached = self.__options.get(option)
+        if cached is not None and cached[0] == value:
+            self.__option_hits += 1
+            return cached[1]
+        self.__option_misses += 1
+        self.__options.pop(option, None)
+        resp = await self.__request({'tag': 'setOpt',
+                                     'key': option,
+                                     'value': value})
+        if resp.get('tag') != 'interactiveError':
+            self.__options[option] = (value, resp)
+        return resp
+
+    def option_cache_stats(self):
+        """Report how many :meth:`.setopt` calls skipped the server.
+
+        See :meth:`._CryptolModule.option_cache_stats`.
+
+        """
+        return {'hits': self.__option_hits, 'misses': self.__option_misses}
+
+    async def browse(self):
+        """Browse the definitions in scope in this module."""
+        return await self.__request({'tag': 'browse'})
+
+    async def exit(self, timeout=_SHUTDOWN_TIMEOUT):
+        """End the Cryptol session for this module.
+
+        :param float timeout: The number of seconds to wait for the
+            worker to acknowledge the exit
+
+        """
+        if not self.__req.closed:
+            try:
+                await self.__req.send_json({'tag': 'exit'},
+                                           flags=zmq.NOBLOCK)
+            except zmq.error.ZMQError:
+                # a request is still in flight
+                pass
+            else:
+                if await self.__req.poll(int(timeout * 1000)):
+                    await self.__req.recv()
+            self.__req.close(linger=0)
+
+async def _stop_server_async(server, timeout):
+    """Wait for a server process to exit, terminating it if need be.
+
+    This is :func:`._stop_server` for the event loop: it escalates
+    from waiting to terminating and then killing the server, without
+    blocking the loop.
+
+    """
+    for stop in (server.terminate, server.kill):
+        if await _await_exit(server, timeout):
+            return
+        try:
+            stop()
+        except OSError:
+            # it exited in the meantime
+            pass
+        timeout = max(timeout, 1.0)
+    await _await_exit(server, None)
+
+async def _await_exit(server, timeout):
+    """Wait up to ``timeout`` seconds for a process to exit.
+
+    :param float timeout: The number of seconds to wait, or ``None``
+        to wait as long as it takes
+
+    :return bool: Whether the process has exited
+
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    delay = 0.001
+    while server.poll() is None:
+        if deadline is not None and time.time() >= deadline:
+            return False
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 0.05)
+    return True
@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+"""Caches for the results of Cryptol queries."""
+
+import collections
+import errno
+import hashlib
+import json
+import os
+import pickle
+import re
+import tempfile
+import threading
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+class ResultCache(object):
+    """A persistent on-disk cache of proof, SAT and exhaustive test results.
+
+    Pass an instance as the ``result_cache`` argument of
+    :class:`.Cryptol` to have :meth:`._CryptolModule.prove`,
+    :meth:`._CryptolModule.sat` and exhaustive
+    :meth:`._CryptolModule.check` look up their results here before
+    contacting the server.
+
+    Results are keyed by the content of the module file and of the
+    modules it imports, transitively, along with the expanded
+    expression and the options that affect the query, such as the
+    prover. Editing a module therefore invalidates its cached results,
+    while identical copies of a module, such as the checkouts of
+    different CI runs, share them. Results from random testing are
+    never cached, since they are not deterministic.
+
+    The cache is safe to share between threads and between processes:
+    each entry is written to a temporary file and atomically renamed
+    into place, and eviction is serialized with a lock file where the
+    platform supports it. Once the entries take more than
+    ``max_bytes``, the least recently used ones are evicted. Each
+    instance keeps a running total of the size of the cache, counting
+    its own stores, and only scans the directory once that total
+    exceeds the bound; entries stored by other processes are counted
+    at the next scan.
+
+    :param str directory: The directory in which to store results; it
+        is created if it does not exist
+
+    :param int max_bytes: The size bound of the cache, in bytes
+
+    :param str namespace: An extra string mixed into every key, such
+        as the version of the Cryptol server, to keep results from
+        incompatible setups apart
+
+    """
+    def __init__(self, directory, max_bytes=256 * 2**20, namespace=''):
+        self.__directory = os.path.abspath(directory)
+        self.__max_bytes = max_bytes
+        self.__namespace = namespace
+        self.__hits = 0
+        self.__misses = 0
+        self.__lock = threading.Lock()
+        try:
+            os.makedirs(self.__directory)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        self.__bytes = None
+
+    def key(self, filepath, command, expr, options, digest=None):
+        """Compute the cache key of a query.
+
+        :param str filepath: The filepath of the module the query runs
+            in, or ``None`` for the prelude
+
+        :param str command: The server command, such as ``prove``
+
+        :param str expr: The fully expanded expression
+
+        :param dict options: The options that affect the result, such
+            as the prover
+
+        :param str digest: The :func:`module_digest` of the module, if
+            already known; otherwise it is computed from ``filepath``
+
+        :return str: A hexadecimal digest
+
+        """
+        if filepath is None:
+            digest = 'prelude'
+        elif digest is None:
+            digest = module_digest(filepath)
+        parts = [self.__namespace, digest, command, expr,
+                 sorted(options.items())]
+        blob = json.dumps(parts, sort_keys=True).encode('utf-8')
+        return hashlib.sha256(blob).hexdigest()
+
+    def __path(self, key):
+        return os.path.join(self.__directory, key[:2], key + '.pickle')
+
+    def get(self, key):
+        """Return the cached result for ``key``, or ``None``."""
+        path = self.__path(key)
+        try:
+            with open(path, 'rb') as entry:
+                result = pickle.load(entry)
+        except (IOError, OSError):
+            result = None
+        except Exception:
+            # a truncated or incompatible entry; treat it as missing
+            _remove(path)
+            result = None
+        with self.__lock:
+            if result is None:
+                self.__misses += 1
+                return None
+            self.__hits += 1
+        try:
+            # record the use, for least-recently-used eviction
+            os.utime(path, None)
+        except OSError:
+            pass
+        return result
+
+    def put(self, key, result):
+        """Store ``result`` under ``key``, evicting old entries if needed."""
+        path = self.__path(key)
+        subdir = os.path.dirname(path)
+        try:
+            os.makedirs(subdir)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        fd, tmp = tempfile.mkstemp(dir=subdir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as entry:
+                pickle.dump(result, entry, 2)
+                size = entry.tell()
+            os.rename(tmp, path)
+        except:
+            _remove(tmp)
+            raise
+        with self.__lock:
+            if self.__bytes is not None:
+                self.__bytes += size
+            over = self.__bytes is None or self.__bytes > self.__max_bytes
+        if over:
+            self.__evict(path)
+
+    def __evict(self, keep):
+        """Remove least recently used entries until under the size bound.
+
+        This scans the whole cache, and resets the running total of
+        its size.
+
+        :param str keep: The path of an entry that must not be evicted,
+            such as the one just written
+
+        """
+        with _FileLock(os.path.join(self.__directory, '.lock')):
+            entries = []
+            total = 0
+            for dirpath, _, filenames in os.walk(self.__directory):
+                for filename in filenames:
+                    if not filename.endswith('.pickle'):
+                        continue
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+                    total += stat.st_size
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.__max_bytes:
+                    break
+                if path == keep:
+                    continue
+                _remove(path)
+                total -= size
+        with self.__lock:
+            self.__bytes = total
+
+    def clear(self):
+        """Remove every entry from the cache."""
+        with _FileLock(os.path.join(self.__directory, '.lock')):
+            for dirpath, _, filenames in os.walk(self.__directory):
+                for filename in filenames:
+                    if filename.endswith('.pickle'):
+                        _remove(os.path.join(dirpath, filename))
+        with self.__lock:
+            self.__bytes = None
+
+    def stats(self):
+        """Report the hits and misses of this cache instance.
+
+        :return dict: ``hits`` and ``misses`` counts
+
+        """
+        with self.__lock:
+            return {'hits': self.__hits, 'misses': self.__misses}
+
+class LRUCache(object):
+    """A bounded in-memory cache, evicting the least recently used entry.
+
+    Modules use this to memoize evaluation results (see
+    :meth:`._CryptolModule.enable_memo`), storing the server's
+    responses rather than decoded Python values, so that every hit
+    returns fresh objects that callers are free to modify.
+
+    :param int capacity: The maximum number of entries
+
+    :param int max_bytes: The maximum total size of the entries, as
+        measured by ``sizeof``, or ``None`` for no bound
+
+    :param sizeof: A function estimating the size of an entry in
+        bytes; by default, the length of its JSON encoding
+
+    """
+    def __init__(self, capacity=1024, max_bytes=None, sizeof=None):
+        if capacity < 1:
+            raise ValueError('An LRU cache needs a capacity of at least 1')
+        self.__capacity = capacity
+        self.__max_bytes = max_bytes
+        if sizeof is None:
+            sizeof = lambda entry: len(json.dumps(entry))
+        self.__sizeof = sizeof
+        self.__entries = collections.OrderedDict()
+        self.__bytes = 0
+        self.__hits = 0
+        self.__misses = 0
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get(self, key):
+        """Return the entry for ``key``, or ``None``."""
+        with self.__lock:
+            try:
+                entry = self.__entries.pop(key)
+            except KeyError:
+                self.__misses += 1
+                return None
+            # reinsert to mark it as the most recently used
+            self.__entries[key] = entry
+            self.__hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        """Store ``value`` under ``key``, evicting old entries if needed."""
+        size = 0
+        if self.__max_bytes is not None:
+            size = self.__sizeof(value)
+            if size > self.__max_bytes:
+                return
+        with self.__lock:
+            old = self.__entries.pop(key, None)
+            if old is not None:
+                self.__bytes -= old[1]
+            self.__entries[key] = (value, size)
+            self.__bytes += size
+            while (len(self.__entries) > self.__capacity or
+                   (self.__max_bytes is not None and
+                    self.__bytes > self.__max_bytes)):
+                _, (_, evicted) = self.__entries.popitem(last=False)
+                self.__bytes -= evicted
+
+    def clear(self):
+        """Remove every entry."""
+        with self.__lock:
+            self.__entries.clear()
+            self.__bytes = 0
+
+    def stats(self):
+        """Report the effectiveness of this cache.
+
+        :return dict: ``hits``, ``misses`` and ``hit_rate``, along with
+            the current number of ``entries`` and their total
+            ``bytes`` (zero unless ``max_bytes`` is set)
+
+        """
+        with self.__lock:
+            lookups = self.__hits + self.__misses
+            if lookups == 0:
+                rate = 0.0
+            else:
+                rate = float(self.__hits) / lookups
+            return {'hits': self.__hits,
+                    'misses': self.__misses,
+                    'hit_rate': rate,
+                    'entries': len(self.__entries),
+                    'bytes': self.__bytes}
+
+_IMPORT = re.compile(r"^\s*import\s+([A-Za-z_][\w']*(?:::[A-Za-z_][\w']*)*)",
+                     re.MULTILINE)
+
+_digests = {}
+_digests_lock = threading.Lock()
+
+def module_digest(filepath):
+    """Hash a Cryptol module together with everything it imports.
+
+    Imports are resolved relative to the directory of the importing
+    module and then along ``CRYPTOLPATH``. Imports that cannot be
+    found, such as modules built into Cryptol, contribute only their
+    name. Files are identified by their file name and import names
+    rather than by where they are, so copies of a module in different
+    directories have the same digest.
+
+    :param str filepath: The filepath of the Cryptol module
+
+    :return str: A hexadecimal digest
+
+    """
+    sha = hashlib.sha256()
+    seen = set()
+    path = os.path.abspath(filepath)
+    pending = [(path, os.path.basename(path))]
+    while pending:
+        path, name = pending.pop()
+        if path in seen:
+            continue
+        seen.add(path)
+        digest, imports = _file_digest(path)
+        sha.update(name.encode('utf-8'))
+        sha.update(digest.encode('ascii'))
+        for name in imports:
+            found = _resolve_import(name, os.path.dirname(path))
+            if found is None:
+                sha.update(name.encode('utf-8'))
+            else:
+                pending.append((found, name))
+    return sha.hexdigest()
+
+def _file_digest(path):
+    """Hash one file and find its imports, reusing unchanged results."""
+    stat = os.stat(path)
+    stamp = (stat.st_mtime, stat.st_size)
+    with _digests_lock:
+        cached = _digests.get(path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1], cached[2]
+    with open(path, 'rb') as src:
+        content = src.read()
+    digest = hashlib.sha256(content).hexdigest()
+    imports = _IMPORT.findall(content.decode('utf-8', 'replace'))
+    with _digests_lock:
+        _digests[path] = (stamp, digest, imports)
+    return digest, imports
+
+def _resolve_import(name, directory):
+    """Find the file defining the module ``name``, or ``None``."""
+    relpath = os.path.join(*name.split('::')) + '.cry'
+    search = [directory]
+    search.extend(p for p in os.environ.get('CRYPTOLPATH', '').split(
+        os.pathsep) if p)
+    for base in search:
+        candidate = os.path.abspath(os.path.join(base, relpath))
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+def _remove(path):
+    """Remove a file, ignoring it if it is already gone."""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+class _FileLock(object):
+    """An exclusive lock on a file, shared between processes.
+
+    On platforms without :mod:`fcntl` this does nothing; writes are
+    still atomic, but concurrent evictions may remove more entries
+    than necessary.
+
+    """
+    def __init__(self, path):
+        self.__path = path
+        self.__file = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            self.__file = open(self.__path, 'a')
+            fcntl.flock(self.__file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.__file is not None:
+            fcntl.flock(self.__file.fileno(), fcntl.LOCK_UN)
+            self.__file.close()
+            self.__file = None
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""Counterexample-guided inductive synthesis over Cryptol sessions."""
+
+from .cryptol import Provers, _CryptolModule
+from .pool import _scatter
+import time
+
+class Synthesizer(object):
+    """A counterexample-guided inductive synthesis (CEGIS) loop.
+
+    Each iteration asks a SAT solver for a candidate program that
+    agrees with a specification on every example found so far, then
+    tries to prove the candidate correct for all inputs. A
+    counterexample to the proof becomes a new example, and the loop
+    repeats until a candidate is proved correct or no candidate
+    remains.
+
+    The synthesis query names the examples through a single ``?``
+    hole, which is filled in with a Cryptol list of the examples. Each
+    example is converted to Cryptol once, when it is found, and added
+    to the list kept from earlier iterations, so an iteration converts
+    only its own counterexample however many examples came before.
+
+    >>> synth = Synthesizer(
+    ...     crc32,
+    ...     '\\\\program -> compute_program(program:[26][lginsn], '
+    ...     'CRC32_oracle, [CRC32_to_state(test) | test <- ?])',
+    ...     '\\\\a -> program_is_correct(?, CRC32_oracle, CRC32_to_state(a))',
+    ...     examples=[Word(0, 32)], verifier=crc32_verifier)
+    >>> result = synth.run()
+    >>> result.get_program()
+
+    With a ``verifier``, a second module on another worker, the proof
+    runs on the verifier while the synthesis worker, otherwise idle,
+    randomly tests the same candidate; whichever first finds a
+    counterexample ends the step, and the other is interrupted.
+
+    :param module: The module in which to find candidates
+
+    :param str synth: The property whose satisfying assignments are
+        candidates, with a ``?`` for the list of examples
+
+    :param str verify: The property that holds for every input when a
+        candidate is correct, with a ``?`` for the candidate
+
+    :param examples: The examples to start with, each a value of
+        the argument of ``verify`` (or a tuple of them, if it has
+        several)
+
+    :param verifier: A module with the same declarations as
+        ``module`` on which to run the proofs, or ``None`` to run
+        them on ``module``
+
+    :param Provers synth_prover: The prover for synthesis queries
+
+    :param Provers verify_prover: The prover for proofs of candidates
+
+    :param int check_limit: The number of random tests the synthesis
+        worker runs on each candidate while a ``verifier`` proves it
+
+    :raises ValueError: if ``synth`` or ``verify`` does not have
+        exactly one hole
+
+    """
+    def __init__(self, module, synth, verify, examples=(), verifier=None,
+                 synth_prover=Provers.ABC, verify_prover=Provers.Z3,
+                 check_limit=100):
+        for expr in (synth, verify):
+            if expr.count('?') != 1:
+                raise ValueError(
+                    'Synthesis properties take exactly one ?: ' + expr)
+        self.__module = module
+        self.__synth = synth.split('?')
+        self.__verify = verify
+        self.__verifier = verifier
+        self.__synth_prover = synth_prover
+        self.__verify_prover = verify_prover
+        self.__check_limit = check_limit
+        self.__examples = []
+        self.__rendered = u''
+        for example in examples:
+            self.add_example(example)
+
+    def examples(self):
+        """The examples found so far, oldest first"""
+        return list(self.__examples)
+
+    def add_example(self, example):
+        """Add an example that every later candidate must agree with.
+
+        :param example: A value of the argument of the verification
+            property, or a tuple of them
+
+        """
+        text = u'({})'.format(_CryptolModule.to_expr(example))
+        if self.__rendered:
+            self.__rendered += u', ' + text
+        else:
+            self.__rendered = text
+        self.__examples.append(example)
+
+    def run(self, max_iterations=None, on_iteration=None):
+        """Search for a correct program.
+
+        :param int max_iterations: The number of candidates to try
+            before giving up, or ``None`` to keep trying
+
+        :param on_iteration: A function called with each finished
+            :class:`.SynthesisIteration`
+
+        :return: A :class:`.SynthesisResult`, with a program if one
+            was proved correct
+
+        :raises CryptolError: if a query fails
+
+        """
+        iterations = []
+        while max_iterations is None or len(iterations) < max_iterations:
+            start = time.time()
+            expr = u'{}[{}]{}'.format(self.__synth[0], self.__rendered,
+                                      self.__synth[1])
+            render_time = time.time() - start
+            sat = self.__module.sat(expr, prover=self.__synth_prover)
+            synth_time = time.time() - start - render_time
+            if not sat.has_assignment():
+                iteration = SynthesisIteration(
+                    None, None, None, render_time, synth_time, 0.0,
+                    len(expr))
+            else:
+                program = _single(sat.get_assignment())
+                start = time.time()
+                cex, found_by = self.__counterexample(program)
+                verify_time = time.time() - start
+                if cex is not None:
+                    self.add_example(cex)
+                    render_time += time.time() - start - verify_time
+                iteration = SynthesisIteration(
+                    program, cex, found_by, render_time, synth_time,
+                    verify_time, len(expr))
+            iterations.append(iteration)
+            if on_iteration is not None:
+                on_iteration(iteration)
+            if not iteration.has_candidate():
+                return SynthesisResult(None, self.examples(), iterations)
+            if not iteration.has_counterexample():
+                return SynthesisResult(iteration.candidate(),
+                                       self.examples(), iterations)
+        return SynthesisResult(None, self.examples(), iterations)
+
+    def __counterexample(self, program):
+        """Find a counterexample to a candidate.
+
+        :return: A pair of the counterexample, or ``None`` if the
+            candidate is correct, and ``'prove'`` or ``'check'`` for
+            the query that decided it
+
+        """
+        expr = _CryptolModule.template(self.__verify, (program,))
+        if self.__verifier is None:
+            result = self.__module.prove(expr, prover=self.__verify_prover)
+            return _counterexample(result), 'prove'
+        names = ('prove', 'check')
+        outcomes = _scatter(
+            [self.__verifier, self.__module],
+            [lambda mod: mod.prove(expr, prover=self.__verify_prover),
+             lambda mod: mod.check(expr, limit=self.__check_limit)],
+            wait=True)
+        errors = {}
+        try:
+            for index, result, err in outcomes:
+                name = names[index]
+                if err is not None:
+                    errors[name] = err
+                elif result.has_counterexample():
+                    return _counterexample(result), name
+                elif name == 'prove':
+                    return None, name
+            raise errors.get('prove', errors.get('check'))
+        finally:
+            # interrupts the query still running, and waits for it
+            outcomes.close()
+
+class SynthesisIteration(object):
+    """One iteration of a :class:`.Synthesizer` loop.
+
+    Times are in seconds, as seen by the client; those of queries
+    include sending the query and its answer as well as solving it.
+    """
+
+    def __init__(self, candidate, cex, found_by, render_time, synth_time,
+                 verify_time, query_size):
+        self.__candidate = candidate
+        self.__cex = cex
+        self.__found_by = found_by
+        self.__render_time = render_time
+        self.__synth_time = synth_time
+        self.__verify_time = verify_time
+        self.__query_size = query_size
+
+    def __str__(self):
+        if self.__candidate is None:
+            return 'no candidate'
+        elif self.__cex is None:
+            return 'correct'
+        else:
+            return 'counterexample'
+
+    def has_candidate(self):
+        """Was a candidate found?"""
+        return self.__candidate is not None
+
+    def candidate(self):
+        """The candidate program, or ``None`` if there was none"""
+        return self.__candidate
+
+    def has_counterexample(self):
+        """Was the candidate refuted?"""
+        return self.__cex is not None
+
+    def counterexample(self):
+        """The counterexample to the candidate, or ``None``"""
+        return self.__cex
+
+    def found_by(self):
+        """``'prove'`` or ``'check'``: the query that decided the candidate"""
+        return self.__found_by
+
+    def render_time(self):
+        """The time spent converting examples and building the query"""
+        return self.__render_time
+
+    def synth_time(self):
+        """The time spent waiting for the synthesis query"""
+        return self.__synth_time
+
+    def verify_time(self):
+        """The time spent waiting for the candidate to be decided"""
+        return self.__verify_time
+
+    def query_size(self):
+        """The length of the synthesis query, in characters"""
+        return self.__query_size
+
+class SynthesisResult(object):
+    """The result of :meth:`.Synthesizer.run`"""
+
+    def __init__(self, program, examples, iterations):
+        self.__program = program
+        self.__examples = examples
+        self.__iterations = iterations
+
+    def __str__(self):
+        if self.__program is None:
+            return 'not found'
+        else:
+            return 'found'
+
+    def has_program(self):
+        """Was a correct program found?"""
+        return self.__program is not None
+
+    def get_program(self):
+        """Return the program proved correct"""
+        if self.__program is None:
+            raise ValueError('No program was found')
+        return self.__program
+
+    def examples(self):
+        """The examples the program was found from"""
+        return self.__examples
+
+    def iterations(self):
+        """The :class:`.SynthesisIteration` s of the search, in order"""
+        return self.__iterations
+
+def _single(args):
+    """A lone argument, or a tuple of several"""
+    if len(args) == 1:
+        return args[0]
+    return tuple(args)
+
+def _counterexample(result):
+    """The counterexample in a proof result or test report, if any"""
+    if not result.has_counterexample():
+        return None
+    return _single(result.get_counterexample())
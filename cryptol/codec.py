@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""Wire formats for messages exchanged with Cryptol server workers.
+
+The control socket of a Cryptol server always speaks JSON, but each
+worker socket may use a faster codec agreed on when the worker is
+created (see the ``codec`` argument of :class:`.Cryptol`):
+
+* :class:`JSONCodec` is understood by every server, and can use a
+  faster JSON library than :mod:`json` in place of the standard one.
+
+* :class:`MsgpackCodec` packs messages with MessagePack, sending the
+  value of every bitvector as raw big-endian bytes instead of as a
+  decimal number. It requires the ``msgpack`` package, and a server
+  that offers it.
+
+"""
+
+import binascii
+import importlib
+import json
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    _string_types = basestring
+except NameError:
+    _string_types = str
+
+_WIDE_INT = 0x2b7e151628aed2a6abf7158809cf4f3c
+"""An integer wider than 64 bits, to test JSON libraries with"""
+
+class JSONCodec(object):
+    """Encode messages as JSON.
+
+    Bitvector values are sent as JSON integers of any size, such as
+    the 128-bit keys of AES, so the library has to encode and decode
+    integers wider than 64 bits exactly. ``simplejson`` and
+    ``rapidjson`` do; ``ujson`` and ``orjson`` do not, and are
+    rejected.
+
+    :param engine: A JSON library providing ``dumps`` and ``loads``,
+        or its module name; defaults to :mod:`json`
+
+    :raises ValueError: if the library cannot handle wide integers
+
+    """
+    name = 'json'
+
+    def __init__(self, engine=None):
+        if engine is None:
+            engine = json
+        elif not hasattr(engine, 'dumps'):
+            engine = importlib.import_module(engine)
+        self.__dumps = engine.dumps
+        self.__loads = engine.loads
+        if engine is not json:
+            try:
+                wide = self.decode(self.encode([_WIDE_INT]))
+            except Exception:
+                wide = None
+            if wide != [_WIDE_INT]:
+                raise ValueError(
+                    u'The JSON library {} cannot handle integers wider than '
+                    '64 bits'.format(getattr(engine, '__name__', engine)))
+
+    def encode(self, msg):
+        """Encode a message as bytes"""
+        data = self.__dumps(msg)
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        return data
+
+    def decode(self, data):
+        """Decode a message from bytes"""
+        return self.__loads(data.decode('utf-8'))
+
+class MsgpackCodec(object):
+    """Encode messages with MessagePack.
+
+    Messages have the same structure as in JSON, except that the
+    ``value`` of each ``bitvector`` is a byte string holding the
+    value in big-endian order, in as few bytes as its width allows.
+    Decoded messages keep these byte strings; the value decoders of
+    :mod:`cryptol.cryptol` accept either form (see :func:`bv_int`).
+
+    :raises ImportError: if ``msgpack`` is not installed
+
+    """
+    name = 'msgpack'
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError('The msgpack codec requires msgpack')
+
+    def encode(self, msg):
+        """Encode a message as bytes"""
+        return msgpack.packb(_pack_bitvectors(msg), use_bin_type=True)
+
+    def decode(self, data):
+        """Decode a message from bytes"""
+        return msgpack.unpackb(data, raw=False)
+
+_CODECS = {
+    'json': JSONCodec,
+    'msgpack': MsgpackCodec,
+    }
+
+def available_codecs():
+    """The names of the codecs usable here, fastest first"""
+    names = []
+    if msgpack is not None:
+        names.append('msgpack')
+    names.append('json')
+    return names
+
+def get_codec(codec):
+    """Look up a codec by name, or pass a codec instance through.
+
+    :raises ValueError: if there is no codec with that name
+
+    """
+    if not isinstance(codec, _string_types):
+        return codec
+    try:
+        factory = _CODECS[codec]
+    except KeyError:
+        raise ValueError(
+            u'Unknown codec {!r}; expected one of {}'.format(
+                codec, ', '.join(sorted(_CODECS))))
+    return factory()
+
+def bv_int(value):
+    """The integer value of a bitvector, as decoded by any codec"""
+    if isinstance(value, bytes):
+        return _from_bytes(value)
+    return int(value)
+
+def bv_bytes(value, width):
+    """The big-endian bytes of a bitvector of the given width"""
+    return _to_bytes(value & ((1 << width) - 1), (width + 7) // 8)
+
+if hasattr(int, 'from_bytes'):
+    def _from_bytes(data):
+        """Big-endian bytes to an integer"""
+        return int.from_bytes(data, 'big')
+
+    def _to_bytes(value, size):
+        """An integer to ``size`` big-endian bytes"""
+        return value.to_bytes(size, 'big')
+else:
+    def _from_bytes(data):
+        """Big-endian bytes to an integer"""
+        if not data:
+            return 0
+        return int(binascii.hexlify(data), 16)
+
+    def _to_bytes(value, size):
+        """An integer to ``size`` big-endian bytes"""
+        if size == 0:
+            return b''
+        return binascii.unhexlify('{:x}'.format(value).rjust(size * 2, '0'))
+
+def _pack_bitvectors(msg):
+    """Copy a message, replacing bitvector values by their bytes.
+
+    The copy is made with an explicit stack rather than by recursion,
+    since values may be nested deeply. Containers are shared between
+    messages (see :data:`cryptol.cryptol._BYTE_VALUES`), so they are
+    never modified in place.
+
+    """
+    root = [None]
+    pending = [(msg, root, 0)]
+    while pending:
+        node, parent, idx = pending.pop()
+        if isinstance(node, dict):
+            bv = node.get('bitvector')
+            if isinstance(bv, dict) and len(node) == 1:
+                width = int(bv['width'])
+                parent[idx] = {'bitvector': {
+                    'width': width,
+                    'value': bv_bytes(bv_int(bv['value']), width)}}
+                continue
+            copy = {}
+            parent[idx] = copy
+            for key, val in node.items():
+                pending.append((val, copy, key))
+        elif isinstance(node, (list, tuple)):
+            copy = [None] * len(node)
+            parent[idx] = copy
+            for i, val in enumerate(node):
+                pending.append((val, copy, i))
+        else:
+            parent[idx] = node
+    return root[0]
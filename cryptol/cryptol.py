@@ -2,16 +2,44 @@
 # pylint: disable=too-many-return-statements,no-member,fixme
 """An interface to the Cryptol interpreter."""
 
+from .cache import LRUCache, module_digest
+from .codec import JSONCodec, available_codecs, bv_int, get_codec
+from .word import Word
 from BitVector import BitVector
 import atexit
 import enum
+import errno
+import itertools
+import json
 import os
-import string
 import time
 import re
+import socket
 import subprocess
+import threading
 import weakref
 import zmq
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    _string_types = basestring
+    _long = long
+except NameError:
+    _string_types = str
+    _long = int
+_bytes_types = (bytes, bytearray)
+
+_STARTUP_TIMEOUT = 30.0
+"""The default number of seconds to wait for a server to start"""
+
+_SHUTDOWN_TIMEOUT = 5.0
+"""The default number of seconds to wait for a server to exit"""
+
+_INTERRUPT_GRACE = 5.0
+"""The number of seconds to wait for a worker to answer an interrupt"""
 
 class Provers(enum.Enum):
     """Available provers for Cryptol"""
@@ -34,12 +62,16 @@ class Provers(enum.Enum):
 class ProofResult(object):
     """The result of a call to :meth:`.prove`"""
 
-    def __init__(self, is_valid, cex):
+    # for results pickled before provers were recorded
+    __prover = None
+
+    def __init__(self, is_valid, cex, prover=None):
         if is_valid and cex is not None:
             raise PycryptolInternalError(
                 'Counterexample given for valid property')
         self.__is_valid = is_valid
         self.__cex = cex
+        self.__prover = prover
 
     def __str__(self):
         if self.__is_valid:
@@ -61,15 +93,23 @@ class ProofResult(object):
             raise ValueError('No counterexample for valid property')
         return self.__cex
 
+    def prover(self):
+        """The :class:`.Provers` member that produced this result"""
+        return self.__prover
+
 class SatResult(object):
     """The result of a call to :meth:`.sat` with ``sat_num=1``"""
 
-    def __init__(self, is_sat, args):
+    # for results pickled before provers were recorded
+    __prover = None
+
+    def __init__(self, is_sat, args, prover=None):
         if is_sat and args is None:
             raise PycryptolInternalError(
                 'No satisfying assignment given for satisfiable property')
         self.__is_sat = is_sat
         self.__args = args
+        self.__prover = prover
 
     def __str__(self):
         if self.__is_sat:
@@ -91,15 +131,23 @@ class SatResult(object):
             raise ValueError('No satisfying assignment for unsat property')
         return self.__args
 
+    def prover(self):
+        """The :class:`.Provers` member that produced this result"""
+        return self.__prover
+
 class AllSatResult(object):
     """The result of a call to :meth:`.sat` with ``sat_num`` other than ``1``"""
 
-    def __init__(self, is_sat, argss):
+    # for results pickled before provers were recorded
+    __prover = None
+
+    def __init__(self, is_sat, argss, prover=None):
         if is_sat and argss is None:
             raise PycryptolInternalError(
                 'No satisfying assignments given for satisfiable property')
         self.__is_sat = is_sat
         self.__argss = argss
+        self.__prover = prover
 
     def __str__(self):
         if self.__is_sat:
@@ -123,6 +171,10 @@ class AllSatResult(object):
             raise ValueError('No satisfying assignments for unsat property')
         return self.__argss
 
+    def prover(self):
+        """The :class:`.Provers` member that produced this result"""
+        return self.__prover
+
 class TestReport(object):
     """The result of a call to :meth:`.check`"""
 
@@ -196,7 +248,32 @@ class Cryptol(object):
 
     :param str addr: The interface on which to bind the Cryptol server
 
-    :param int port: The port on which to bind the Cryptol server
+    :param int port: The port on which to bind the Cryptol server;
+        pass ``None`` to pick a free port automatically when starting
+        a new server
+
+    :param ResultCache result_cache: A persistent cache of proof, SAT
+        and exhaustive test results shared by the modules loaded in
+        this session (see :class:`.ResultCache`)
+
+    :param float startup_timeout: The number of seconds to wait for
+        the server to accept connections
+
+    :param codec: The wire format for messages to the modules loaded
+        in this session: a codec name from :mod:`cryptol.codec`, a
+        codec instance such as a :class:`.JSONCodec` with a faster
+        JSON library, or ``'auto'`` to agree on the fastest codec
+        supported by both this client and the server, falling back
+        to JSON for servers that offer no other
+
+    :param str values: The default representation of words in the
+        modules loaded in this session: ``'bitvector'`` for
+        :class:`BitVector.BitVector` objects, ``'int'`` for the
+        lighter :class:`.Word` objects, ``'numpy'`` for
+        :class:`.Word` objects with sequences of words of up to 64
+        bits, and nested sequences of them, as unsigned NumPy arrays,
+        or ``'bytes'`` for :class:`.Word` objects with sequences of
+        8-bit words as ``bytes``
 
     :raises CryptolServerError: if the ``cryptol_server`` executable
         can't be found or exits unexpectedly
@@ -205,47 +282,52 @@ class Cryptol(object):
     def __init__(self,
                  cryptol_server='cryptol-server',
                  addr='tcp://127.0.0.1',
-                 port=5555):
+                 port=5555,
+                 result_cache=None,
+                 values='bitvector',
+                 codec='json',
+                 startup_timeout=_STARTUP_TIMEOUT):
+        _value_decoder(values)
+        if codec == 'auto':
+            self.__codec = None
+            self.__codecs = available_codecs()
+        else:
+            self.__codec = get_codec(codec)
+            if self.__codec.name == 'json':
+                # every server speaks JSON; there is nothing to offer
+                self.__codecs = None
+            else:
+                self.__codecs = [self.__codec.name]
         self.__loaded_modules = []
+        self.__sources = {}
+        self.__sources_lock = threading.Lock()
+        self.__result_cache = result_cache
+        self.__values = values
         self.__ctx = zmq.Context()
+        # bound the time spent delivering the last messages of closed
+        # sockets, in case the server is gone by then
+        self.__ctx.setsockopt(zmq.LINGER, int(_SHUTDOWN_TIMEOUT * 1000))
         self.__addr = addr
 
-        if cryptol_server is not None:
-            # Start the server
-            null = open(os.devnull, 'wb')
-            try:
-                args = [cryptol_server,
-                        '--port', str(port),
-                        '--mask-interrupts']
-                self.__server = subprocess.Popen(args,
-                                                 stdin=subprocess.PIPE,
-                                                 stdout=null,
-                                                 stderr=null,
-                                                 shell=True)
-            except OSError as err:
-                if err.errno == os.errno.ENOENT:
-                    raise CryptolServerError(
-                        u'Could not find Cryptol server executable {!r}.\n'
-                        'Make sure it is on your system path, or pass a '
-                        'different path for the cryptol_server argument.'
-                        .format(cryptol_server)
-                        )
-                else:
-                    raise
+        if port is None:
+            if cryptol_server is None:
+                raise ValueError(
+                    'A port is required to connect to a running server')
+            port = _free_port(addr)
+        self.__port = port
 
-            # wait a little bit to make sure the server doesn't
-            # promptly exit
-            time.sleep(0.01)
-            result = self.__server.poll()
-            if result is not None:
-                raise CryptolServerError(
-                    u'Cryptol server executable {!r} exited unexpectedly '
-                    'with exit code {:d}'.format(cryptol_server, result)
-                    )
+        start = time.time()
+        if cryptol_server is not None:
+            self.__server = _start_server(cryptol_server, addr, port,
+                                          startup_timeout)
         else:
             self.__server = False
+            _await_server(None, addr, port, startup_timeout)
+        self.__startup_latency = time.time() - start
+        self.__shutdown_latency = None
         self.__main_req = self.__ctx.socket(zmq.REQ)
         self.__main_req.connect(self.__addr + ':' + str(port))
+        self.__control = _ControlChannel(self.__main_req)
         atexit.register(self.exit)
 
     def __enter__(self):
@@ -255,62 +337,212 @@ class Cryptol(object):
         self.exit()
         return None
 
-    def exit(self):
+    def port(self):
+        """The port of the Cryptol server's control socket"""
+        return self.__port
+
+    def startup_latency(self):
+        """The number of seconds it took for the server to be ready"""
+        return self.__startup_latency
+
+    def shutdown_latency(self):
+        """The number of seconds :meth:`.exit` took to stop the server.
+
+        This is ``None`` until the session has exited.
+
+        """
+        return self.__shutdown_latency
+
+    def exit(self, timeout=_SHUTDOWN_TIMEOUT):
         """Close the session.
 
         Any modules loaded in this session will be invalid after
-        calling this method.
+        calling this method. A server started by this session is
+        asked to exit, and terminated if it has not done so within
+        ``timeout`` seconds.
+
+        :param float timeout: The number of seconds to wait for the
+            server to exit
 
         """
+        if self.__shutdown_latency is not None:
+            return
+        start = time.time()
         for mod_ref in self.__loaded_modules:
             mod = mod_ref()
             if mod is not None:
-                mod.exit()
+                mod.exit(timeout)
         if not self.__main_req.closed and self.__server:
-            self.__main_req.send_json({'tag': 'exit'}, flags=zmq.NOBLOCK)
-            self.__main_req.close()
+            try:
+                self.__main_req.send_json({'tag': 'exit'}, flags=zmq.NOBLOCK)
+            except zmq.error.ZMQError:
+                # a control request is still in flight
+                pass
+        if not self.__main_req.closed:
+            # bound the time spent delivering the exit message, in
+            # case the server is already gone
+            self.__main_req.close(linger=int(timeout * 1000))
         if not self.__ctx.closed:
-            self.__ctx.destroy()
-        if self.__server and self.__server.poll() is not None:
-            time.sleep(0.01)
-            self.__server.terminate()
+            self.__ctx.destroy(linger=int(timeout * 1000))
+        if self.__server:
+            _stop_server(self.__server, timeout)
+        self.__shutdown_latency = time.time() - start
 
-    def load_module(self, filepath):
+    def load_module(self, filepath, eager=False, values=None):
         """Load a Cryptol module.
 
         Returns a Python object with attributes corresponding to
         constants and methods corresponding to functions defined in
         the Cryptol module.
 
+        Loading the same version of a module again while an earlier
+        copy is still open is cheap on servers that clone workers:
+        the new worker starts with the module already parsed and
+        typechecked.
+
         :param str filepath: The filepath of the Cryptol module to load
 
+        :param bool eager: Whether to evaluate every top-level
+            declaration while loading, rather than the first time
+            each one is accessed
+
+        :param str values: The representation of words returned by
+            the module, ``'bitvector'``, ``'int'``, ``'numpy'`` or
+            ``'bytes'`` (see :class:`.Cryptol`); defaults to that of
+            the session
+
         """
-        port, req = self.__new_client()
         # TODO: get the module name from the AST, don't just guess
         # from the filepath
-        mod_name = os.path.splitext(
-            os.path.basename(filepath))[0].encode('ascii', 'replace')
+        mod_name = _native_str(os.path.splitext(
+            os.path.basename(filepath))[0], 'ascii', 'replace')
         cls = type('{} <Cryptol>'.format(mod_name), (_CryptolModule,), {})
-        mod = cls(port, req, self.__main_req, filepath)
-        self.__loaded_modules.append(weakref.ref(mod))
-        return mod
+        return self.__open(cls, filepath, eager, values)
+
+    def prelude(self, eager=False, values=None):
+        """Load the Cryptol prelude.
+
+        :param bool eager: Whether to evaluate every top-level
+            declaration while loading (see :meth:`.load_module`)
+
+        :param str values: The representation of words returned by
+            the module (see :meth:`.load_module`)
 
-    def prelude(self):
-        """Load the Cryptol prelude."""
-        port, req = self.__new_client()
+        """
         cls = type('Prelude <Cryptol>', (_CryptolModule,), {})
-        mod = cls(port, req, self.__main_req)
+        return self.__open(cls, None, eager, values)
+
+    def __open(self, cls, filepath, eager, values):
+        """Open a worker and load a module (or the prelude) in it.
+
+        Loading a module makes the server parse and typecheck it,
+        which is slow for large modules. So if a module of this
+        session already has the same version of the file loaded, the
+        server is asked to clone that module's worker instead, and
+        the declarations it found are reused rather than browsed
+        again. Servers that cannot clone workers start a fresh one,
+        in which the module is loaded as usual.
+
+        """
+        if values is None:
+            values = self.__values
+        _value_decoder(values)
+        key = _module_key(filepath)
+        source = None
+        if key is not None:
+            with self.__sources_lock:
+                source_ref = self.__sources.get(key)
+            if source_ref is not None:
+                source = source_ref()
+        clone = None if source is None else source._clone_info()
+        if clone is None:
+            port, req, codec, cloned = self.__new_client()
+            index = None
+        else:
+            port, req, codec, cloned = self.__new_client(clone[0])
+            index = clone[1]
+        mod = cls(port, req, self.__control, filepath, eager,
+                  self.__result_cache, values, codec,
+                  loaded=cloned, index=index)
         self.__loaded_modules.append(weakref.ref(mod))
+        if key is not None and clone is None:
+            with self.__sources_lock:
+                self.__sources[key] = weakref.ref(mod)
         return mod
 
-    def __new_client(self):
-        """Start up a new REPL session client."""
-        self.__main_req.send_json({'tag': 'connect'})
-        resp = self.__main_req.recv_json()
+    def __new_client(self, clone=None):
+        """Start up a new REPL session client.
+
+        Codecs other than JSON are offered to the server along with
+        the ``connect`` request; servers that do not know about codecs
+        ignore the offer and reply without naming one, meaning JSON.
+        Likewise, servers that do not know about cloning ignore a
+        request to clone the worker on port ``clone``.
+
+        :return: The port of the new worker, a request socket
+            connected to it, its codec, and whether it was cloned
+
+        """
+        msg = {'tag': 'connect'}
+        if self.__codecs is not None:
+            msg['codecs'] = self.__codecs
+        if clone is not None:
+            msg['clone'] = clone
+        resp = self.__control.request(msg)
         worker_port = resp['port']
+        codec = self.__worker_codec(resp.get('codec', 'json'))
         req = self.__ctx.socket(zmq.REQ)
         req.connect(self.__addr + ':' + str(worker_port))
-        return (worker_port, req)
+        return (worker_port, req, codec,
+                clone is not None and resp.get('cloned') is True)
+
+    def __worker_codec(self, name):
+        """The codec for a worker whose server chose codec ``name``.
+
+        :raises CryptolServerError: if the server does not support the
+            codec this session requires
+
+        """
+        if self.__codec is None:
+            if name not in self.__codecs:
+                raise PycryptolInternalError(
+                    u'Cryptol server chose a codec that was not '
+                    'offered: {}'.format(name))
+            return get_codec(name)
+        if name != self.__codec.name:
+            raise CryptolServerError(
+                u'Cryptol server does not support the {} '
+                'codec'.format(self.__codec.name))
+        return self.__codec
+
+class _ControlChannel(object):
+    """The control socket of a Cryptol server.
+
+    The control socket is shared by the session and every module
+    loaded in it, and modules used from different threads may need it
+    at the same time (for example to interrupt a computation), so each
+    request/response exchange holds a lock.
+
+    :param Socket req: The request socket connected to the server's
+        control port
+
+    """
+    def __init__(self, req):
+        self.__req = req
+        self.__lock = threading.Lock()
+
+    def request(self, msg):
+        """Send a control message and return the server's response."""
+        with self.__lock:
+            self.__req.send_json(msg)
+            return self.__req.recv_json()
+
+_RESULT_OPTIONS = frozenset(['base', 'ascii', 'infLength', 'mono-binds',
+                             'tc-solver', 'iteSolver'])
+"""The options that may affect the result of any cached query"""
+
+_DEFAULT_CHUNK_SIZE = 1024
+"""The number of inputs sent per request by :meth:`.apply_many`"""
 
 class _CryptolModule(object):
     """Abstract class for Cryptol modules.
@@ -323,92 +555,175 @@ class _CryptolModule(object):
 
     :param Socket req: The request socket for this module context
 
+    :param _ControlChannel control: The control channel of the server
+        running this module context
+
     :param str filepath: The filepath of the Cryptol module to load, or
         ``None`` for loading only the prelude
 
+    :param bool eager: Whether to evaluate every top-level declaration
+        up front, rather than the first time each one is accessed
+
+    :param ResultCache result_cache: A cache of results for
+        :meth:`.prove`, :meth:`.sat` and exhaustive :meth:`.check`, or
+        ``None`` to always ask the server
+
+    :param str values: The representation of words in results,
+        ``'bitvector'``, ``'int'``, ``'numpy'`` or ``'bytes'``
+
+    :param codec: The codec agreed on with the server for ``req``;
+        defaults to a :class:`.JSONCodec`
+
+    :param bool loaded: Whether the worker already has the module
+        loaded, having been cloned from another worker
+
+    :param dict index: The top-level declarations of the module, if
+        already known from another worker with the same module loaded
+
     """
     __identifier = re.compile(r"^[a-zA-Z_]\w*\Z")
 
-    def __init__(self, port, req, control_req, filepath=None):
+    def __init__(self, port, req, control, filepath=None, eager=False,
+                 result_cache=None, values='bitvector', codec=None,
+                 loaded=False, index=None):
+        self.__filepath = filepath
+        if codec is None:
+            codec = JSONCodec()
+        self.__codec = codec
+        self.__result_cache = result_cache
+        self.__values = values
+        self.__decode = _value_decoder(values)
+        self.__memo = None
         self.__decls = {}
+        self.__decl_index = {}
+        self.__options = {}
+        self.__option_hits = 0
+        self.__option_misses = 0
         self.__ascii = False
         self.__base = 16
         self.__mono_binds = True
         self.__prover = Provers.CVC4
+        self.__deadline = None
+        self.__bindings = weakref.WeakValueDictionary()
+        self.__binding_names = itertools.count()
         self.__port = port
         self.__req = req
-        self.__control_req = control_req
-        if filepath is None:
-            self.__load_prelude()
+        self.__control = control
+        self.__digest = None
+        if result_cache is not None and filepath is not None:
+            # the version of the module the server is about to load,
+            # whatever happens to the file later
+            try:
+                self.__digest = module_digest(filepath)
+            except (IOError, OSError):
+                pass
+        if not loaded:
+            if filepath is None:
+                self.__load_prelude()
+            else:
+                self.__load_module(filepath)
+        if index is not None:
+            self.__decl_index = dict(index)
         else:
-            self.__load_module(filepath)
-        self.__req.send_json({'tag': 'browse'})
-        browse_resp = self.__try_recv_json()
+            self.__index_decls()
+
+        if eager:
+            for name in self.__decl_index:
+                self.__lookup_decl(name)
+
+    def __index_decls(self):
+        """Browse the top-level declarations of the loaded module."""
+        self.__send({'tag': 'browse'})
+        browse_resp = self.__try_recv()
         tl_decls = browse_resp['decls']['ifDecls']
         for name in tl_decls:
             decl = tl_decls[name]
 
             # TODO: properly handle polymorphic declarations
             tvars = decl['ifDeclSig']['sVars']
-            if len(tvars) is not 0:
+            if len(tvars) != 0:
                 # TODO: warn
                 continue
 
-            # Run the evaluation
-            val_resp = self.__tag_expr('evalExpr', u'({})'.format(name), ())
-            if val_resp['tag'] == 'value':
-                val = self.__from_value(val_resp['value'])
-                sval = val
-            elif val_resp['tag'] == 'funValue':
-                val = self.__from_funvalue(val_resp['handle'], static=False)
-                sval = self.__from_funvalue(val_resp['handle'], static=True)
-            elif val_resp['tag'] == 'interactiveError':
-                raise CryptolError(val_resp['pp'])
-            else:
-                raise PycryptolInternalError(
-                    u'Cryptol evaluation returned a non-value '
-                    'message: {}'.format(val_resp))
+            # only record the declaration here; it is evaluated the
+            # first time it is looked up
+            self.__decl_index[name] = decl
 
-            # set the name, if possible
-            try:
-                val.__name__ = name.encode('utf-8')
-                sval.__name__ = name.encode('utf-8')
-            except AttributeError:
-                pass
+    def _clone_info(self):
+        """What a new worker needs to start from this module's state.
 
-            # set the docstring if available and settable
-            if 'ifDeclDoc' in decl:
-                try:
-                    val.__doc__ = decl['ifDeclDoc'].encode('utf-8')
-                    sval.__doc__ = decl['ifDeclDoc'].encode('utf-8')
-                except AttributeError:
-                    pass
-
-            # at this point the decl is ready to at least be added to
-            # the decls dictionary, if not as a member to the class,
-            # but interpret it statically
-            self.__decls[name] = sval
-
-            # Since new infix operators can't be defined in Python, we
-            # can't add them to the returned object, only to the decls
-            # dictionary.
-            is_infix = decl['ifDeclInfix']
-            if is_infix:
-                # TODO: warn
-                continue
+        :return: The port of this module's worker and its index of
+            declarations, or ``None`` once the module has exited
 
-            # filter out invalid identifiers
-            if re.match(_CryptolModule.__identifier, name) is None:
-                continue
+        """
+        if self.__req.closed:
+            return None
+        return (self.__port, self.__decl_index)
+
+    def __getattr__(self, name):
+        # Only called when normal attribute lookup fails, so methods
+        # and other existing attributes always take precedence over
+        # Cryptol declarations with the same name.
+        index = self.__dict__.get('_CryptolModule__decl_index', {})
+        decl = index.get(name)
+        if decl is None:
+            raise AttributeError(name)
+
+        # Since new infix operators can't be defined in Python, we
+        # can't expose them as attributes, only through decl().
+        is_infix = decl['ifDeclInfix']
+        if is_infix:
+            raise AttributeError(name)
+
+        # filter out invalid identifiers
+        if re.match(_CryptolModule.__identifier, name) is None:
+            raise AttributeError(name)
+
+        return self.__lookup_decl(name)
+
+    def __dir__(self):
+        names = set(dir(self.__class__)) | set(self.__dict__)
+        for name, decl in self.__decl_index.items():
+            if (not decl['ifDeclInfix'] and
+                    re.match(_CryptolModule.__identifier, name) is not None):
+                names.add(name)
+        return sorted(names)
+
+    def __lookup_decl(self, name):
+        """Evaluate a top-level declaration, memoizing the result.
 
-            # make sure the name doesn't already exist in the current
-            # object to prevent overwriting things like __class__
-            if hasattr(self, name):
-                # TODO: warn for collisions
-                continue
+        :param str name: The name of the declaration
+
+        :raises CryptolError: if the declaration is not in scope
+
+        """
+        try:
+            return self.__decls[name]
+        except KeyError:
+            pass
+        try:
+            decl = self.__decl_index[name]
+        except KeyError:
+            raise CryptolError(u'Value not in scope: {}'.format(name))
+
+        # Run the evaluation
+        val = self.__eval_expr(u'({})'.format(name))
+
+        # set the name, if possible
+        try:
+            val.__name__ = _native_str(name)
+        except AttributeError:
+            pass
+
+        # set the docstring if available and settable
+        if 'ifDeclDoc' in decl:
+            try:
+                val.__doc__ = _native_str(decl['ifDeclDoc'])
+            except AttributeError:
+                pass
 
-            # add it to the object under construction
-            setattr(self.__class__, name, val)
+        self.__decls[name] = val
+        return val
 
     def __load_prelude(self):
         """Load the Prelude, leaving it up to the server to find it
@@ -416,8 +731,8 @@ class _CryptolModule(object):
         :raises CryptolError: if the prelude does not load successfully
 
         """
-        self.__req.send_json({'tag': 'loadPrelude'})
-        load_resp = self.__try_recv_json()
+        self.__send({'tag': 'loadPrelude'})
+        load_resp = self.__try_recv()
         if load_resp['tag'] != 'ok':
             raise CryptolError(load_resp)
 
@@ -429,8 +744,8 @@ class _CryptolModule(object):
         :raises CryptolError: if the module does not load successfully
 
         """
-        self.__req.send_json({'tag': 'loadModule', 'filePath': filepath})
-        load_resp = self.__try_recv_json()
+        self.__send({'tag': 'loadModule', 'filePath': filepath})
+        load_resp = self.__try_recv()
         if load_resp['tag'] != 'ok':
             raise CryptolError(load_resp)
 
@@ -456,121 +771,484 @@ class _CryptolModule(object):
         :raises TypeError: if the given expression is not a string
 
         """
-        if not isinstance(expr, basestring):
+        return self.__send_expr(tag, self.__expand(expr, fmtargs))
+
+    @staticmethod
+    def __expand(expr, fmtargs):
+        """Fill in the holes of an expression template.
+
+        :raises TypeError: if the given expression is not a string
+
+        """
+        if not isinstance(expr, _string_types):
             raise TypeError(
                 u'Expected Cryptol expression as string, '
                 'got unsupported type {!r}'.format(type(expr).__name__)
                 )
-        expr = _CryptolModule.template(expr, fmtargs)
-        self.__req.send_json({'tag': tag, 'expr': expr})
-        resp = self.__try_recv_json()
+        return _CryptolModule.template(expr, fmtargs)
+
+    @staticmethod
+    def __split_template(expr, fmtargs):
+        """Split an expression template at its holes.
+
+        :return: The parts of the template and the tuple of arguments
+
+        :raises TypeError: if the given expression is not a string, or
+            the number of arguments does not match the number of holes
+
+        """
+        if not isinstance(expr, _string_types):
+            raise TypeError(
+                u'Expected Cryptol expression as string, '
+                'got unsupported type {!r}'.format(type(expr).__name__)
+                )
+        parts = expr.split('?')
+        if not isinstance(fmtargs, tuple):
+            fmtargs = (fmtargs,)
+        _check_holes(parts, fmtargs)
+        return parts, fmtargs
+
+    def __send_expr(self, tag, expr):
+        """Send a command with an already-expanded expression."""
+        self.__send({'tag': tag, 'expr': expr})
+        resp = self.__try_recv()
         return resp
 
-    def __from_value(self, val):
-        """Convert a JSON-formatted Cryptol value to a Python value."""
-        # VBit
-        if 'bit' in val:
-            return val['bit']
-        # VRecord
-        if 'record' in val:
-            rec = {}
-            for field in val['record']:
-                fname = field[0]['Name']
-                fval = self.__from_value(field[1])
-                rec[fname] = fval
-            return rec
-        # VTuple
-        if 'tuple' in val:
-            tup = ()
-            for tval in val['tuple']:
-                tup = tup + (self.__from_value(tval),)
-            return tup
-        # VSeq
-        if 'sequence' in val and val['sequence']['isWord']:
-            return BitVector(bitlist=[self.__from_value(elt)
-                                      for elt in val['sequence']['elements']])
-        if 'sequence' in val and not val['sequence']['isWord']:
-            return [self.__from_value(elt)
-                    for elt in val['sequence']['elements']]
-        # VWord
-        if 'word' in val:
-            bv = val['word']['bitvector']
-            intval = int(bv['value'])
-            width = int(bv['width'])
-            if width == 0:
-                return None
-            else:
-                return BitVector(intVal=intval % (2**width), size=width)
-        # VFun TODO: this only arises when functions are nested within
-        # other structures. Make the server handle this case with a
-        # funvalue message
-        if 'function' in val:
+    def __eval_expr(self, expr):
+        """Evaluate an already-expanded expression.
+
+        Function values returned by the server remember ``expr`` so
+        that they can later be applied in bulk (see
+        :meth:`.__from_funvalue`).
+
+        """
+        val = self.__memoized(('evalExpr', expr),
+                              lambda: self.__send_expr('evalExpr', expr))
+        if val['tag'] == 'value':
+            return self.__decode(val['value'])
+        elif val['tag'] == 'funValue':
+            return self.__from_funvalue(val['handle'], expr)
+        elif val['tag'] == 'interactiveError':
+            raise CryptolError(val['pp'])
+        else:
+            raise PycryptolInternalError(
+                u'Cryptol evaluation returned a non-value '
+                'message: {}'.format(val))
+
+    def __eval_elements(self, expr):
+        """Evaluate an already-expanded expression denoting a sequence.
+
+        Each element is decoded on its own, just as the result of a
+        single call would be, so that in the ``'numpy'`` and
+        ``'bytes'`` value modes a batch of results is not turned into
+        one array or byte string.
+
+        :return: The list of decoded elements
+
+        """
+        val = self.__memoized(('evalExpr', expr),
+                              lambda: self.__send_expr('evalExpr', expr))
+        if val['tag'] == 'value':
+            value = val['value']
+            if 'word' in value:
+                # a sequence of bits, sent as a word
+                bv = value['word']['bitvector']
+                width = int(bv['width'])
+                bits = bv_int(bv['value'])
+                return [bool((bits >> (width - 1 - i)) & 1)
+                        for i in range(width)]
+            return [self.__decode(elt)
+                    for elt in value['sequence']['elements']]
+        elif val['tag'] == 'interactiveError':
+            raise CryptolError(val['pp'])
+        else:
+            raise PycryptolInternalError(
+                u'Cryptol evaluation returned a non-sequence '
+                'message: {}'.format(val))
+
+    def __memoized(self, key, request):
+        """Send a request, unless its response has been memoized.
+
+        Only responses carrying values are memoized; errors are always
+        reported by the server again.
+
+        :param key: The memoization key of the request
+
+        :param request: A function sending the request and returning
+            the response
+
+        """
+        if self.__memo is None:
+            return request()
+        resp = self.__memo.get(key)
+        if resp is None:
+            resp = request()
+            if resp['tag'] in ('value', 'funValue'):
+                self.__memo.put(key, resp)
+        return resp
+
+    def enable_memo(self, capacity=1024, max_bytes=None):
+        """Memoize evaluation and function call results in this module.
+
+        Cryptol expressions are pure, so once enabled, evaluating the
+        same expression with :meth:`.eval` or calling a function with
+        the same argument reuses the earlier result instead of asking
+        the server again. The least recently used results are dropped
+        once the memo holds ``capacity`` results or, if given,
+        ``max_bytes`` bytes of results, as encoded by the codec of
+        the module.
+
+        :param int capacity: The maximum number of memoized results
+
+        :param int max_bytes: The maximum total size of the memoized
+            results, or ``None`` for no bound
+
+        """
+        codec = self.__codec
+        self.__memo = LRUCache(capacity, max_bytes,
+                               lambda resp: len(codec.encode(resp)))
+
+    def disable_memo(self):
+        """Stop memoizing results and forget the memoized ones."""
+        self.__memo = None
+
+    def memo_stats(self):
+        """Report the hit rate of the memo, if enabled.
+
+        :return: A dictionary of statistics (see
+            :meth:`.LRUCache.stats`), or ``None`` if memoization is
+            not enabled
+
+        """
+        if self.__memo is None:
             return None
-        raise PycryptolInternalError(
-            u'Could not convert message to value: {}'.format(val))
+        return self.__memo.stats()
+
+    def __map_expr(self, expr, inputs, chunk_size):
+        """Apply the function denoted by ``expr`` to each of ``inputs``.
 
-    def __from_funvalue(self, handle, static=True):
+        Inputs are sent in chunks of ``chunk_size`` as a single list
+        comprehension per chunk, so a chunk costs one round trip
+        rather than one per input.
+
+        """
+        if chunk_size is None:
+            chunk_size = _DEFAULT_CHUNK_SIZE
+        if chunk_size < 1:
+            raise ValueError('chunk_size must be positive')
+        prefix = u'[({}) pycryptol_arg | pycryptol_arg <- '.format(expr)
+        if numpy is not None and isinstance(inputs, numpy.ndarray):
+            # send each chunk as a single array literal
+            for start in range(0, len(inputs), chunk_size):
+                for result in self.__eval_elements(
+                        prefix + _CryptolModule.to_expr(
+                            inputs[start:start + chunk_size]) + u']'):
+                    yield result
+            return
+        chunk = []
+        for arg in inputs:
+            chunk.append(arg)
+            if len(chunk) == chunk_size:
+                for result in self.__eval_elements(
+                        prefix + _CryptolModule.to_expr(chunk) + u']'):
+                    yield result
+                chunk = []
+        if chunk:
+            for result in self.__eval_elements(
+                    prefix + _CryptolModule.to_expr(chunk) + u']'):
+                yield result
+
+    def __from_funvalue(self, handle, expr=None):
         """Convert a JSON-formatted Cryptol closure to a Python function.
 
-        This is separated out from :meth:`.__from_value` since the
+        This is separated out from :func:`._from_value` since the
         Cryptol server tags closure messages differently from regular
         values.
 
-        :param bool static: Whether to return a static function, or a
-        method on the current module
+        The returned function can be called with several arguments
+        at once, as in ``fn(a, b, c)`` or ``fn.apply(a, b, c)``,
+        which is equivalent to ``fn(a)(b)(c)``. It also has a ``map``
+        attribute that applies it to an iterable of arguments (see
+        :meth:`.apply_many`). Calls accept ``timeout`` and
+        ``deadline`` keyword arguments, as :meth:`.eval` does.
+
+        :param str expr: A Cryptol expression that evaluates to this
+            closure, if one is known; this allows multiple arguments
+            to be applied with a single request, and ``map`` to send
+            its inputs in bulk instead of one ``applyFun`` at a time
+
         """
-        def clos(self, arg):
+        def clos(*args, **kwargs):
             """Closure for callable Cryptol function"""
-            self.__req.send_json({'tag': 'applyFun',
-                                  'handle': handle,
-                                  'arg': self.__to_value(arg)})
-            val = self.__try_recv_json()
+            timeout = kwargs.pop('timeout', None)
+            deadline = kwargs.pop('deadline', None)
+            if kwargs:
+                raise TypeError(
+                    u'Unexpected keyword arguments: {}'.format(
+                        ', '.join(sorted(kwargs))))
+            return self.__bounded(timeout, deadline,
+                                  lambda: apply_all(args))
+        def apply_all(args):
+            """Apply the closure to one or more arguments"""
+            if len(args) == 0:
+                raise TypeError(
+                    'Cryptol function expects at least one argument')
+            bound = [_holds_handle(arg) for arg in args]
+            if isinstance(args[0], ValueHandle) and (
+                    expr is None or not any(bound[1:])):
+                result = apply_bound(args[0])
+                if len(args) == 1:
+                    return result
+                return result(*args[1:])
+            if expr is not None and any(bound):
+                parts = ([u'({}) ('.format(expr)] +
+                         [u') ('] * (len(args) - 1) + [u')'])
+                return self.__eval_bound(parts, args)
+            if len(args) == 1:
+                return apply_one(args[0])
+            full_expr = self.__apply_expr(expr, args)
+            if full_expr is not None:
+                # one request for the whole application, leaving no
+                # intermediate function handles behind on the server
+                return self.__eval_expr(full_expr)
+            result = apply_one(args[0])
+            for arg in args[1:]:
+                result = result(arg)
+            return result
+        def apply_one(arg):
+            """Apply the closure to a single argument with ``applyFun``"""
+            msg = {'tag': 'applyFun', 'handle': handle, 'arg': _to_value(arg)}
+            def request():
+                """Send the application to the server"""
+                self.__send(msg)
+                return self.__try_recv()
+            if self.__memo is None:
+                val = request()
+            else:
+                val = self.__memoized(
+                    ('applyFun', handle,
+                     json.dumps(msg['arg'], sort_keys=True)),
+                    request)
             if val['tag'] == 'value':
-                return self.__from_value(val['value'])
+                return self.__decode(val['value'])
             elif val['tag'] == 'funValue':
-                return self.__from_funvalue(val['handle'], static)
+                return self.__from_funvalue(val['handle'],
+                                            self.__apply_expr(expr, (arg,)))
             else:
                 raise PycryptolInternalError(
                     u'No value returned from applying Cryptol function; '
                     'instead got {!s}'.format(val))
-        def static_clos(arg):
-            """Closure for callable Cryptol function"""
-            return clos(self, arg)
+        def apply_bound(bound):
+            """Apply the closure to a bound value, once per closure"""
+            self.__check_bound(bound)
+            result = bound._partial(handle)
+            if result is None:
+                result = apply_one(bound)
+                if callable(result):
+                    # the server keeps the partial application
+                    bound._keep_partial(handle, result)
+            return result
+        def map_clos(inputs, chunk_size=None):
+            """Apply this function to each of ``inputs``, in order"""
+            if expr is None:
+                return (apply_one(arg) for arg in inputs)
+            return self.__map_expr(expr, inputs, chunk_size)
         setattr(clos, '__name__', '<cryptol_closure>')
-        setattr(static_clos, '__name__', '<cryptol_closure>')
-        if static:
-            return static_clos
-        else:
-            return clos
+        setattr(clos, 'apply', clos)
+        setattr(clos, 'map', map_clos)
+        setattr(clos, '_apply_one', apply_one)
+        return clos
 
-    def __to_value(self, pyval):
-        """Convert a Python value to a JSON-formatted Cryptol value."""
-        # VBit
-        if isinstance(pyval, bool):
-            return {'bit': pyval}
-        # VRecord
-        elif isinstance(pyval, dict):
-            return {'record': [[{'Name': k}, self.__to_value(v)]
-                               for k, v in pyval.items()]}
-        # VTuple
-        elif isinstance(pyval, tuple):
-            return {'tuple': [self.__to_value(v) for v in pyval]}
-        # VSeq
-        elif isinstance(pyval, list):
-            # TODO: assert homogeneous, set isWord
-            return {'sequence':
-                    {'isWord': False,
-                     'elements': [self.__to_value(v) for v in pyval]}}
-        # VWord
-        elif isinstance(pyval, BitVector):
-            return {'word':
-                    {'bitvector':
-                     {'width': pyval.length(), 'value': int(pyval)}}}
-        else:
-            # TODO: convert strings to ASCII?
+    @staticmethod
+    def __apply_expr(expr, args):
+        """The expression applying ``expr`` to ``args``, if expressible.
+
+        Bound values are never sent as text, so applications to them
+        are not expressible.
+
+        """
+        if expr is None or any(isinstance(arg, ValueHandle)
+                               for arg in args):
+            return None
+        try:
+            return u'({}) {}'.format(expr, u' '.join(
+                [u'({})'.format(_CryptolModule.to_expr(arg)) for arg in args]))
+        except TypeError:
+            return None
+
+    def prepare(self, template):
+        """Prepare a template for evaluation with many arguments.
+
+        The template is turned once into a Cryptol function of its
+        holes, which the server parses and typechecks once; each call
+        then applies that function to its arguments, sent as a single
+        tuple of values, rather than filling in and sending the text
+        of the whole expression again.
+
+        >>> encrypt = aes.prepare('aesEncrypt (?, ?)')
+        >>> cts = [encrypt(pt, key) for pt in pts]
+
+        A template whose function does not typecheck, such as one
+        whose holes could take values of several types, is filled in
+        as text on every call instead, as by :meth:`.eval`.
+
+        :param str template: The template, with a ``?`` for each
+            argument (see :meth:`.template`)
+
+        :return: A :class:`.PreparedExpr`, called with the arguments
+            and, optionally, ``timeout`` and ``deadline`` keywords (see
+            :meth:`.eval`)
+
+        :raises TypeError: if the template is not a string
+
+        """
+        if not isinstance(template, _string_types):
+            raise TypeError(
+                u'Expected Cryptol expression as string, '
+                'got unsupported type {!r}'.format(type(template).__name__)
+                )
+        parts = template.split('?')
+        names = [u'pycryptol_hole_{}'.format(i)
+                 for i in range(len(parts) - 1)]
+        fun = None
+        if names:
+            lambda_expr = u'\\({}) -> {}'.format(
+                u', '.join(names), _fill_holes(parts, names))
+            try:
+                fun = self.__eval_expr(lambda_expr)
+            except CryptolError:
+                # left to be filled in as text, and to report any
+                # error when called
+                pass
+        return PreparedExpr(template, parts, fun, self.eval)
+
+    def bind(self, name, value):
+        """Bind a value for use in many later requests.
+
+        The value is converted for the server once, and sent to it
+        once per expression it is used in, rather than every time.
+        When a handle is the leading argument of a call of a Cryptol
+        function, the server applies the function to the value the
+        first time and keeps the partial application, which every
+        later call of that function with the handle reuses. Other
+        calls, and templates evaluated with :meth:`.eval`, that hold
+        handles, even inside tuples, lists or records, are turned into
+        a Cryptol function of the bound values, returning a function
+        of the other arguments; the server applies it to the bound
+        values once and keeps the result, so later calls only send the
+        other arguments. The queries of :meth:`.check`, :meth:`.prove`
+        and :meth:`.sat` are sent as text, with the handle standing
+        for the text of the value, converted once.
+
+        >>> key = aes.bind('key', key_bytes)
+        >>> cts = [aes.aesEncrypt((pt, key)) for pt in pts]
+
+        Binding a name again releases the handle bound to it. A handle
+        is also released by :meth:`.ValueHandle.release`, or once
+        nothing refers to it any more. The server has no request to
+        drop function handles, so its partial applications last until
+        the worker exits.
+
+        :param str name: The name of the binding, or ``None`` for a
+            fresh name
+
+        :param value: The value to bind
+
+        :return: A :class:`.ValueHandle` for the value
+
+        """
+        if name is None:
+            name = u'pycryptol_bound_{}'.format(next(self.__binding_names))
+        old = self.__bindings.get(name)
+        if old is not None:
+            old.release()
+        bound = ValueHandle(name, value)
+        self.__bindings[name] = bound
+        return bound
+
+    def __check_bound(self, bound):
+        """Raise ValueError unless a handle is bound in this module"""
+        if self.__bindings.get(bound.name()) is not bound:
             raise ValueError(
-                u'Unable to convert Python value into '
-                'Cryptol value {!s}'.format(pyval))
+                u'{} is not bound in this module'.format(bound.name()))
+        if bound.released():
+            raise ValueError(u'{} has been released'.format(bound.name()))
+
+    def __eval_bound(self, parts, args):
+        """Evaluate a template whose arguments hold bound values.
+
+        The template is turned into a Cryptol function of the bound
+        values, returning a function of the other arguments, as by
+        :meth:`.prepare`. The server applies it to the bound values
+        once and keeps the result on the first handle, so evaluating
+        the template again with the same handles sends only the other
+        arguments, as a tuple of values. Integer literals are filled
+        in as text. A template whose function does not typecheck is
+        filled in as text instead, as by :meth:`.eval`.
+
+        :param parts: The template, split at its holes
+
+        :param tuple args: The arguments of the template
+
+        """
+        handles = []
+        holes = []
+        def abstract(arg):
+            """The text of an argument, its values made parameters"""
+            if isinstance(arg, ValueHandle):
+                self.__check_bound(arg)
+                for index, bound in enumerate(handles):
+                    if bound is arg:
+                        break
+                else:
+                    index = len(handles)
+                    handles.append(arg)
+                return u'pycryptol_handle_{}'.format(index)
+            if not _holds_handle(arg):
+                if (isinstance(arg, (int, _long)) and
+                        not isinstance(arg, bool)):
+                    return _CryptolModule.to_expr(arg)
+                holes.append(arg)
+                return u'pycryptol_hole_{}'.format(len(holes) - 1)
+            if isinstance(arg, tuple):
+                return u'({})'.format(u', '.join([abstract(v) for v in arg]))
+            elif isinstance(arg, list):
+                return u'[{}]'.format(u', '.join([abstract(v) for v in arg]))
+            return u'{{{}}}'.format(u', '.join(
+                [u'{} = {}'.format(k, abstract(v)) for k, v in arg.items()]))
+        body = _fill_holes(parts, [abstract(arg) for arg in args])
+        names = [u'pycryptol_hole_{}'.format(i) for i in range(len(holes))]
+        if not holes:
+            # a parameter that is ignored, so that the server keeps a
+            # function rather than a value
+            names = [u'pycryptol_unit : Bit']
+            holes = [False]
+        lambda_expr = u'\\({}) -> \\({}) -> {}'.format(
+            u', '.join([u'pycryptol_handle_{}'.format(i)
+                        for i in range(len(handles))]),
+            u', '.join(names), body)
+        key = ('template', lambda_expr,
+               tuple(bound._serial() for bound in handles[1:]))
+        fun = handles[0]._partial(key)
+        if fun is None:
+            try:
+                fun = self.__eval_expr(lambda_expr)
+            except CryptolError:
+                # filled in as text from now on, reporting any error
+                fun = False
+            if fun is not False:
+                fun = fun._apply_one(handles[0] if len(handles) == 1
+                                     else tuple(handles))
+            handles[0]._keep_partial(key, fun)
+        if fun is False:
+            return self.__eval_expr(_fill_holes(
+                parts, [_CryptolModule.to_expr(arg) for arg in args]))
+        return fun(holes[0] if len(holes) == 1 else tuple(holes))
+
+    def bindings(self):
+        """The names of the values bound in this module and not released"""
+        return sorted(name for name, bound in list(self.__bindings.items())
+                      if not bound.released())
 
     def decl(self, name):
         """Return a top-level Cryptol declaration in the current module
@@ -581,6 +1259,10 @@ class _CryptolModule(object):
         this method to access other declarations without reevaluating
         them.
 
+        Declarations are evaluated the first time they are accessed,
+        either through this method or as an attribute, and the result
+        is reused afterwards.
+
         :param str name: The name of the declaration
 
         :return: A Python value representing the named declaration
@@ -588,12 +1270,9 @@ class _CryptolModule(object):
         :raises CryptolError: if the declaration is not in scope
 
         """
-        try:
-            return self.__decls[name]
-        except KeyError:
-            raise CryptolError(u'Value not in scope: {}'.format(name))
+        return self.__lookup_decl(name)
 
-    def eval(self, expr, fmtargs=()):
+    def eval(self, expr, fmtargs=(), timeout=None, deadline=None):
 
         """Evaluate a Cryptol expression in this module's context.
 
@@ -602,24 +1281,53 @@ class _CryptolModule(object):
         :param fmtargs: The values to substitute in for ``?`` in
             ``expr`` (see :meth:`.template`)
 
+        :param float timeout: The number of seconds to wait for the
+            result, or ``None`` to wait as long as it takes
+
+        :param float deadline: The time, as given by :func:`time.time`,
+            by which the result is needed, or ``None`` for no deadline
+
         :return: A Python value representing the result of evaluating
             ``expr``
 
+        :raises CryptolTimeout: if the result is not ready in time
+
         :raises CryptolError: if an error occurs during Cryptol
             parsing, typechecking, or evaluation
 
         """
-        val = self.__tag_expr('evalExpr', expr, fmtargs)
-        if val['tag'] == 'value':
-            return self.__from_value(val['value'])
-        elif val['tag'] == 'funValue':
-            return self.__from_funvalue(val['handle'])
-        elif val['tag'] == 'interactiveError':
-            raise CryptolError(val['pp'])
-        else:
-            raise PycryptolInternalError(
-                u'Cryptol evaluation returned a non-value '
-                'message: {}'.format(val))
+        if _holds_handle(fmtargs):
+            parts, args = self.__split_template(expr, fmtargs)
+            return self.__bounded(timeout, deadline,
+                                  lambda: self.__eval_bound(parts, args))
+        expr = self.__expand(expr, fmtargs)
+        return self.__bounded(timeout, deadline,
+                              lambda: self.__eval_expr(expr))
+
+    def apply_many(self, name, inputs, chunk_size=None):
+        """Apply a top-level Cryptol function to many inputs.
+
+        Rather than one round trip per input, the inputs are sent in
+        chunks, each evaluated by a single request, and the results
+        are yielded in the order of ``inputs``.
+
+        :param str name: The name of the function to apply
+
+        :param inputs: An iterable of arguments for the function, or a
+            NumPy array whose rows are the arguments
+
+        :param int chunk_size: The number of inputs to send per
+            request, bounding the size of each request and response;
+            defaults to 1024
+
+        :return: An iterator over the results, each decoded as the
+            result of a single call is, whatever the value mode
+
+        :raises CryptolError: if an error occurs during Cryptol
+            parsing, typechecking, or evaluation
+
+        """
+        return self.__map_expr(u'({})'.format(name), inputs, chunk_size)
 
     def typeof(self, expr, fmtargs=()):
         """Get the type of a Cryptol expression.
@@ -638,16 +1346,10 @@ class _CryptolModule(object):
         # TODO: design Python representation of Cryptol types for a
         # semantically-meaningful return value
         resp = self.__tag_expr('typeOf', expr, fmtargs)
-        if resp['tag'] == 'type':
-            return resp['pp']
-        elif resp['tag'] == 'interactiveError':
-            raise CryptolError(resp['pp'])
-        else:
-            raise PycryptolInternalError(
-                u'Cryptol typechecking returned a non-type '
-                'message: {}'.format(resp))
+        return _type_from_response(resp)
 
-    def check(self, expr, fmtargs=(), limit=100):
+    def check(self, expr, fmtargs=(), limit=100, timeout=None,
+              deadline=None):
         """Randomly test a Cryptol property.
 
         :param str expr: The property to test
@@ -658,10 +1360,18 @@ class _CryptolModule(object):
         :param int limit: The number of test cases to run, or ``None``
             to exhaustively check the property
 
+        :param float timeout: The number of seconds to wait for the
+            report (see :meth:`.eval`)
+
+        :param float deadline: The time by which the report is needed
+            (see :meth:`.eval`)
+
         :return: A :class:`.TestReport` for this property
 
         :raises ValueError: if ``expr`` is empty
 
+        :raises CryptolTimeout: if the report is not ready in time
+
         :raises CryptolError: if an error occurs during Cryptol
             parsing or typechecking; errors during test evaluation are
             reported in the :class:`.TestReport`.
@@ -669,48 +1379,23 @@ class _CryptolModule(object):
         """
         if expr == '':
             raise ValueError('Cannot check an empty expression')
-        # set keywords
+        expr = self.__expand(expr, fmtargs)
         if limit is not None:
-            self.setopt('tests', str(limit))
-            cmd = 'check'
-        else:
-            cmd = 'exhaust'
-        resp = self.__tag_expr(cmd, expr, fmtargs)
-        if resp['tag'] == 'interactiveError':
-            raise CryptolError(resp['pp'])
-        try:
-            obj = resp['testReport'][0]
-        except:
-            raise PycryptolInternalError(
-                u'Malformed check response: {}'.format(resp))
-        return self.__create_test_report(obj)
-
-    def __create_test_report(self, obj):
-        try:
-            result = obj['reportResult']
-            if 'Pass' in result:
-                passed = True
-                cex = None
-            else:
-                passed = False
-            if 'FailFalse' in result:
-                cex = tuple([self.__from_value(arg)
-                             for arg in result['FailFalse']])
-            if 'FailError' in result:
-                cex = tuple([self.__from_value(arg)
-                             for arg in result['args']])
-                errmsg = result['FailError']
-            else:
-                errmsg = None
-            tests_run = obj['reportTestsRun']
-            tests_possible = obj['reportTestsPossible']
-            prop = obj['reportProp']
-            return TestReport(
-                prop, passed, tests_run, tests_possible, errmsg, cex)
-        except KeyError:
-            raise PycryptolInternalError('Malformed check/exhaust response')
-
-    def prove(self, expr, fmtargs=(), prover=Provers.CVC4):
+            def query():
+                """Run the random tests on the server"""
+                # set keywords
+                self.setopt('tests', str(limit))
+                resp = self.__send_expr('check', expr)
+                return _test_report_from_response(resp, self.__decode)
+            return self.__bounded(timeout, deadline, query)
+        # exhaustive checks are deterministic, so they may be cached
+        return self.__cached_query('exhaust', expr, {}, lambda: (
+            self.__bounded(timeout, deadline, lambda: (
+                _test_report_from_response(
+                    self.__send_expr('exhaust', expr), self.__decode)))))
+
+    def prove(self, expr, fmtargs=(), prover=Provers.CVC4, timeout=None,
+              deadline=None):
         """Prove validity of a Cryptol property, or find a counterexample.
 
         :param str expr: The property to prove
@@ -718,40 +1403,43 @@ class _CryptolModule(object):
         :param fmtargs: The values to substitute in for ``?`` in
             ``expr`` (see :meth:`.template`)
 
+        :param Provers prover: The prover to use
+
+        :param float timeout: The number of seconds to wait for the
+            result (see :meth:`.eval`)
+
+        :param float deadline: The time by which the result is needed
+            (see :meth:`.eval`)
+
         :return: A :class:`.ProofResult` for this property
 
+        :raises CryptolTimeout: if the prover does not finish in time
+
         :raises ProverError: if an error occurs during prover invocation
 
         :raises CryptolError: if an error occurs during Cryptol
             parsing, typechecking, evaluation, or symbolic simulation
 
         """
-        # set keywords
-        self.setopt('prover', prover.value)
-
-        resp = self.__tag_expr('prove', expr, fmtargs)
-
-        if resp['tag'] == 'prove':
-            if resp['counterexample'] is not None:
-                args = tuple([self.__from_value(arg)
-                              for arg in resp['counterexample']])
-                return ProofResult(False, args)
-            else:
-                return ProofResult(True, None)
-        elif resp['tag'] == 'proverError':
-            raise ProverError(resp['message'])
-        elif resp['tag'] == 'interactiveError':
-            raise CryptolError(resp['pp'])
-        else:
-            raise PycryptolInternalError(
-                u'Cryptol prove command returned an invalid '
-                'message: {}'.format(resp))
+        expr = self.__expand(expr, fmtargs)
+        def query():
+            """Run the proof on the server"""
+            # set keywords
+            self.setopt('prover', prover.value)
+
+            resp = self.__send_expr('prove', expr)
+            return _proof_result_from_response(resp, self.__decode, prover)
+        return self.__cached_query(
+            'prove', expr, {'prover': prover.value},
+            lambda: self.__bounded(timeout, deadline, query))
 
     def sat(self,
             expr,
             fmtargs=(),
             sat_num=1,
-            prover=Provers.CVC4):
+            prover=Provers.CVC4,
+            timeout=None,
+            deadline=None):
         """Find satisfying assignments for a Cryptol property.
 
         :param str expr: The property to satisfy
@@ -764,50 +1452,165 @@ class _CryptolModule(object):
 
         :param Provers prover: The prover to use
 
+        :param float timeout: The number of seconds to wait for the
+            result (see :meth:`.eval`)
+
+        :param float deadline: The time by which the result is needed
+            (see :meth:`.eval`)
+
         :return: Either :class:`.SatResult` or :class:`.AllSatResult`,
             depending on ``sat_num``
 
+        :raises CryptolTimeout: if the prover does not finish in time
+
         :raises ProverError: if an error occurs during prover invocation
 
         :raises CryptolError: if an error occurs during Cryptol
             parsing, typechecking, evaluation, or symbolic simulation
 
         """
-        # set keywords
         if sat_num is None:
-            self.setopt('satNum', 'all')
+            sat_num_opt = 'all'
         else:
-            self.setopt('satNum', str(sat_num))
-        self.setopt('prover', prover.value)
-
-        resp = self.__tag_expr('sat', expr, fmtargs)
-
-        if resp['tag'] == 'sat':
-            argss = [tuple([self.__from_value(arg) for arg in assignment])
-                     for assignment in resp['assignments']]
-            # Return different result types based on ``sat_num``
-            if sat_num == 1:
-                if len(argss) == 0:
-                    return SatResult(False, None)
-                elif len(argss) == 1:
-                    return SatResult(True, argss[0])
-                else:
-                    raise PycryptolInternalError(
-                        'Multiple satisfying assignments with sat_num != 1')
+            sat_num_opt = str(sat_num)
+        expr = self.__expand(expr, fmtargs)
+        def query():
+            """Run the SAT query on the server"""
+            # set keywords
+            self.setopt('satNum', sat_num_opt)
+            self.setopt('prover', prover.value)
+
+            resp = self.__send_expr('sat', expr)
+            return _sat_result_from_response(resp, sat_num, self.__decode,
+                                             prover)
+        return self.__cached_query(
+            'sat', expr, {'satNum': sat_num_opt, 'prover': prover.value},
+            lambda: self.__bounded(timeout, deadline, query))
+
+    def iter_sat(self,
+                 expr,
+                 fmtargs=(),
+                 prover=Provers.CVC4,
+                 split_bits=8,
+                 chunks=False,
+                 progress=None,
+                 timeout=None):
+        """Generate every satisfying assignment of a Cryptol property.
+
+        Unlike ``sat(expr, sat_num=None)``, which returns every
+        assignment at once, this enumerates them range by range: if
+        the first argument of the property is a word, its values are
+        split into ``2 ** split_bits`` disjoint ranges by their most
+        significant bits, and the assignments in each range are found
+        by a separate query. Only the assignments of one range are
+        held at a time, and the first ones are available as soon as
+        their range is done. Properties whose first argument is not a
+        word are enumerated by a single query.
+
+        Stopping the iteration early skips the remaining ranges, and
+        interrupting it, or the ``timeout`` of a range expiring,
+        interrupts the worker.
+
+        >>> for (x,) in m.iter_sat('\\(x : [32]) -> x * x == 1'):
+        ...     print(x)
+
+        :param str expr: The property to satisfy
+
+        :param fmtargs: The values to substitute in for ``?`` in
+            ``expr`` (see :meth:`.template`)
+
+        :param Provers prover: The prover to use
+
+        :param int split_bits: The number of leading bits of the first
+            argument fixed by each query; it is reduced for narrower
+            arguments
+
+        :param bool chunks: Whether to yield the assignments of each
+            range as one list, rather than one at a time; ranges
+            without assignments yield nothing
+
+        :param progress: A function called after each range with the
+            number of ranges done, the number of ranges in all and the
+            number of assignments found so far
+
+        :param float timeout: The number of seconds each range may
+            take (see :meth:`.eval`)
+
+        :return: An iterator over the satisfying assignments, each a
+            tuple of arguments, or over lists of them
+
+        :raises CryptolTimeout: if a range takes longer than
+            ``timeout``
+
+        """
+        expr = self.__expand(expr, fmtargs)
+        width = _word_argument(_type_from_response(
+            self.__send_expr('typeOf', expr)))
+        bits = 0
+        if width is not None:
+            bits = max(0, min(split_bits, width - 1))
+        found = 0
+        for index in range(2 ** bits):
+            if bits == 0:
+                query = expr
             else:
-                if len(argss) == 0:
-                    return AllSatResult(False, None)
-                else:
-                    return AllSatResult(True, argss)
+                query = _shard_expr(expr, index, bits, width)
+            result = self.sat(query, sat_num=None, prover=prover,
+                              timeout=timeout)
+            assignments = []
+            if result.is_sat():
+                assignments = result.get_assignments()
+                if bits != 0:
+                    # prefix the rest of the first argument with the
+                    # bits of this range
+                    assignments = [
+                        (_shard_word(index, bits, args[0]),) + args[1:]
+                        for args in assignments]
+            found += len(assignments)
+            del result
+            if progress is not None:
+                progress(index + 1, 2 ** bits, found)
+            if chunks:
+                if assignments:
+                    yield assignments
+            else:
+                for args in assignments:
+                    yield args
 
-        elif resp['tag'] == 'proverError':
-            raise ProverError(resp['message'])
-        elif resp['tag'] == 'interactiveError':
-            raise CryptolError(resp['pp'])
-        else:
-            raise PycryptolInternalError(
-                u'Cryptol SAT checking returned an invalid '
-                'message: {}'.format(resp))
+    def __cached_query(self, command, expr, options, query):
+        """Answer a query from the result cache, or run and cache it.
+
+        :param str command: The server command answering the query
+
+        :param str expr: The expanded expression of the query
+
+        :param dict options: The options the query sets
+
+        :param query: A function running the query on the server
+
+        """
+        if self.__result_cache is None:
+            return query()
+        if self.__filepath is not None and self.__digest is None:
+            # the module file could not be read when it was loaded
+            return query()
+        # a few other options set in this module affect every result;
+        # the options of other commands, such as the prover of an
+        # earlier proof, do not
+        all_options = dict((key, val[0])
+                           for key, val in self.__options.items()
+                           if key in _RESULT_OPTIONS)
+        all_options.update(options)
+        if self.__values != 'bitvector':
+            # results hold words in a different representation
+            all_options['pycryptol.values'] = self.__values
+        key = self.__result_cache.key(
+            self.__filepath, command, expr, all_options, self.__digest)
+        result = self.__result_cache.get(key)
+        if result is None:
+            result = query()
+            self.__result_cache.put(key, result)
+        return result
 
     def setopt(self, option, value):
         """Set an option in the Cryptol session for this module.
@@ -821,45 +1624,134 @@ class _CryptolModule(object):
 
         :param str value: The value to assign to ``option``
 
+        The module remembers the value of each option it has set, and
+        setting an option to the value it already has does not contact
+        the server (see :meth:`.option_cache_stats`).
+
         """
         # TODO: add more examples, special-case these into methods
         # like _CryptolModule.set_base, etc
-        self.__req.send_json({'tag': 'setOpt', 'key': option, 'value': value})
-        return self.__try_recv_json()
+        cached = self.__options.get(option)
+        if cached is not None and cached[0] == value:
+            self.__option_hits += 1
+            return cached[1]
+        self.__option_misses += 1
+        # forget the old value first, in case this request is
+        # interrupted after the server has already applied it
+        self.__options.pop(option, None)
+        self.__send({'tag': 'setOpt', 'key': option, 'value': value})
+        resp = self.__try_recv()
+        if resp.get('tag') != 'interactiveError':
+            self.__options[option] = (value, resp)
+        return resp
+
+    def option_cache_stats(self):
+        """Report how many :meth:`.setopt` calls skipped the server.
+
+        :return dict: ``hits``, the number of calls that found the
+            option already set to the requested value, and ``misses``,
+            the number of calls that sent a request to the server
+
+        """
+        return {'hits': self.__option_hits, 'misses': self.__option_misses}
 
     def browse(self):
         """Browse the definitions in scope in this module."""
         # TODO: return these in a cleaner structure, perhaps combined
         # with the type information that typeof will return
-        self.__req.send_json({'tag': 'browse'})
-        return self.__try_recv_json()
+        self.__send({'tag': 'browse'})
+        return self.__try_recv()
 
-    def exit(self):
+    def exit(self, timeout=_SHUTDOWN_TIMEOUT):
         """End the Cryptol session for this module.
 
         .. note:: It is usually not necessary to call this method
             unless this instance might not be garbage-collected.
 
+        :param float timeout: The number of seconds to spend trying
+            to deliver the exit message to the worker
+
         """
         if not self.__req.closed:
             try:
-                self.__req.send_json({'tag': 'exit'}, flags=zmq.NOBLOCK)
-                self.__req.recv_json(flags=zmq.NOBLOCK)
+                self.__send({'tag': 'exit'}, flags=zmq.NOBLOCK)
+                self.__req.recv(flags=zmq.NOBLOCK)
             except zmq.error.Again:
                 pass
-            self.__req.close()
+            self.__req.close(linger=int(timeout * 1000))
+
+    def interrupt(self):
+        """Interrupt the request this module is waiting on.
+
+        This is meant to be called from another thread than the one
+        that made the request, which then fails with the error the
+        server reports for the interrupted computation. The module
+        remains usable.
+
+        """
+        if not self.__req.closed:
+            self.__control.request({'tag': 'interrupt', 'port': self.__port})
+
+    def __send(self, msg, flags=0):
+        """Encode a message with this module's codec and send it."""
+        self.__req.send(self.__codec.encode(msg), flags=flags)
 
-    def __try_recv_json(self):
+    def __try_recv(self):
         """Try to receive from the request socket, but guard for exceptions."""
         try:
-            return self.__req.recv_json()
+            if self.__deadline is not None:
+                self.__await_reply()
+            return self.__codec.decode(self.__req.recv())
+        except CryptolTimeout:
+            raise
         except:
-            self.__control_req.send_json({'tag': 'interrupt',
-                                          'port': self.__port})
-            self.__control_req.recv_json()
-            self.__req.recv_json()
+            self.__control.request({'tag': 'interrupt', 'port': self.__port})
+            self.__req.recv()
             raise
 
+    def __await_reply(self):
+        """Wait for a reply until the deadline, interrupting if it passes.
+
+        The reply to the interrupted request is received and dropped,
+        so that the worker can serve the next request. A worker that
+        does not answer the interrupt either is given up on, and the
+        module is closed.
+
+        :raises CryptolTimeout: if there is no reply by the deadline
+
+        """
+        remaining = max(self.__deadline - time.time(), 0)
+        if self.__req.poll(int(remaining * 1000)):
+            return
+        self.__control.request({'tag': 'interrupt', 'port': self.__port})
+        if not self.__req.poll(int(_INTERRUPT_GRACE * 1000)):
+            self.__req.close(linger=0)
+            raise CryptolTimeout(
+                u'Cryptol request timed out, and the worker did not answer '
+                'the interrupt within {:g} seconds; the module is no '
+                'longer usable'.format(_INTERRUPT_GRACE))
+        self.__req.recv()
+        raise CryptolTimeout(u'Cryptol request timed out')
+
+    def __bounded(self, timeout, deadline, request):
+        """Make a request, receiving every reply by the given deadline.
+
+        Deadlines nest: a request made on behalf of another one has
+        to finish by the earlier of their deadlines.
+
+        """
+        deadline = _deadline(timeout, deadline)
+        if deadline is None:
+            return request()
+        outer = self.__deadline
+        if outer is not None and outer < deadline:
+            deadline = outer
+        self.__deadline = deadline
+        try:
+            return request()
+        finally:
+            self.__deadline = outer
+
 
     @staticmethod
     def to_expr(pyval):
@@ -879,13 +1771,38 @@ class _CryptolModule(object):
         elif isinstance(pyval, tuple):
             elts = [_CryptolModule.to_expr(v) for v in pyval]
             return u'({})'.format(', '.join(elts))
-        # list of length n containing a -> [n]a
         elif isinstance(pyval, list):
+            # list of n booleans -> [n] binary literal
+            if _is_bit_list(pyval):
+                return u'0b' + u''.join([u'1' if v else u'0' for v in pyval])
+            # list of n words of width w -> [n][w]
+            width = _uniform_width(pyval)
+            if width is not None:
+                return u'([{}] : [{}][{}])'.format(
+                    u', '.join([u'{:d}'.format(int(v)) for v in pyval]),
+                    len(pyval), width)
+            # list of length n containing a -> [n]a
             elts = [_CryptolModule.to_expr(v) for v in pyval]
             return u'[{}]'.format(', '.join(elts))
+        # bytes of length n -> [n][8]
+        elif isinstance(pyval, _bytes_types):
+            if not pyval:
+                return u'([] : [0][8])'
+            return u'[{}]'.format(u', '.join(
+                [u'0x{:02x}'.format(b) for b in bytearray(pyval)]))
         # BitVector of length n -> [n]
         elif isinstance(pyval, BitVector):
             return u'{:d} : [{}]'.format(int(pyval), pyval.length())
+        # Word of width n -> [n]
+        elif isinstance(pyval, Word):
+            return u'{:d} : [{}]'.format(pyval.value, pyval.width)
+        # NumPy array of shape (m, n) -> [m][n][w]
+        elif numpy is not None and isinstance(pyval, (numpy.ndarray,
+                                                      numpy.generic)):
+            return _array_to_expr(pyval)
+        # bound value -> its expression, converted once
+        elif isinstance(pyval, ValueHandle):
+            return pyval._expr()
         else:
             # TODO: convert strings to ASCII?
             raise TypeError(
@@ -914,19 +1831,124 @@ class _CryptolModule(object):
             the number of holes in the template
 
         """
-        holes = string.count(template, '?')
+        parts = template.split('?')
         if not isinstance(args, tuple):
             args = (args,)
-        if len(args) < holes:
-            raise TypeError(
-                'not all arguments converted during Cryptol string templating')
-        if len(args) > holes:
+        _check_holes(parts, args)
+        return _fill_holes(parts, [_CryptolModule.to_expr(arg)
+                                   for arg in args])
+
+class PreparedExpr(object):
+    """A template prepared with :meth:`._CryptolModule.prepare`"""
+
+    def __init__(self, template, parts, fun, evaluate):
+        self.__template = template
+        self.__parts = parts
+        self.__fun = fun
+        self.__evaluate = evaluate
+
+    def __repr__(self):
+        return u'<PreparedExpr {!r}>'.format(self.__template)
+
+    def __call__(self, *args, **kwargs):
+        timeout = kwargs.pop('timeout', None)
+        deadline = kwargs.pop('deadline', None)
+        if kwargs:
             raise TypeError(
-                'not enough arguments for Cryptol template string')
-        result = template
-        for arg in args:
-            result = string.replace(result, '?', _CryptolModule.to_expr(arg), 1)
-        return result
+                u'Unexpected keyword arguments: {}'.format(
+                    ', '.join(sorted(kwargs))))
+        _check_holes(self.__parts, args)
+        if self.__fun is None:
+            return self.__evaluate(
+                _fill_holes(self.__parts, [_CryptolModule.to_expr(arg)
+                                           for arg in args]),
+                timeout=timeout, deadline=deadline)
+        if len(args) == 1:
+            return self.__fun(args[0], timeout=timeout, deadline=deadline)
+        return self.__fun(args, timeout=timeout, deadline=deadline)
+
+    def template(self):
+        """The template this was prepared from"""
+        return self.__template
+
+    def holes(self):
+        """The number of arguments the template takes"""
+        return len(self.__parts) - 1
+
+    def is_compiled(self):
+        """Was the template turned into a function on the server?"""
+        return self.__fun is not None
+
+class ValueHandle(object):
+    """A value bound in a module with :meth:`._CryptolModule.bind`"""
+
+    __serials = itertools.count()
+
+    def __init__(self, name, value):
+        self.__serial = next(ValueHandle.__serials)
+        self.__name = name
+        self.__value = value
+        self.__expr = None
+        self.__json = None
+        self.__partials = {}
+        self.__released = False
+
+    def __repr__(self):
+        return u'<ValueHandle {}>'.format(self.__name)
+
+    def name(self):
+        """The name of the binding"""
+        return self.__name
+
+    def value(self):
+        """The Python value bound"""
+        self.__check()
+        return self.__value
+
+    def released(self):
+        """Has the handle been released?"""
+        return self.__released
+
+    def release(self):
+        """Forget the value and its conversions; the handle is unusable."""
+        self.__released = True
+        self.__value = None
+        self.__expr = None
+        self.__json = None
+        self.__partials.clear()
+
+    def __check(self):
+        """Raise ValueError if the handle has been released"""
+        if self.__released:
+            raise ValueError(
+                u'{} has been released'.format(self.__name))
+
+    def _expr(self):
+        """The value as a Cryptol expression"""
+        self.__check()
+        if self.__expr is None:
+            self.__expr = _CryptolModule.to_expr(self.__value)
+        return self.__expr
+
+    def _value(self):
+        """The value as a JSON-formatted Cryptol value"""
+        self.__check()
+        if self.__json is None:
+            self.__json = _to_value(self.__value)
+        return self.__json
+
+    def _serial(self):
+        """A number telling this handle apart from every other one"""
+        return self.__serial
+
+    def _partial(self, handle):
+        """The function with ``handle`` applied to the value, if kept"""
+        return self.__partials.get(handle)
+
+    def _keep_partial(self, handle, clos):
+        """Keep the function with ``handle`` applied to the value"""
+        self.__check()
+        self.__partials[handle] = clos
 
 class CryptolError(Exception):
     """Base class for errors arising from the Cryptol interpreter"""
@@ -942,6 +1964,17 @@ class ProverError(CryptolError):
     """An error arising from the prover configured for Cryptol"""
     pass
 
+class CryptolTimeout(CryptolError):
+    """A request that did not finish by its timeout or deadline
+
+    The request is interrupted on the server, and the module it was
+    made on remains usable, unless the worker did not answer the
+    interrupt either: the module is then closed, and any further
+    request on it fails.
+
+    """
+    pass
+
 class PycryptolInternalError(Exception):
     """An internal error in pycryptol that indicates a bug
 
@@ -962,6 +1995,757 @@ class PycryptolInternalError(Exception):
         )
         return template.format(self.msg)
 
+def _start_server(cryptol_server, addr, port, timeout=_STARTUP_TIMEOUT):
+    """Start a Cryptol server process listening on ``port``.
+
+    Returns once the server accepts connections (see
+    :func:`._await_server`).
+
+    :raises CryptolServerError: if the ``cryptol_server`` executable
+        can't be found, exits unexpectedly or does not start in time
+
+    """
+    null = open(os.devnull, 'wb')
+    try:
+        args = [cryptol_server,
+                '--port', str(port),
+                '--mask-interrupts']
+        server = subprocess.Popen(args,
+                                  stdin=subprocess.PIPE,
+                                  stdout=null,
+                                  stderr=null)
+    except OSError as err:
+        if err.errno == errno.ENOENT:
+            raise CryptolServerError(
+                u'Could not find Cryptol server executable {!r}.\n'
+                'Make sure it is on your system path, or pass a '
+                'different path for the cryptol_server argument.'
+                .format(cryptol_server)
+                )
+        else:
+            raise
+
+    try:
+        _await_server(server, addr, port, timeout)
+    except CryptolServerError as err:
+        _stop_server(server, 0)
+        raise CryptolServerError(
+            u'Cryptol server executable {!r}: {}'.format(cryptol_server, err))
+    return server
+
+def _await_server(server, addr, port, timeout):
+    """Wait until a Cryptol server accepts connections on ``port``.
+
+    Rather than sleeping for a fixed time, this tries to connect to
+    the server's control port, backing off exponentially between
+    attempts, so that it returns as soon as the server is listening
+    and still tolerates slow starts on loaded hosts. Only TCP
+    addresses can be probed; for others this returns immediately.
+
+    :param server: The server process, so that an early exit is
+        reported at once, or ``None`` for a server started elsewhere
+
+    :param float timeout: The number of seconds to wait at most
+
+    :raises CryptolServerError: if the server exits, or does not
+        accept connections within ``timeout`` seconds
+
+    """
+    if not addr.startswith('tcp://'):
+        return
+    host = addr.split('://', 1)[1]
+    deadline = time.time() + timeout
+    delay = 0.001
+    while True:
+        if server:
+            result = server.poll()
+            if result is not None:
+                raise CryptolServerError(
+                    u'Cryptol server exited unexpectedly with exit '
+                    'code {:d}'.format(result))
+        remaining = deadline - time.time()
+        try:
+            probe = socket.create_connection((host, port),
+                                             max(remaining, 0.001))
+        except socket.error:
+            pass
+        else:
+            probe.close()
+            return
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise CryptolServerError(
+                u'Cryptol server did not accept connections on port {} '
+                'within {:g} seconds'.format(port, timeout))
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 0.1)
+
+def _stop_server(server, timeout):
+    """Wait for a server process to exit, terminating it if need be.
+
+    :param float timeout: The number of seconds to give the server to
+        exit by itself, for instance after an ``exit`` message, before
+        terminating it, and then again before killing it
+
+    """
+    for stop in (server.terminate, server.kill):
+        if _wait_exit(server, timeout):
+            return
+        try:
+            stop()
+        except OSError:
+            # it exited in the meantime
+            pass
+        timeout = max(timeout, 1.0)
+    server.wait()
+
+def _wait_exit(server, timeout):
+    """Wait up to ``timeout`` seconds for a process to exit.
+
+    :return bool: Whether the process has exited
+
+    """
+    deadline = time.time() + timeout
+    delay = 0.001
+    while server.poll() is None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 0.05)
+    return True
+
+def _bitvector_word(value, width):
+    """Build the Python representation of a word as a ``BitVector``"""
+    if width == 0:
+        return BitVector(size=0)
+    return BitVector(intVal=value, size=width)
+
+def _from_value(val, make_word=_bitvector_word, decoders=None):
+    """Convert a JSON-formatted Cryptol value to a Python value.
+
+    Rather than recursing, this walks the value with an explicit
+    stack, dispatching on the kind of each node through
+    :data:`._VALUE_DECODERS`. Containers are created before their
+    elements and filled in place; tuples, being immutable, are built
+    from their filled element lists once the walk is over.
+
+    :param make_word: A function building the Python representation
+        of a word from its (non-negative) integer value and its width
+
+    :param dict decoders: The decoders to dispatch to, by kind of
+        value; defaults to :data:`._VALUE_DECODERS`
+
+    """
+    if decoders is None:
+        decoders = _VALUE_DECODERS
+    root = [None]
+    pending = [(val, root, 0)]
+    tuples = []
+    while pending:
+        node, parent, idx = pending.pop()
+        for kind in node:
+            decode = decoders.get(kind)
+            if decode is not None:
+                break
+        else:
+            raise PycryptolInternalError(
+                u'Could not convert message to value: {}'.format(node))
+        decode(node[kind], parent, idx, pending, tuples, make_word)
+    # tuples were registered parents first, so build them children first
+    for parent, idx, items in reversed(tuples):
+        parent[idx] = tuple(items)
+    return root[0]
+
+def _decode_bit(bit, parent, idx, pending, tuples, make_word):
+    """VBit"""
+    parent[idx] = bit
+
+def _decode_record(fields, parent, idx, pending, tuples, make_word):
+    """VRecord"""
+    rec = {}
+    parent[idx] = rec
+    # pushed in reverse, so that fields are added in their given order
+    for field in reversed(fields):
+        pending.append((field[1], rec, field[0]['Name']))
+
+def _decode_tuple(elts, parent, idx, pending, tuples, make_word):
+    """VTuple"""
+    items = [None] * len(elts)
+    tuples.append((parent, idx, items))
+    for i, elt in enumerate(elts):
+        pending.append((elt, items, i))
+
+def _decode_sequence(seq, parent, idx, pending, tuples, make_word):
+    """VSeq"""
+    elts = seq['elements']
+    if seq['isWord']:
+        # a word given bit by bit; pack the bits straight into an int
+        try:
+            bits = ''.join(['1' if elt['bit'] else '0' for elt in elts])
+        except (KeyError, TypeError):
+            raise PycryptolInternalError(
+                u'Word sequence with non-bit elements: {}'.format(seq))
+        parent[idx] = make_word(int(bits, 2) if bits else 0, len(bits))
+        return
+    if elts:
+        # sequences of words or of bits, the most common by far, are
+        # decoded here rather than pushed element by element
+        items = _decode_flat(elts, make_word)
+        if items is not None:
+            parent[idx] = items
+            return
+    items = [None] * len(elts)
+    parent[idx] = items
+    for i, elt in enumerate(elts):
+        pending.append((elt, items, i))
+
+def _decode_flat(elts, make_word):
+    """Decode a non-empty sequence of words or of bits at once.
+
+    :return: The list of decoded elements, or ``None`` if the elements
+        are not all words or all bits
+
+    """
+    try:
+        if 'bit' in elts[0]:
+            return [elt['bit'] for elt in elts]
+        if 'word' not in elts[0]:
+            return None
+        bvs = [elt['word']['bitvector'] for elt in elts]
+    except (KeyError, TypeError):
+        return None
+    items = []
+    width = mask = None
+    for bv in bvs:
+        if bv['width'] != width:
+            width = bv['width']
+            mask = (1 << int(width)) - 1
+        if mask:
+            items.append(make_word(bv_int(bv['value']) & mask, int(width)))
+        else:
+            items.append(None)
+    return items
+
+def _decode_word(word, parent, idx, pending, tuples, make_word):
+    """VWord"""
+    bv = word['bitvector']
+    width = int(bv['width'])
+    if width == 0:
+        parent[idx] = None
+    else:
+        parent[idx] = make_word(bv_int(bv['value']) & ((1 << width) - 1),
+                                width)
+
+def _decode_function(fun, parent, idx, pending, tuples, make_word):
+    """VFun"""
+    # TODO: this only arises when functions are nested within other
+    # structures. Make the server handle this case with a funvalue
+    # message
+    parent[idx] = None
+
+_VALUE_DECODERS = {
+    'bit': _decode_bit,
+    'record': _decode_record,
+    'tuple': _decode_tuple,
+    'sequence': _decode_sequence,
+    'word': _decode_word,
+    'function': _decode_function,
+    }
+"""Decoders for each kind of JSON-formatted Cryptol value"""
+
+def _decode_sequence_array(seq, parent, idx, pending, tuples, make_word):
+    """VSeq, as a NumPy array if its elements are uniform words"""
+    arr = _array_from_sequence(seq)
+    if arr is None:
+        _decode_sequence(seq, parent, idx, pending, tuples, make_word)
+    else:
+        parent[idx] = arr
+
+_ARRAY_DECODERS = dict(_VALUE_DECODERS, sequence=_decode_sequence_array)
+"""Decoders producing NumPy arrays for sequences where possible"""
+
+def _array_from_sequence(seq):
+    """Convert a JSON-formatted sequence to a NumPy array, if possible.
+
+    Sequences of words of the same width of at most 64 bits become
+    arrays of the smallest unsigned integer type holding them.
+    Sequences of such sequences, all of the same shape, become
+    multidimensional arrays.
+
+    :return: The array, or ``None`` if the sequence is empty, not
+        uniform or too wide
+
+    """
+    elts = seq['elements']
+    if seq['isWord'] or not elts:
+        return None
+    first = elts[0]
+    if 'sequence' in first and not first['sequence']['isWord']:
+        rows = []
+        for elt in elts:
+            row = _array_from_sequence(elt['sequence']) \
+                if 'sequence' in elt else None
+            if row is None or (rows and (row.shape != rows[0].shape or
+                                         row.dtype != rows[0].dtype)):
+                return None
+            rows.append(row)
+        return numpy.stack(rows)
+    words = [_word_parts(elt) for elt in elts]
+    width = words[0][1]
+    if width is None or width == 0 or width > 64:
+        return None
+    values = []
+    for value, elt_width in words:
+        if elt_width != width:
+            return None
+        values.append(value)
+    return numpy.array(values, dtype=_array_dtype(width))
+
+def _word_parts(node):
+    """The value and width of a JSON-formatted word, or ``(None, None)``"""
+    if 'word' in node:
+        bv = node['word']['bitvector']
+        width = int(bv['width'])
+        return bv_int(bv['value']) & ((1 << width) - 1), width
+    if 'sequence' in node and node['sequence']['isWord']:
+        try:
+            bits = ''.join(['1' if elt['bit'] else '0'
+                            for elt in node['sequence']['elements']])
+        except KeyError:
+            return None, None
+        return int(bits, 2) if bits else 0, len(bits)
+    return None, None
+
+def _decode_sequence_bytes(seq, parent, idx, pending, tuples, make_word):
+    """VSeq, as ``bytes`` if its elements are 8-bit words"""
+    data = _bytes_from_sequence(seq)
+    if data is None:
+        _decode_sequence(seq, parent, idx, pending, tuples, make_word)
+    else:
+        parent[idx] = data
+
+_BYTES_DECODERS = dict(_VALUE_DECODERS, sequence=_decode_sequence_bytes)
+"""Decoders producing ``bytes`` for sequences of bytes"""
+
+def _bytes_from_sequence(seq):
+    """Convert a JSON-formatted sequence of 8-bit words to ``bytes``.
+
+    :return: The bytes, or ``None`` if the sequence is empty or has
+        elements other than 8-bit words
+
+    """
+    elts = seq['elements']
+    if seq['isWord'] or not elts:
+        return None
+    values = []
+    for elt in elts:
+        value, width = _word_parts(elt)
+        if width != 8:
+            return None
+        values.append(value)
+    return bytes(bytearray(values))
+
+def _array_dtype(width):
+    """The smallest unsigned NumPy integer type holding ``width`` bits"""
+    for bits in (8, 16, 32, 64):
+        if width <= bits:
+            return numpy.dtype('uint{}'.format(bits))
+    raise ValueError(u'No NumPy integer type holds {} bits'.format(width))
+
+_VALUE_MODES = {
+    'bitvector': (_bitvector_word, _VALUE_DECODERS),
+    'int': (Word, _VALUE_DECODERS),
+    'numpy': (Word, _ARRAY_DECODERS),
+    'bytes': (Word, _BYTES_DECODERS),
+    }
+"""Word builders and decoders of each value mode"""
+
+def _value_decoder(values):
+    """Build the function decoding values in a value mode.
+
+    :raises ValueError: if ``values`` is not a known value mode, or
+        NumPy is not installed for the ``'numpy'`` mode
+
+    """
+    try:
+        make_word, decoders = _VALUE_MODES[values]
+    except KeyError:
+        raise ValueError(
+            u'Unknown value mode {!r}; expected one of {}'.format(
+                values, ', '.join(sorted(_VALUE_MODES))))
+    if values == 'numpy' and numpy is None:
+        raise ValueError(u'The numpy value mode requires NumPy')
+    return lambda val: _from_value(val, make_word, decoders)
+
+def _check_holes(parts, args):
+    """Check that a template split at its holes takes ``args``.
+
+    :raises TypeError: if the number of arguments does not match the
+        number of holes
+
+    """
+    holes = len(parts) - 1
+    if len(args) < holes:
+        raise TypeError(
+            'not all arguments converted during Cryptol string templating')
+    if len(args) > holes:
+        raise TypeError(
+            'not enough arguments for Cryptol template string')
+
+def _holds_handle(pyval):
+    """Is a value, or one it contains, a :class:`.ValueHandle`?"""
+    if isinstance(pyval, ValueHandle):
+        return True
+    if isinstance(pyval, (tuple, list)):
+        return any(_holds_handle(v) for v in pyval)
+    if isinstance(pyval, dict):
+        return any(_holds_handle(v) for v in pyval.values())
+    return False
+
+def _fill_holes(parts, texts):
+    """Join a template split at its holes with the text of each hole"""
+    pieces = [parts[0]]
+    for text, part in zip(texts, parts[1:]):
+        pieces.append(text)
+        pieces.append(part)
+    return u''.join(pieces)
+
+def _to_value(pyval):
+    """Convert a Python value to a JSON-formatted Cryptol value."""
+    # VBit
+    if isinstance(pyval, bool):
+        return {'bit': pyval}
+    # VRecord
+    elif isinstance(pyval, dict):
+        return {'record': [[{'Name': k}, _to_value(v)]
+                           for k, v in pyval.items()]}
+    # VTuple
+    elif isinstance(pyval, tuple):
+        return {'tuple': [_to_value(v) for v in pyval]}
+    # VSeq
+    elif isinstance(pyval, list):
+        # a list of bits is a word, sent packed rather than bit by bit
+        if _is_bit_list(pyval):
+            return {'word':
+                    {'bitvector':
+                     {'width': len(pyval), 'value': _bits_to_int(pyval)}}}
+        width = _uniform_width(pyval)
+        if width is not None:
+            # skip the dispatch on each element of a list of words
+            return {'sequence':
+                    {'isWord': False,
+                     'elements': [{'word':
+                                   {'bitvector':
+                                    {'width': width, 'value': int(v)}}}
+                                  for v in pyval]}}
+        return {'sequence':
+                {'isWord': False,
+                 'elements': [_to_value(v) for v in pyval]}}
+    # VSeq of bytes
+    elif isinstance(pyval, _bytes_types):
+        return {'sequence':
+                {'isWord': False,
+                 'elements': [_BYTE_VALUES[b] for b in bytearray(pyval)]}}
+    # VSeq or VWord, from a NumPy array or scalar
+    elif numpy is not None and isinstance(pyval, (numpy.ndarray,
+                                                  numpy.generic)):
+        return _array_to_value(pyval)
+    # VWord
+    elif isinstance(pyval, BitVector):
+        return {'word':
+                {'bitvector':
+                 {'width': pyval.length(), 'value': int(pyval)}}}
+    elif isinstance(pyval, Word):
+        return {'word':
+                {'bitvector': {'width': pyval.width, 'value': pyval.value}}}
+    # bound value, converted once
+    elif isinstance(pyval, ValueHandle):
+        return pyval._value()
+    else:
+        # TODO: convert strings to ASCII?
+        raise ValueError(
+            u'Unable to convert Python value into '
+            'Cryptol value {!s}'.format(pyval))
+
+_BYTE_VALUES = [{'word': {'bitvector': {'width': 8, 'value': b}}}
+                for b in range(256)]
+"""The JSON-formatted Cryptol value of each byte"""
+
+def _is_bit_list(pyval):
+    """Is a list non-empty and made of booleans only?"""
+    if not pyval:
+        return False
+    for elt in pyval:
+        if not isinstance(elt, bool):
+            return False
+    return True
+
+def _bits_to_int(bits):
+    """The integer with the given bits, most significant first"""
+    return int(''.join(['1' if bit else '0' for bit in bits]), 2)
+
+def _uniform_width(pyval):
+    """The common width of a non-empty list of words, or ``None``"""
+    width = None
+    for elt in pyval:
+        if isinstance(elt, Word):
+            elt_width = elt.width
+        elif isinstance(elt, BitVector):
+            elt_width = elt.length()
+        else:
+            return None
+        if width is None:
+            width = elt_width
+        elif elt_width != width:
+            return None
+    return width
+
+def _array_to_value(arr):
+    """Convert a NumPy array of integers or booleans to a Cryptol value.
+
+    Integer elements become words as wide as their type, with signed
+    integers taken in two's complement, and arrays of booleans become
+    words along their last axis.
+
+    """
+    arr = numpy.asarray(arr)
+    if arr.dtype == numpy.bool_:
+        if arr.ndim == 0:
+            return {'bit': bool(arr)}
+        width = arr.shape[-1]
+        values = [int(''.join(['1' if bit else '0' for bit in row]) or '0', 2)
+                  for row in arr.reshape(-1, width).tolist()]
+        values = numpy.array(values, dtype=object).reshape(arr.shape[:-1])
+    elif arr.dtype.kind in 'iu':
+        width = arr.dtype.itemsize * 8
+        values = arr.view(_array_dtype(width))
+    else:
+        raise ValueError(
+            u'Unable to convert NumPy array of {} into Cryptol '
+            'value'.format(arr.dtype))
+    def word(value):
+        """VWord"""
+        return {'word': {'bitvector': {'width': width, 'value': value}}}
+    def build(items, depth):
+        """VSeq of the nested lists of an array"""
+        if depth == 0:
+            return word(items)
+        return {'sequence':
+                {'isWord': False,
+                 'elements': [build(item, depth - 1) for item in items]}}
+    return build(values.tolist(), values.ndim)
+
+def _array_to_expr(arr):
+    """Convert a NumPy array of integers or booleans to a Cryptol literal"""
+    arr = numpy.asarray(arr)
+    if arr.dtype == numpy.bool_:
+        width = None
+        items = arr.tolist()
+    elif arr.dtype.kind in 'iu':
+        width = arr.dtype.itemsize * 8
+        items = arr.view(_array_dtype(width)).tolist()
+    else:
+        raise TypeError(
+            u'Unable to convert NumPy array of {} into Cryptol '
+            'expression'.format(arr.dtype))
+    literal = json.dumps(items).replace('true', 'True').replace(
+        'false', 'False')
+    typ = u''.join([u'[{}]'.format(dim) for dim in arr.shape])
+    if width is not None:
+        typ += u'[{}]'.format(width)
+    elif not typ:
+        return literal
+    return u'({} : {})'.format(literal, typ)
+
+def _type_from_response(resp):
+    """Interpret the server's response to a ``typeOf`` command"""
+    if resp['tag'] == 'type':
+        return resp['pp']
+    elif resp['tag'] == 'interactiveError':
+        raise CryptolError(resp['pp'])
+    else:
+        raise PycryptolInternalError(
+            u'Cryptol typechecking returned a non-type '
+            'message: {}'.format(resp))
+
+def _test_report_from_response(resp, decode=_from_value):
+    """Interpret the server's response to a ``check`` or ``exhaust``"""
+    if resp['tag'] == 'interactiveError':
+        raise CryptolError(resp['pp'])
+    try:
+        obj = resp['testReport'][0]
+    except:
+        raise PycryptolInternalError(
+            u'Malformed check response: {}'.format(resp))
+    try:
+        result = obj['reportResult']
+        if 'Pass' in result:
+            passed = True
+            cex = None
+        else:
+            passed = False
+        if 'FailFalse' in result:
+            cex = tuple([decode(arg)
+                         for arg in result['FailFalse']])
+        if 'FailError' in result:
+            cex = tuple([decode(arg)
+                         for arg in result['args']])
+            errmsg = result['FailError']
+        else:
+            errmsg = None
+        tests_run = obj['reportTestsRun']
+        tests_possible = obj['reportTestsPossible']
+        prop = obj['reportProp']
+        return TestReport(
+            prop, passed, tests_run, tests_possible, errmsg, cex)
+    except KeyError:
+        raise PycryptolInternalError('Malformed check/exhaust response')
+
+def _proof_result_from_response(resp, decode=_from_value, prover=None):
+    """Interpret the server's response to a ``prove`` command"""
+    if resp['tag'] == 'prove':
+        if resp['counterexample'] is not None:
+            args = tuple([decode(arg)
+                          for arg in resp['counterexample']])
+            return ProofResult(False, args, prover)
+        else:
+            return ProofResult(True, None, prover)
+    elif resp['tag'] == 'proverError':
+        raise ProverError(resp['message'])
+    elif resp['tag'] == 'interactiveError':
+        raise CryptolError(resp['pp'])
+    else:
+        raise PycryptolInternalError(
+            u'Cryptol prove command returned an invalid '
+            'message: {}'.format(resp))
+
+def _sat_result_from_response(resp, sat_num, decode=_from_value,
+                              prover=None):
+    """Interpret the server's response to a ``sat`` command"""
+    if resp['tag'] == 'sat':
+        argss = [tuple([decode(arg) for arg in assignment])
+                 for assignment in resp['assignments']]
+        # Return different result types based on ``sat_num``
+        if sat_num == 1:
+            if len(argss) == 0:
+                return SatResult(False, None, prover)
+            elif len(argss) == 1:
+                return SatResult(True, argss[0], prover)
+            else:
+                raise PycryptolInternalError(
+                    'Multiple satisfying assignments with sat_num != 1')
+        else:
+            if len(argss) == 0:
+                return AllSatResult(False, None, prover)
+            else:
+                return AllSatResult(True, argss, prover)
+
+    elif resp['tag'] == 'proverError':
+        raise ProverError(resp['message'])
+    elif resp['tag'] == 'interactiveError':
+        raise CryptolError(resp['pp'])
+    else:
+        raise PycryptolInternalError(
+            u'Cryptol SAT checking returned an invalid '
+            'message: {}'.format(resp))
+
+_WORD_ARGUMENT = re.compile(r'^\[(\d+)\]\s*->')
+
+def _word_argument(prop_type):
+    """The width of the first argument of a property, if a word"""
+    match = _WORD_ARGUMENT.match(prop_type.strip())
+    if match is None:
+        return None
+    return int(match.group(1))
+
+_BITS_TYPE = r'(?:(?:\[\d+\])+|Bit)'
+_BITS_PROPERTY = re.compile(r'^(?:{0}\s*->\s*)*Bit$'.format(_BITS_TYPE))
+_BITS_ARGUMENT = re.compile(r'({})\s*->'.format(_BITS_TYPE))
+
+def _tests_possible(prop_type):
+    """The size of the input space of a property, if it is known.
+
+    :return: The number of possible inputs of a property taking bits,
+        words and sequences of them, or ``None`` for other properties
+
+    """
+    prop_type = prop_type.strip()
+    if _BITS_PROPERTY.match(prop_type) is None:
+        return None
+    possible = 1
+    for arg in _BITS_ARGUMENT.findall(prop_type):
+        width = 1
+        for length in re.findall(r'\d+', arg):
+            width *= int(length)
+        possible <<= width
+    return possible
+
+def _shard_expr(expr, index, bits, width):
+    """The property restricted to first arguments starting with ``index``"""
+    return (u'\\(pycryptol_rest : [{}]) -> '
+            '({}) (({} : [{}]) # pycryptol_rest)').format(
+                width - bits, expr, index, bits)
+
+def _shard_word(index, bits, rest):
+    """The first argument of a property from that of one of its shards.
+
+    :param int index: The leading bits fixed by the shard
+
+    :param int bits: The number of leading bits fixed by the shard
+
+    :param rest: The rest of the first argument, as a word in the
+        representation of the module that decoded it
+
+    """
+    make_word = _bitvector_word if isinstance(rest, BitVector) else Word
+    width = len(rest)
+    return make_word((index << width) | int(rest), bits + width)
+
+def _deadline(timeout, deadline):
+    """The earlier of a relative timeout and an absolute deadline"""
+    if timeout is not None:
+        if timeout < 0:
+            raise ValueError('A timeout cannot be negative')
+        timeout = time.time() + timeout
+        if deadline is None or timeout < deadline:
+            return timeout
+    return deadline
+
+def _module_key(filepath):
+    """Identify the version of a module file, with its imports.
+
+    :return: A key that changes whenever the module or a module it
+        imports is edited, or ``None`` if the file cannot be read
+
+    """
+    if filepath is None:
+        return 'prelude'
+    try:
+        return (os.path.abspath(filepath), module_digest(filepath))
+    except (IOError, OSError):
+        return None
+
+def _native_str(text, encoding='utf-8', errors='strict'):
+    """Convert text to the native ``str`` type of this Python version"""
+    if isinstance(text, str):
+        return text
+    return text.encode(encoding, errors)
+
+def _free_port(addr):
+    """Find a TCP port that is currently free on the interface ``addr``.
+
+    :param str addr: A ZeroMQ TCP address such as ``tcp://127.0.0.1``
+
+    """
+    host = addr.split('://', 1)[-1]
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
 def _bool_to_opt(boolean):
     """Convert a boolean to ``on`` or ``off``"""
     if boolean:
@@ -980,6 +2764,6 @@ def _is_function(sch):
 
 def _bv_to_hex(bv):
     """Temporary convenience function for C API"""
-    if not isinstance(bv, BitVector):
+    if not isinstance(bv, (BitVector, Word)):
         raise TypeError('bv_to_hex expects a BitVector')
-    return hex(long(int(bv)))
+    return hex(_long(int(bv)))
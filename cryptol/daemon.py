@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+"""A Cryptol server shared by the sessions of every Python process.
+
+Starting ``cryptol-server`` takes a while, which short-lived processes
+pay on every run. A :class:`SharedCryptol` session instead connects to
+a server already running for the current user, or starts one that
+later sessions, in this process or others, will reuse.
+
+Each shared server is watched by a small supervisor process. The
+supervisor records the server's port in a registry file, and counts
+the sessions using the server through a directory holding one file
+per session, named after the process it belongs to. Once no live
+process has used the server for ``idle_timeout`` seconds, the
+supervisor stops it and removes its registry entry. Sessions of
+processes that die without exiting are noticed and dropped.
+
+Finding or starting a server, and stopping it, are serialized with a
+lock file, so concurrent processes agree on a single server.
+
+Run as ``python -m cryptol.daemon``, this module is the supervisor.
+
+"""
+
+from .cache import _FileLock, _remove, fcntl
+from .cryptol import (Cryptol, CryptolServerError, _free_port,
+                      _start_server, _stop_server, _STARTUP_TIMEOUT,
+                      _SHUTDOWN_TIMEOUT)
+import argparse
+import errno
+import hashlib
+import itertools
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import zmq
+
+_DEFAULT_IDLE_TIMEOUT = 300.0
+"""The default number of idle seconds before a shared server stops"""
+
+class SharedCryptol(Cryptol):
+    """A Cryptol session on a server shared between processes.
+
+    This behaves like :class:`.Cryptol`, except that the server is
+    found in, or added to, a per-user registry of running servers
+    rather than started for this session alone, and :meth:`.exit`
+    leaves it running for other sessions. The server stops by itself
+    after ``idle_timeout`` seconds without sessions.
+
+    >>> with SharedCryptol(idle_timeout=600) as cry:
+    ...     aes = cry.load_module('AES.cry')
+
+    :param str cryptol_server: The path to the Cryptol server
+        executable; sessions with different executables or addresses
+        use different servers
+
+    :param str addr: The interface on which to bind the Cryptol server
+
+    :param float idle_timeout: The number of seconds the server keeps
+        running once no session uses it, if this session starts it
+
+    :param str registry: The directory of the registry; defaults to
+        ``pycryptol`` in the user's cache directory
+
+    Other keyword arguments are passed on to :class:`.Cryptol`.
+
+    :raises CryptolServerError: if no server can be found or started
+
+    """
+    def __init__(self,
+                 cryptol_server='cryptol-server',
+                 addr='tcp://127.0.0.1',
+                 idle_timeout=_DEFAULT_IDLE_TIMEOUT,
+                 registry=None,
+                 **kwargs):
+        self.__lease = _acquire(cryptol_server, addr, idle_timeout, registry,
+                                kwargs.get('startup_timeout',
+                                           _STARTUP_TIMEOUT))
+        try:
+            super(SharedCryptol, self).__init__(
+                cryptol_server=None, addr=addr,
+                port=self.__lease['port'], **kwargs)
+        except:
+            _release(self.__lease)
+            raise
+
+    def exit(self, timeout=_SHUTDOWN_TIMEOUT):
+        """Close the session, leaving the shared server running.
+
+        Any modules loaded in this session will be invalid after
+        calling this method.
+
+        """
+        try:
+            super(SharedCryptol, self).exit(timeout)
+        finally:
+            _release(self.__lease)
+
+def running_server(cryptol_server='cryptol-server', addr='tcp://127.0.0.1',
+                   registry=None):
+    """Look up the shared server for an executable and address.
+
+    :return dict: The registry entry of the server, with its control
+        ``port`` and the ``pid`` of its supervisor, or ``None`` if no
+        such server is running
+
+    """
+    paths = _paths(cryptol_server, addr, registry)
+    with _FileLock(paths['lock']):
+        return _live_entry(paths)
+
+def _registry_dir(registry):
+    """The registry directory, created if needed"""
+    if registry is None:
+        cache = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+            os.path.expanduser('~'), '.cache')
+        registry = os.path.join(cache, 'pycryptol')
+    try:
+        os.makedirs(registry)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+    return registry
+
+def _paths(cryptol_server, addr, registry):
+    """The registry files of the server for an executable and address"""
+    key = hashlib.sha256(u'{}\0{}'.format(cryptol_server, addr).encode(
+        'utf-8')).hexdigest()[:16]
+    base = os.path.join(_registry_dir(registry), 'server-' + key)
+    return {'entry': base + '.json',
+            'lock': base + '.lock',
+            'log': base + '.log',
+            'clients': base + '.clients'}
+
+def _live_entry(paths):
+    """Read the registry entry, if its supervisor is still running."""
+    try:
+        with open(paths['entry']) as entry_file:
+            entry = json.load(entry_file)
+    except (IOError, OSError, ValueError):
+        return None
+    if not _alive(entry['pid']):
+        _remove(paths['entry'])
+        return None
+    return entry
+
+_leases = itertools.count()
+_supervisors = []
+
+def _acquire(cryptol_server, addr, idle_timeout, registry, timeout):
+    """Register a session with the shared server, starting it if needed.
+
+    :return dict: The lease of the session, holding the server's
+        control ``port`` and the ``client`` file to remove on release
+
+    """
+    if fcntl is None:
+        raise CryptolServerError(
+            u'Shared Cryptol servers require file locking, which this '
+            'platform does not support')
+    paths = _paths(cryptol_server, addr, registry)
+    client = os.path.join(paths['clients'], '{}.{}'.format(
+        os.getpid(), next(_leases)))
+    with _FileLock(paths['lock']):
+        entry = _live_entry(paths)
+        try:
+            os.makedirs(paths['clients'])
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        # registered while holding the lock, so that a supervisor
+        # about to stop its server for idleness sees this session
+        open(client, 'w').close()
+        try:
+            if entry is None:
+                entry = _spawn(cryptol_server, addr, idle_timeout, paths,
+                               timeout)
+        except:
+            _remove(client)
+            raise
+    return {'port': entry['port'], 'client': client}
+
+def _release(lease):
+    """Unregister a session from its shared server."""
+    _remove(lease['client'])
+
+def _spawn(cryptol_server, addr, idle_timeout, paths, timeout):
+    """Start a supervisor and wait for it to register its server."""
+    env = dict(os.environ)
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        [package_root] + [p for p in [env.get('PYTHONPATH')] if p])
+    args = [sys.executable, '-m', 'cryptol.daemon',
+            '--server', cryptol_server,
+            '--addr', addr,
+            '--idle-timeout', repr(idle_timeout),
+            '--startup-timeout', repr(timeout),
+            '--entry', paths['entry'],
+            '--lock', paths['lock'],
+            '--clients', paths['clients']]
+    null = open(os.devnull, 'rb')
+    log = open(paths['log'], 'ab')
+    try:
+        # in a session of its own, so that it outlives this process
+        # and is not interrupted along with it
+        supervisor = subprocess.Popen(args, stdin=null, stdout=log,
+                                      stderr=log, close_fds=True, env=env,
+                                      preexec_fn=os.setsid)
+    finally:
+        null.close()
+        log.close()
+    _supervisors.append(supervisor)
+    deadline = time.time() + timeout
+    delay = 0.001
+    while True:
+        entry = _live_entry(paths)
+        if entry is not None and entry['pid'] == supervisor.pid:
+            return entry
+        if supervisor.poll() is not None:
+            raise CryptolServerError(
+                u'Could not start a shared Cryptol server; see {}'.format(
+                    paths['log']))
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise CryptolServerError(
+                u'Shared Cryptol server did not start within {:g} '
+                'seconds; see {}'.format(timeout, paths['log']))
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 0.1)
+
+def _alive(pid):
+    """Is there a running process with this pid?"""
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+    return True
+
+def _live_clients(clients):
+    """Count the live sessions, removing those of dead processes."""
+    count = 0
+    try:
+        names = os.listdir(clients)
+    except OSError:
+        return 0
+    for name in names:
+        try:
+            pid = int(name.split('.', 1)[0])
+        except ValueError:
+            continue
+        if _alive(pid):
+            count += 1
+        else:
+            _remove(os.path.join(clients, name))
+    return count
+
+def _supervise(opts):
+    """Run a shared server until it has been idle for long enough."""
+    port = _free_port(opts['addr'])
+    server = _start_server(opts['server'], opts['addr'], port,
+                           opts['startup_timeout'])
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    tmp = '{}.{}.tmp'.format(opts['entry'], os.getpid())
+    with open(tmp, 'w') as entry_file:
+        json.dump({'pid': os.getpid(), 'port': port,
+                   'server_pid': server.pid}, entry_file)
+    os.rename(tmp, opts['entry'])
+    interval = min(1.0, opts['idle_timeout'] / 4)
+    idle_since = None
+    try:
+        while not stop.is_set() and server.poll() is None:
+            if _live_clients(opts['clients']) > 0:
+                idle_since = None
+            elif idle_since is None:
+                idle_since = time.time()
+            elif time.time() - idle_since >= opts['idle_timeout']:
+                with _FileLock(opts['lock']):
+                    # a session may have registered since the check
+                    if _live_clients(opts['clients']) == 0:
+                        _remove(opts['entry'])
+                        break
+                idle_since = None
+            stop.wait(interval)
+    finally:
+        with _FileLock(opts['lock']):
+            entry = _read_json(opts['entry'])
+            if entry is not None and entry.get('pid') == os.getpid():
+                _remove(opts['entry'])
+        _exit_server(server, opts['addr'], port)
+
+def _read_json(path):
+    """Read a JSON file, or return ``None``."""
+    try:
+        with open(path) as json_file:
+            return json.load(json_file)
+    except (IOError, OSError, ValueError):
+        return None
+
+def _exit_server(server, addr, port):
+    """Ask a server to exit through its control port, then stop it."""
+    ctx = zmq.Context()
+    try:
+        req = ctx.socket(zmq.REQ)
+        req.connect(addr + ':' + str(port))
+        try:
+            req.send_json({'tag': 'exit'}, flags=zmq.NOBLOCK)
+        except zmq.error.ZMQError:
+            pass
+        # bounded, in case the server is already gone
+        req.close(linger=int(_SHUTDOWN_TIMEOUT * 1000))
+    finally:
+        ctx.destroy(linger=int(_SHUTDOWN_TIMEOUT * 1000))
+    _stop_server(server, _SHUTDOWN_TIMEOUT)
+
+def main(args):
+    """Entry point of the supervisor process."""
+    parser = argparse.ArgumentParser(
+        prog='python -m cryptol.daemon',
+        description='Supervise a Cryptol server shared between processes.')
+    parser.add_argument('--server', required=True,
+                        help='the cryptol-server executable')
+    parser.add_argument('--addr', required=True,
+                        help='the interface on which to bind the server')
+    parser.add_argument('--idle-timeout', type=float, required=True,
+                        help='the idle seconds before the server stops')
+    parser.add_argument('--startup-timeout', type=float, required=True,
+                        help='the seconds to wait for the server to start')
+    parser.add_argument('--entry', required=True,
+                        help='the registry file of the server')
+    parser.add_argument('--lock', required=True,
+                        help='the lock file of the registry')
+    parser.add_argument('--clients', required=True,
+                        help='the directory of the sessions using the server')
+    _supervise(vars(parser.parse_args(args)))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,503 @@
+# -*- coding: utf-8 -*-
+"""Pools of Cryptol worker sessions for parallel evaluation."""
+
+from .cryptol import (Cryptol, TestReport, _CryptolModule, _shard_expr,
+                      _shard_word, _tests_possible, _word_argument,
+                      _STARTUP_TIMEOUT)
+from multiprocessing.pool import ThreadPool
+import collections
+import itertools
+import multiprocessing
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+class ModulePool(object):
+    """A thread-safe pool of worker sessions with the same module loaded.
+
+    A module returned by :meth:`.Cryptol.load_module` talks to a
+    single server worker over a single socket, so it can only be used
+    from one thread at a time. A pool opens several workers, each with
+    its own copy of the module, and hands every request to a worker
+    that is not busy. Since every worker has the module loaded, any
+    free worker can serve any request.
+
+    Requests name either a method of the module, such as ``'eval'``,
+    ``'check'``, ``'prove'`` or ``'sat'``, or one of its top-level
+    declarations, such as ``'aesEncrypt'``. A callable may be given
+    instead, in which case it is called with the worker's module as
+    its first argument.
+
+    >>> pool = ModulePool(cry, 'AES.cry', workers=4)
+    >>> result = pool.submit('prove', 'aesIsCorrect')
+    >>> cts = pool.map('aesEncrypt', [(pt, key) for pt in pts])
+    >>> result.get().is_valid()
+
+    Proofs and SAT queries may also race several provers, each on its
+    own worker, taking the first answer (see :meth:`.prove`).
+
+    :param cryptol: The :class:`.Cryptol` session in which to open
+        the workers
+
+    :param str filepath: The filepath of the Cryptol module to load
+        in every worker, or ``None`` for the prelude
+
+    :param int workers: The number of worker sessions to open
+
+    :param bool eager: Whether to evaluate every top-level declaration
+        while loading (see :meth:`.Cryptol.load_module`)
+
+    :param str values: The representation of words returned by the
+        workers (see :meth:`.Cryptol.load_module`)
+
+    """
+    def __init__(self, cryptol, filepath=None, workers=4, eager=False,
+                 values=None):
+        if workers < 1:
+            raise ValueError('A module pool needs at least one worker')
+        self.__modules = []
+        self.__idle = queue.Queue()
+        for _ in range(workers):
+            if filepath is None:
+                mod = cryptol.prelude(eager=eager, values=values)
+            else:
+                mod = cryptol.load_module(filepath, eager=eager,
+                                          values=values)
+            self.__modules.append(mod)
+            self.__idle.put(mod)
+        self.__threads = ThreadPool(workers)
+        self.__scatter_lock = threading.Lock()
+        self.__wins = {'prove': collections.Counter(),
+                       'sat': collections.Counter()}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.__modules)
+
+    def __run(self, method, args, kwargs):
+        """Run a request on the next free worker, blocking until one is."""
+        mod = self.__idle.get()
+        try:
+            if callable(method):
+                return method(mod, *args, **kwargs)
+            return getattr(mod, method)(*args, **kwargs)
+        finally:
+            self.__idle.put(mod)
+
+    def submit(self, method, *args, **kwargs):
+        """Run a request on a free worker in the background.
+
+        :param method: The name of a module method or declaration, or
+            a callable taking the module as its first argument
+
+        :return: A :class:`multiprocessing.pool.AsyncResult` whose
+            ``get()`` returns the result of the request
+
+        """
+        return self.__threads.apply_async(self.__run, (method, args, kwargs))
+
+    def map(self, method, iterable):
+        """Apply a request to each item of ``iterable`` in parallel.
+
+        Each item is passed as the single argument of ``method``.
+
+        :return: A list of results, in the order of ``iterable``
+
+        """
+        return self.__threads.map(
+            lambda arg: self.__run(method, (arg,), {}), iterable)
+
+    def imap(self, method, iterable):
+        """Like :meth:`.map`, but return an iterator over the results"""
+        return self.__threads.imap(
+            lambda arg: self.__run(method, (arg,), {}), iterable)
+
+    def call(self, name, *args, **kwargs):
+        """Call the top-level function ``name`` on a free worker"""
+        return self.__run(lambda mod: mod.decl(name)(*args, **kwargs),
+                          (), {})
+
+    def eval(self, expr, fmtargs=(), **kwargs):
+        """Run :meth:`._CryptolModule.eval` on a free worker"""
+        return self.__run('eval', (expr, fmtargs), kwargs)
+
+    def typeof(self, expr, fmtargs=()):
+        """Run :meth:`._CryptolModule.typeof` on a free worker"""
+        return self.__run('typeof', (expr, fmtargs), {})
+
+    def check(self, expr, fmtargs=(), **kwargs):
+        """Run :meth:`._CryptolModule.check` on a free worker"""
+        return self.__run('check', (expr, fmtargs), kwargs)
+
+    def prove(self, expr, fmtargs=(), provers=None, **kwargs):
+        """Run :meth:`._CryptolModule.prove` on a free worker.
+
+        Given a list of ``provers``, the proof is instead attempted
+        with each prover at once, on separate workers. The first
+        answer is returned, and the other provers are interrupted.
+        The prover that answered is given by the ``prover()`` method
+        of the result, and counted in :meth:`.prover_stats`. If
+        there are fewer workers than provers, only the provers that
+        won most often so far take part.
+
+        >>> result = pool.prove('aesIsCorrect',
+        ...                     provers=[Provers.Z3, Provers.CVC4])
+        >>> result.prover()
+        <Provers.Z3: 'z3'>
+
+        :param provers: The :class:`.Provers` to race, or ``None``
+            to use the ``prover`` keyword argument as usual
+
+        :raises ProverError: if every prover fails; the error is that
+            of the first prover to fail
+
+        """
+        if provers is None:
+            return self.__run('prove', (expr, fmtargs), kwargs)
+        return self.__race('prove', expr, fmtargs, provers, kwargs)
+
+    def sat(self, expr, fmtargs=(), provers=None, **kwargs):
+        """Run :meth:`._CryptolModule.sat` on a free worker.
+
+        Like :meth:`.prove`, this races ``provers`` if given.
+
+        """
+        if provers is None:
+            return self.__run('sat', (expr, fmtargs), kwargs)
+        return self.__race('sat', expr, fmtargs, provers, kwargs)
+
+    def prover_stats(self):
+        """Count how often each prover won a race.
+
+        :return dict: For each of ``prove`` and ``sat``, a dictionary
+            from the value of each winning prover, such as ``'z3'``,
+            to its number of wins
+
+        """
+        with self.__scatter_lock:
+            return dict((command, dict(wins))
+                        for command, wins in self.__wins.items())
+
+    def __race(self, command, expr, fmtargs, provers, kwargs):
+        """Run a query with several provers at once, on separate workers."""
+        provers = list(provers)
+        if not provers:
+            raise ValueError('A prover race needs at least one prover')
+        with self.__scatter_lock:
+            wins = self.__wins[command]
+            # the stable sort keeps the given order among equals
+            provers.sort(key=lambda prover: -wins[prover.value])
+        provers = provers[:len(self.__modules)]
+        outcomes = self.__scatter([
+            _bind_prover(command, expr, fmtargs, prover, kwargs)
+            for prover in provers])
+        first_error = None
+        try:
+            for index, result, err in outcomes:
+                if err is None:
+                    break
+                if first_error is None:
+                    first_error = err
+            else:
+                raise first_error
+        finally:
+            # interrupts the losers
+            outcomes.close()
+        with self.__scatter_lock:
+            self.__wins[command][provers[index].value] += 1
+        return result
+
+    def check_parallel(self, expr, fmtargs=(), limit=100, **kwargs):
+        """Test a property on every worker at once.
+
+        Random testing splits the ``limit`` tests between the workers,
+        each of which draws its tests from its own random generator.
+        Since the random tests of separate workers may repeat inputs,
+        a ``limit`` covering the whole input space checks the property
+        exhaustively instead, and properties whose input space is not
+        known from their type are tested on a single worker.
+        Exhaustive testing (``limit=None``) splits the values of the
+        first argument of the property, which has to be a word, into
+        disjoint ranges by their most significant bits, and checks
+        one range per worker; other properties are checked on a
+        single worker. As soon as a worker finds a failure, the
+        others are interrupted.
+
+        The reports of the workers are merged into one: the property
+        passes if it passed on every worker, the tests run are
+        totalled over the workers that finished, and the tests
+        possible are those of the whole property. A failure is
+        reported with the counterexample of the first worker to find
+        one, in terms of the original property.
+
+        Keyword arguments, such as ``timeout``, are passed on to
+        :meth:`._CryptolModule.check` on each worker.
+
+        :return: A :class:`.TestReport` for the property
+
+        """
+        expr = _CryptolModule.template(expr, fmtargs)
+        if limit is not None and limit < 1:
+            raise ValueError('limit must be positive')
+        prop_type = self.__run('typeof', (expr,), {})
+        possible = _tests_possible(prop_type)
+        if limit is not None:
+            if possible is None:
+                # the shares could cover an input space of unknown size
+                return self.__run('check', (expr,), dict(kwargs, limit=limit))
+            if limit < possible:
+                shares = _split(limit, min(limit, len(self.__modules)))
+                jobs = [_bind_check(expr, share, kwargs) for share in shares]
+                return self.__merge_checks(expr, jobs, None, possible)
+        width = _word_argument(prop_type)
+        bits = 0
+        if width is not None:
+            while 2 ** (bits + 1) <= len(self.__modules) and bits + 1 < width:
+                bits += 1
+        if bits == 0:
+            return self.__run('check', (expr,), dict(kwargs, limit=None))
+        jobs = [_bind_check(_shard_expr(expr, i, bits, width), None, kwargs)
+                for i in range(2 ** bits)]
+        return self.__merge_checks(expr, jobs, bits, possible)
+
+    def __merge_checks(self, expr, jobs, bits, tests_possible):
+        """Run check jobs at once, and merge their reports.
+
+        :param int bits: The number of leading bits of the first
+            argument fixed by each job, which is the index of the job,
+            or ``None`` if the jobs check the property as it is
+
+        :param int tests_possible: The size of the input space of the
+            property, or ``None`` to work it out from the reports
+
+        """
+        tests_run = 0
+        failure = None
+        outcomes = self.__scatter(jobs)
+        try:
+            for index, report, err in outcomes:
+                if err is not None:
+                    raise err
+                tests_run += report.tests_run()
+                if tests_possible is None:
+                    # the jobs split the input space evenly
+                    tests_possible = report.tests_possible() << (bits or 0)
+                if not report.passed():
+                    failure = (index, report)
+                    break
+        finally:
+            # stops the other workers early after a failure
+            outcomes.close()
+        if failure is None:
+            return TestReport(expr, True, tests_run, tests_possible,
+                              None, None)
+        index, report = failure
+        cex = None
+        if report.has_counterexample():
+            cex = report.get_counterexample()
+            if bits is not None:
+                cex = (_shard_word(index, bits, cex[0]),) + tuple(cex[1:])
+        errmsg = report.get_error() if report.has_error() else None
+        return TestReport(expr, False, tests_run, tests_possible, errmsg, cex)
+
+    def __scatter(self, jobs):
+        """Run jobs at once on separate workers, as they finish.
+
+        Each job is a function taking a worker's module. The workers
+        are taken together, so that concurrent calls cannot each hold
+        part of the workers they need, and each is handed back to the
+        pool once its job is done.
+
+        :return: A generator of ``(index, result, error)`` triples
+            (see :func:`._scatter`)
+
+        """
+        with self.__scatter_lock:
+            mods = [self.__idle.get() for _ in jobs]
+        return _scatter(mods, jobs, release=self.__idle.put)
+
+    def close(self):
+        """Wait for outstanding requests, then end every worker session."""
+        self.__threads.close()
+        self.__threads.join()
+        # wait for the losers of prover races too
+        for _ in self.__modules:
+            self.__idle.get()
+        for mod in self.__modules:
+            mod.exit()
+
+class ShardedCryptol(object):
+    """A Cryptol session spread across several server processes.
+
+    Each shard is a separate ``cryptol-server`` process on a free port
+    picked automatically. Modules are loaded on the shards in turn, so
+    a :class:`.ModulePool` opened on a sharded session spreads its
+    workers across every server process.
+
+    >>> with ShardedCryptol(shards=4) as cry:
+    ...     pool = ModulePool(cry, 'AES.cry', workers=16)
+
+    :param int shards: The number of server processes to start;
+        defaults to the number of CPUs
+
+    :param str cryptol_server: The path to the Cryptol server
+        executable
+
+    :param str addr: The interface on which to bind the Cryptol
+        servers
+
+    :param ResultCache result_cache: A persistent cache of results
+        shared by every shard (see :class:`.Cryptol`)
+
+    :param str values: The default representation of words in the
+        modules loaded in this session (see :class:`.Cryptol`)
+
+    :param codec: The wire format for messages to the modules loaded
+        in this session (see :class:`.Cryptol`)
+
+    :param float startup_timeout: The number of seconds to wait for
+        each server to accept connections
+
+    :raises CryptolServerError: if the ``cryptol_server`` executable
+        can't be found or exits unexpectedly
+
+    """
+    def __init__(self,
+                 shards=None,
+                 cryptol_server='cryptol-server',
+                 addr='tcp://127.0.0.1',
+                 result_cache=None,
+                 values='bitvector',
+                 codec='json',
+                 startup_timeout=_STARTUP_TIMEOUT):
+        if shards is None:
+            shards = multiprocessing.cpu_count()
+        if shards < 1:
+            raise ValueError('A sharded session needs at least one shard')
+        self.__shards = []
+        try:
+            for _ in range(shards):
+                self.__shards.append(
+                    Cryptol(cryptol_server=cryptol_server,
+                            addr=addr,
+                            port=None,
+                            result_cache=result_cache,
+                            values=values,
+                            codec=codec,
+                            startup_timeout=startup_timeout))
+        except:
+            self.exit()
+            raise
+        self.__next_shard = itertools.cycle(self.__shards)
+        self.__lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.exit()
+        return None
+
+    def shards(self):
+        """The :class:`.Cryptol` sessions making up this session"""
+        return list(self.__shards)
+
+    def __shard(self):
+        """Pick the shard for the next module, in turn."""
+        with self.__lock:
+            return next(self.__next_shard)
+
+    def load_module(self, filepath, eager=False, values=None):
+        """Load a Cryptol module on the next shard.
+
+        See :meth:`.Cryptol.load_module`.
+
+        """
+        return self.__shard().load_module(filepath, eager=eager,
+                                          values=values)
+
+    def prelude(self, eager=False, values=None):
+        """Load the Cryptol prelude on the next shard.
+
+        See :meth:`.Cryptol.prelude`.
+
+        """
+        return self.__shard().prelude(eager=eager, values=values)
+
+    def exit(self):
+        """Close the session, stopping every server process."""
+        for shard in self.__shards:
+            shard.exit()
+
+def _scatter(mods, jobs, release=None, wait=False):
+    """Run jobs at once, each on its own module, as they finish.
+
+    Each job is a function taking its module, and runs on a thread of
+    its own.
+
+    :param release: A function called with each module once its job
+        is done, or ``None``
+
+    :param bool wait: Whether closing the generator waits for the
+        jobs it interrupts to finish
+
+    :return: A generator of ``(index, result, error)`` triples, one
+        per job, in the order the jobs finish; closing it interrupts
+        the jobs still running
+
+    """
+    outcomes = queue.Queue()
+    lock = threading.Lock()
+    running = set(mods)
+    def run(index, mod, job):
+        """Run a job and report its outcome"""
+        try:
+            try:
+                outcome = (index, job(mod), None)
+            except Exception as err:
+                outcome = (index, None, err)
+            with lock:
+                # no longer to be interrupted, as the module may be
+                # handed to another request once released
+                running.discard(mod)
+            outcomes.put(outcome)
+        finally:
+            if release is not None:
+                release(mod)
+    threads = []
+    for index, (mod, job) in enumerate(zip(mods, jobs)):
+        thread = threading.Thread(target=run, args=(index, mod, job))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    try:
+        for _ in jobs:
+            yield outcomes.get()
+    finally:
+        with lock:
+            for mod in running:
+                mod.interrupt()
+        if wait:
+            for thread in threads:
+                thread.join()
+
+def _bind_prover(command, expr, fmtargs, prover, kwargs):
+    """A job running a query with the given prover"""
+    return lambda mod: getattr(mod, command)(expr, fmtargs, prover=prover,
+                                             **kwargs)
+
+def _bind_check(expr, limit, kwargs):
+    """A job checking a property"""
+    return lambda mod: mod.check(expr, limit=limit, **kwargs)
+
+def _split(total, parts):
+    """Split a number into as even parts as possible, largest first"""
+    share, extra = divmod(total, parts)
+    return [share + 1] * extra + [share] * (parts - extra)
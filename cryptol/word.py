@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""A lightweight representation of Cryptol words."""
+
+from BitVector import BitVector
+
+class Word(object):
+    """A Cryptol word: a non-negative integer of a fixed bit width.
+
+    Modules loaded with ``values='int'`` (see :meth:`.Cryptol.load_module`)
+    return words as instances of this class rather than as
+    :class:`BitVector.BitVector` objects. A word is just an integer and
+    a width, so it is much cheaper to build and to hold than a
+    :class:`BitVector.BitVector`, and it converts to a Python integer
+    with ``int(w)`` or ``w.value``. Words may be passed back to Cryptol
+    functions, :meth:`._CryptolModule.to_expr` and templates anywhere
+    a :class:`BitVector.BitVector` is accepted.
+
+    Words compare equal to words and :class:`BitVector.BitVector`
+    objects of the same width and value, and to integers of the same
+    value. A :class:`BitVector.BitVector` only compares with a word
+    on its right, as in ``w == bv``, since its own comparison does not
+    know about words.
+
+    >>> w = Word(0x2a, 8)
+    >>> int(w), len(w)
+    (42, 8)
+    >>> Word(-1, 4)
+    Word(0xf, 4)
+
+    :param int value: The value of the word; it is reduced modulo
+        ``2**width``, so negative values are taken in two's complement
+
+    :param int width: The width of the word, in bits
+
+    """
+    __slots__ = ('value', 'width')
+
+    def __init__(self, value, width):
+        if width < 0:
+            raise ValueError('A word cannot have a negative width')
+        self.value = value & ((1 << width) - 1)
+        self.width = width
+
+    def __int__(self):
+        return self.value
+
+    __long__ = __int__
+    __index__ = __int__
+
+    def __len__(self):
+        return self.width
+
+    def length(self):
+        """The width of the word, as for :class:`BitVector.BitVector`"""
+        return self.width
+
+    def __bool__(self):
+        return self.value != 0
+
+    __nonzero__ = __bool__
+
+    def __eq__(self, other):
+        if isinstance(other, Word):
+            return self.width == other.width and self.value == other.value
+        if isinstance(other, BitVector):
+            return self.width == len(other) and self.value == int(other)
+        if isinstance(other, bool):
+            return NotImplemented
+        try:
+            return self.value == other.__index__()
+        except AttributeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __hash__(self):
+        # consistent with equality to plain integers
+        return hash(self.value)
+
+    def __repr__(self):
+        return 'Word({}, {})'.format(hex(self.value).rstrip('L'), self.width)
+
+    def __getstate__(self):
+        return (self.value, self.width)
+
+    def __setstate__(self, state):
+        self.value, self.width = state
@@ -45,6 +45,7 @@ setup(
         'Topic :: Security :: Cryptography',
         'License :: OSI Approved :: BSD License',
         'Programming Language :: Python :: 2.7',
+        'Programming Language :: Python :: 3',
     ],
 
     # What does your project relate to?
@@ -58,7 +59,13 @@ setup(
     # your project is installed. For an analysis of "install_requires" vs pip's
     # requirements files see:
     # https://packaging.python.org/en/latest/requirements.html
-    install_requires=['BitVector', 'enum34', 'pyzmq'],
+    install_requires=['BitVector', 'enum34; python_version < "3.4"', 'pyzmq'],
+
+    # Optional dependencies, installed with e.g. pip install pycryptol[numpy]
+    extras_require={
+        'numpy': ['numpy'],
+        'msgpack': ['msgpack'],
+    },
 
     setup_requires=[
         'pytest-runner',
@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+"""A stand-in for ``cryptol-server``, for tests that need no Cryptol.
+
+The stand-in speaks the server's protocol over ZeroMQ from threads of
+the current process, with a fixed set of declarations instead of a
+Cryptol interpreter:
+
+* ``zero`` is the 8-bit word 0, and ``key`` a 128-bit word;
+* ``table`` is a sequence of 256 32-bit words;
+* ``id`` and ``echo`` are functions returning their argument, and
+  ``const`` a curried function returning its first argument; ``id``
+  and ``echo`` may also be mapped over a list of words, as by
+  :meth:`.apply_many`;
+* ``loop`` never finishes evaluating, until interrupted;
+* lambdas evaluate to functions returning their argument, and
+  lambdas returning lambdas to ``const``, unless they mention
+  ``poly``, whose type is ambiguous.
+
+The canned properties ``always``, ``unique``, ``sparse`` and
+``never``, of type ``[16] -> Bit``, hold for every argument, for
+every argument but ``0xbeef``, for multiples of 4096, and for none,
+respectively. They may be checked, and are satisfied by the arguments
+for which they hold. Checks and SAT queries also accept them
+restricted to a range of arguments, as sent by
+:meth:`.ModulePool.check_parallel` and
+:meth:`._CryptolModule.iter_sat`. Any other property is valid, and
+unsatisfiable.
+
+A canned synthesis problem looks for the mask ``m`` with ``x && m ==
+x && 0x00f0`` for every 16-bit ``x``. SAT queries of ``mask_fits``
+applied to a list of examples, such as ``mask_fits [(16 : [16])]``,
+find the smallest mask that is right for every example, and proofs or
+checks of ``mask_correct (m : [16])`` refute a wrong mask with the
+lowest bit on which it is wrong.
+
+Provers may be made to take some time over their queries, or to run
+until interrupted.
+
+With ``clone=True``, the stand-in also clones workers: a ``connect``
+request naming the port of an existing worker in its ``clone`` field
+gets a new worker with the same module loaded, and ``cloned: true``
+in the reply.
+
+Connect a session to it with ``Cryptol(cryptol_server=None,
+port=server.port)``. Evaluating any other expression is an error.
+
+Run as a script, it takes the arguments of ``cryptol-server`` and
+serves until told to exit, so a small wrapper script can stand in
+for the ``cryptol_server`` executable::
+
+    python tests/standin_server.py --port 5555 [--delay SECONDS]
+
+"""
+
+import os
+import random
+import re
+import sys
+import threading
+import time
+import zmq
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+from cryptol.codec import get_codec
+
+def _word(value, width):
+    return {'word': {'bitvector': {'width': width, 'value': value}}}
+
+def _decl(name):
+    return {'ifDeclName': name, 'ifDeclInfix': False,
+            'ifDeclSig': {'sVars': []}}
+
+VALUES = {
+    'zero': _word(0, 8),
+    'key': _word(0x2b7e151628aed2a6abf7158809cf4f3c, 128),
+    'table': {'sequence': {'isWord': False,
+                           'elements': [_word(i * 0x01010101, 32)
+                                        for i in range(256)]}},
+    }
+"""The canned values of the stand-in, as the server would send them"""
+
+FUNCTIONS = ('id', 'echo', 'const')
+"""The canned functions of the stand-in, all but ``const`` identities"""
+
+PROPERTIES = {
+    'always': lambda x: True,
+    'unique': lambda x: x != 0xbeef,
+    'sparse': lambda x: x % 4096 == 0,
+    'never': lambda x: False,
+    }
+"""The canned properties of the stand-in, over 16-bit words"""
+
+MASK = 0x00f0
+"""The mask sought by the canned synthesis problem"""
+
+_MASK_FITS = re.compile(r'^mask_fits \[(.*)\]$')
+
+_MASK_CORRECT = re.compile(r'^mask_correct \((\d+) : \[16\]\)$')
+
+_EXAMPLE = re.compile(r'\((\d+) : \[16\]\)')
+
+_SHARD = re.compile(r'^\\\(pycryptol_rest : \[(\d+)\]\) -> \((\w+)\) '
+                    r'\(\((\d+) : \[(\d+)\]\) # pycryptol_rest\)$')
+
+_MAP = re.compile(r'^\[\(+(?:id|echo)\)+ pycryptol_arg \| pycryptol_arg <- '
+                  r'\(\[([\d, ]*)\] : \[\d+\]\[(\d+)\]\)\]$')
+
+_CURRIED = re.compile(r'^\\\([^)]*\) -> \\')
+
+def _property(expr):
+    """The name, fixed leading bits and width of those bits of a property"""
+    match = _SHARD.match(expr)
+    if match is not None:
+        return match.group(2), int(match.group(3)), int(match.group(4))
+    return expr.strip('()'), 0, 0
+
+def _mask_counterexample(expr):
+    """The arguments refuting a candidate mask, or ``None`` if it is right"""
+    wrong = MASK ^ int(_MASK_CORRECT.match(expr).group(1))
+    if not wrong:
+        return None
+    return [_word(wrong & -wrong, 16)]
+
+class StandinServer(object):
+    """A stand-in Cryptol server running in background threads.
+
+    :param codecs: The names of the codecs the stand-in offers to
+        clients, in order of preference; an empty sequence behaves
+        like a server that knows nothing of codecs
+
+    :param int port: The control port to bind, or ``None`` for a
+        random free port
+
+    :param bool clone: Whether the stand-in clones workers on request
+
+    :param dict prover_delays: The number of seconds each prover, by
+        name, takes to answer, or ``None`` for provers that run until
+        interrupted; other provers answer at once
+
+    :param dict check_delays: The number of seconds checks take to
+        answer when they ``pass`` and when they ``fail``, or ``None``
+        to run until interrupted; by default, they answer at once
+
+    """
+    def __init__(self, codecs=(), port=None, clone=False,
+                 prover_delays=None, check_delays=None):
+        self.codecs = list(codecs)
+        self.clone = clone
+        self.prover_delays = dict(prover_delays or {})
+        self.check_delays = dict(check_delays or {})
+        self.requests = []
+        self.exited = threading.Event()
+        self.__ctx = zmq.Context()
+        self.__stop = threading.Event()
+        self.__threads = []
+        self.__lock = threading.Lock()
+        self.__workers = {}
+        control = self.__ctx.socket(zmq.REP)
+        if port is None:
+            self.port = control.bind_to_random_port('tcp://127.0.0.1')
+        else:
+            control.bind('tcp://127.0.0.1:' + str(port))
+            self.port = port
+        self.__spawn(self.__serve_control, control)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Stop every thread of the stand-in and close its sockets."""
+        self.__stop.set()
+        for thread in self.__threads:
+            thread.join()
+        self.__ctx.term()
+
+    def __spawn(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        self.__threads.append(thread)
+
+    def __serve(self, sock, codec, handle):
+        """Answer requests on ``sock`` until closed or told to exit."""
+        poller = zmq.Poller()
+        poller.register(sock, zmq.POLLIN)
+        try:
+            while not self.__stop.is_set():
+                if not poller.poll(50):
+                    continue
+                msg = codec.decode(sock.recv())
+                with self.__lock:
+                    self.requests.append(msg)
+                resp = handle(msg)
+                sock.send(codec.encode(resp))
+                if msg.get('tag') == 'exit':
+                    break
+        finally:
+            sock.close(linger=0)
+
+    def __serve_control(self, sock):
+        self.__serve(sock, get_codec('json'), self.__control)
+
+    def __control(self, msg):
+        tag = msg['tag']
+        if tag == 'connect':
+            name = 'json'
+            for offered in msg.get('codecs', ()):
+                if offered in self.codecs:
+                    name = offered
+                    break
+            state = {'loaded': None, 'options': {}}
+            source = self.__workers.get(msg.get('clone'))
+            if self.clone and source is not None:
+                state['loaded'] = source['loaded']
+                state['options'] = dict(source['options'])
+            state['interrupt'] = threading.Event()
+            state['busy'] = False
+            worker = self.__ctx.socket(zmq.REP)
+            port = worker.bind_to_random_port('tcp://127.0.0.1')
+            self.__workers[port] = state
+            self.__spawn(self.__serve, worker, get_codec(name),
+                         lambda msg: self.__worker(state, msg))
+            resp = {'port': port}
+            if self.codecs:
+                resp['codec'] = name
+            if self.clone and source is not None:
+                resp['cloned'] = True
+            return resp
+        if tag == 'interrupt':
+            state = self.__workers[msg['port']]
+            # like the server, ignore interrupts of idle workers
+            if state['busy']:
+                state['interrupt'].set()
+        elif tag == 'exit':
+            self.exited.set()
+        return {'tag': 'ok'}
+
+    def __worker(self, state, msg):
+        tag = msg['tag']
+        if tag == 'loadModule':
+            state['loaded'] = msg['filePath']
+        elif tag == 'loadPrelude':
+            state['loaded'] = 'Cryptol'
+        elif tag == 'browse':
+            names = list(VALUES) + list(FUNCTIONS) + ['loop']
+            return {'decls': {'ifDecls': dict((name, _decl(name))
+                                              for name in names)}}
+        if tag == 'evalExpr':
+            name = msg['expr'].strip('()')
+            if name in VALUES:
+                return {'tag': 'value', 'value': VALUES[name]}
+            if name in FUNCTIONS:
+                return {'tag': 'funValue', 'handle': FUNCTIONS.index(name)}
+            if name == 'loop':
+                self.__work(state, None)
+                return {'tag': 'interactiveError', 'pp': 'Interrupted'}
+            if msg['expr'].startswith('\\'):
+                if 'poly' in msg['expr']:
+                    return {'tag': 'interactiveError',
+                            'pp': 'Ambiguous type in ' + msg['expr']}
+                if _CURRIED.match(msg['expr']):
+                    return {'tag': 'funValue',
+                            'handle': FUNCTIONS.index('const')}
+                return {'tag': 'funValue', 'handle': FUNCTIONS.index('id')}
+            mapped = _MAP.match(msg['expr'])
+            if mapped is not None:
+                width = int(mapped.group(2))
+                return {'tag': 'value',
+                        'value': {'sequence': {
+                            'isWord': False,
+                            'elements': [_word(int(arg), width) for arg in
+                                         mapped.group(1).split(', ')]}}}
+            return {'tag': 'interactiveError',
+                    'pp': 'The stand-in cannot evaluate ' + msg['expr']}
+        if tag == 'applyFun':
+            handle = msg['handle']
+            if handle == FUNCTIONS.index('const'):
+                # keep the first argument in a new closure
+                state.setdefault('closures', []).append(msg['arg'])
+                return {'tag': 'funValue',
+                        'handle': len(FUNCTIONS) + len(state['closures']) - 1}
+            if handle >= len(FUNCTIONS):
+                return {'tag': 'value',
+                        'value': state['closures'][handle - len(FUNCTIONS)]}
+            return {'tag': 'value', 'value': msg['arg']}
+        if tag == 'setOpt':
+            state['options'][msg['key']] = msg['value']
+        if tag in ('prove', 'sat'):
+            prover = state['options'].get('prover', 'cvc4')
+            if prover in self.prover_delays:
+                if self.__work(state, self.prover_delays[prover]):
+                    return {'tag': 'interactiveError', 'pp': 'Interrupted'}
+            if tag == 'prove':
+                cex = None
+                if _MASK_CORRECT.match(msg['expr']):
+                    cex = _mask_counterexample(msg['expr'])
+                return {'tag': 'prove', 'counterexample': cex}
+            return {'tag': 'sat',
+                    'assignments': self.__solutions(state, msg['expr'])}
+        if tag in ('check', 'exhaust'):
+            return self.__check(state, tag, msg['expr'])
+        if tag == 'typeOf':
+            if msg['expr'].strip('()') in PROPERTIES:
+                return {'tag': 'type', 'pp': '[16] -> Bit'}
+            return {'tag': 'type', 'pp': '[8]'}
+        return {'tag': 'ok'}
+
+    def __solutions(self, state, expr):
+        """The satisfying assignments of a property, up to ``satNum``."""
+        fits = _MASK_FITS.match(expr)
+        if fits is not None:
+            seen = 0
+            for example in _EXAMPLE.findall(fits.group(1)):
+                seen |= int(example)
+            return [[_word(MASK & seen, 16)]]
+        name, prefix, bits = _property(expr)
+        if name not in PROPERTIES:
+            return []
+        sat_num = state['options'].get('satNum', '1')
+        limit = None if sat_num == 'all' else int(sat_num)
+        rest = 16 - bits
+        low = prefix << rest
+        solutions = []
+        for arg in range(low, low + (1 << rest)):
+            if limit is not None and len(solutions) == limit:
+                break
+            if PROPERTIES[name](arg):
+                solutions.append([_word(arg - low, rest)])
+        return solutions
+
+    def __check(self, state, tag, expr):
+        """Test a canned property, possibly on a range of arguments."""
+        if _MASK_CORRECT.match(expr):
+            cex = _mask_counterexample(expr)
+            tests_run = 1
+            if cex is None:
+                tests_run = int(state['options'].get('tests', 100))
+            return self.__report(state, expr, cex, tests_run, 1 << 16)
+        name, prefix, bits = _property(expr)
+        if name not in PROPERTIES:
+            return {'tag': 'interactiveError',
+                    'pp': 'The stand-in cannot check ' + expr}
+        rest = 16 - bits
+        low = prefix << rest
+        possible = 1 << rest
+        if tag == 'check':
+            run = min(int(state['options'].get('tests', 100)), possible)
+            args = [random.randrange(low, low + possible)
+                    for _ in range(run)]
+        else:
+            args = range(low, low + possible)
+        cex = None
+        tests_run = 0
+        for arg in args:
+            tests_run += 1
+            if not PROPERTIES[name](arg):
+                cex = [_word(arg - low, rest)]
+                break
+        return self.__report(state, expr, cex, tests_run, possible)
+
+    def __report(self, state, expr, cex, tests_run, possible):
+        """A test report, once the checks have taken their time."""
+        if cex is None:
+            result = {'Pass': []}
+        else:
+            result = {'FailFalse': cex}
+        delay = self.check_delays.get('pass' if 'Pass' in result else 'fail',
+                                      0)
+        if delay != 0 and self.__work(state, delay):
+            return {'tag': 'interactiveError', 'pp': 'Interrupted'}
+        return {'tag': 'testReport',
+                'testReport': [{'reportResult': result,
+                                'reportTestsRun': tests_run,
+                                'reportTestsPossible': possible,
+                                'reportProp': expr}]}
+
+    def __work(self, state, seconds):
+        """Keep a worker busy for a while, or until interrupted.
+
+        :param float seconds: How long to work, or ``None`` to work
+            until interrupted
+
+        :return bool: Whether the work was interrupted
+
+        """
+        deadline = None if seconds is None else time.time() + seconds
+        state['busy'] = True
+        try:
+            while not state['interrupt'].wait(0.05):
+                if self.__stop.is_set():
+                    return True
+                if deadline is not None and time.time() >= deadline:
+                    return False
+            return True
+        finally:
+            state['busy'] = False
+            state['interrupt'].clear()
+
+def main(args):
+    port = int(args[args.index('--port') + 1])
+    if '--delay' in args:
+        # simulate a slow start
+        time.sleep(float(args[args.index('--delay') + 1]))
+    server = StandinServer(port=port)
+    while not server.exited.wait(0.1):
+        pass
+    server.close()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -3,11 +3,18 @@
 # pylint: disable=wildcard-import,unused-wildcard-import
 
 from cryptol import *
+from cryptol.cache import module_digest
+from cryptol.codec import JSONCodec, bv_bytes, bv_int, get_codec
+from cryptol.daemon import SharedCryptol, running_server
+from standin_server import StandinServer
 from BitVector import BitVector
 from multiprocessing import Process, Lock
+import gc
+import json
 import os
 import pytest
 import signal
+import sys
 import time
 
 @pytest.fixture(scope="module")
@@ -20,12 +27,19 @@ def cry(request):
 def prelude(cry):
     return cry.prelude()
 
+@pytest.fixture
+def standin(request):
+    server = StandinServer()
+    request.addfinalizer(server.close)
+    cry = Cryptol(cryptol_server=None, port=server.port, values='int')
+    request.addfinalizer(cry.exit)
+    return cry, server
+
 def test_prelude(prelude):
     assert int(prelude.eval('1+1')) == 0
 
-def test_aes(cry):
-    key = BitVector(intVal=0x2b7e151628aed2a6abf7158809cf4f3c, size=128)
-    tvs = [(BitVector(intVal=pt, size=128),
+AES_KEY = BitVector(intVal=0x2b7e151628aed2a6abf7158809cf4f3c, size=128)
+AES_TVS = [(BitVector(intVal=pt, size=128),
             BitVector(intVal=ct, size=128))
            for pt, ct in
            [(0x6bc1bee22e409f96e93d7e117393172a,
@@ -36,6 +50,10 @@ def test_aes(cry):
              0x43b1cd7f598ece23881b00e3ed030688),
             (0xf69f2445df4f9b17ad2b417be66c3710,
              0x7b0c785e27e8ad3f8223207104725dd4)]]
+
+def test_aes(cry):
+    key = AES_KEY
+    tvs = AES_TVS
     aes = cry.load_module('tests/AES.cry')
     for pt, ct in tvs:
         ct_actual = aes.aesEncrypt((pt, key))
@@ -65,6 +83,12 @@ def test_interrupt(cry):
         m.eval('bot ()')
     assert int(m.eval('1+1')) == 0
 
+def test_timeout(cry):
+    m = cry.load_module('tests/inf.cry')
+    with pytest.raises(CryptolTimeout):
+        m.eval('bot ()', timeout=1)
+    assert int(m.eval('1+1')) == 0
+
 def test_check(prelude):
     report = prelude.check('\\x -> (x : [4]) == x')
     assert(report.passed())
@@ -76,8 +100,8 @@ def test_check(prelude):
     assert(report.coverage() == 0.390625)
 
     report = prelude.check('\\x -> (x : [8]) == x', limit=256)
-    print report.tests_run()
-    print report.tests_possible()
+    print(report.tests_run())
+    print(report.tests_possible())
     assert(report.passed())
     assert(report.is_exhaustive())
     assert(report.coverage() == 1.0)
@@ -100,3 +124,712 @@ def test_check(prelude):
     assert(not report.passed())
     assert(report.has_error())
     assert('foo' in report.get_error())
+
+def test_lazy_decls(cry):
+    m = cry.load_module('tests/idents.cry')
+    oplus = m.decl(u'⊕')
+    assert m.decl(u'⊕') is oplus
+    assert m.decl('__dict__') is True
+    assert isinstance(m.__dict__, dict)
+    with pytest.raises(CryptolError):
+        m.decl('not_a_decl')
+
+def test_eager_decls(cry):
+    m = cry.load_module('tests/idents.cry', eager=True)
+    two = BitVector(intVal=2, size=4)
+    three = BitVector(intVal=3, size=4)
+    assert int(m.decl(u'⊕')(two)(three)) == 5
+
+def test_apply_many(cry):
+    aes = cry.load_module('tests/AES.cry')
+    cts = aes.apply_many('aesEncrypt',
+                         [(pt, AES_KEY) for pt, _ in AES_TVS],
+                         chunk_size=3)
+    assert list(cts) == [ct for _, ct in AES_TVS]
+    cts = aes.aesEncrypt.map((pt, AES_KEY) for pt, _ in AES_TVS)
+    assert list(cts) == [ct for _, ct in AES_TVS]
+
+def test_map_partial(cry):
+    m = cry.load_module('tests/idents.cry')
+    add_two = m.decl(u'⊕')(BitVector(intVal=2, size=4))
+    results = add_two.map([BitVector(intVal=i, size=4) for i in range(16)],
+                          chunk_size=5)
+    assert [int(r) for r in results] == [(i + 2) % 16 for i in range(16)]
+
+def test_multi_arg_call(cry):
+    m = cry.load_module('tests/idents.cry')
+    oplus = m.decl(u'⊕')
+    two = BitVector(intVal=2, size=4)
+    three = BitVector(intVal=3, size=4)
+    assert int(oplus(two, three)) == 5
+    assert int(oplus.apply(two, three)) == 5
+    assert int(oplus(two)(three)) == 5
+
+def test_int_values(cry):
+    aes = cry.load_module('tests/AES.cry', values='int')
+    key = Word(int(AES_KEY), 128)
+    for pt, ct in AES_TVS:
+        result = aes.aesEncrypt((Word(int(pt), 128), key))
+        assert isinstance(result, Word)
+        assert result == Word(int(ct), 128)
+        assert result == int(ct)
+    prelude = cry.prelude(values='int')
+    assert prelude.eval('0x3 + ?', Word(-1, 4)) == Word(2, 4)
+    with pytest.raises(ValueError):
+        cry.prelude(values='float')
+
+def test_word():
+    w = Word(0x1ff, 8)
+    assert (w.value, w.width, len(w)) == (0xff, 8, 8)
+    assert int(w) == 255 and w == 255 and w != Word(255, 16)
+    assert hash(w) == hash(255)
+    assert w == BitVector(intVal=255, size=8)
+    assert w != BitVector(intVal=255, size=16)
+    assert w != BitVector(intVal=1, size=8)
+    assert repr(Word(-1, 4)) == 'Word(0xf, 4)'
+    assert not Word(0, 4)
+    with pytest.raises(AttributeError):
+        w.extra = 1
+    from cryptol.cryptol import _CryptolModule, _from_value, _to_value
+    assert _CryptolModule.to_expr([w]) == u'([255] : [1][8])'
+    assert _CryptolModule.to_expr([w, BitVector(intVal=1, size=4)]) == (
+        u'[255 : [8], 1 : [4]]')
+    assert _from_value(_to_value((w, [Word(3, 2)])), Word) == (w, [3])
+
+def test_numpy_values():
+    numpy = pytest.importorskip('numpy')
+    from cryptol.cryptol import _CryptolModule, _to_value, _value_decoder
+    decode = _value_decoder('numpy')
+    arr = numpy.arange(12, dtype=numpy.uint16).reshape(3, 4)
+    out = decode(_to_value(arr))
+    assert out.dtype == numpy.uint16 and (out == arr).all()
+    signed = numpy.array([-1, 1], dtype=numpy.int8)
+    assert decode(_to_value(signed)).tolist() == [255, 1]
+    bits = numpy.array([[True, False, True], [False, False, True]])
+    assert decode(_to_value(bits)).tolist() == [5, 1]
+    mixed = _to_value((numpy.uint8(7), [Word(1, 72), Word(2, 72)]))
+    assert decode(mixed) == (Word(7, 8), [Word(1, 72), Word(2, 72)])
+    assert (_CryptolModule.to_expr(arr[:2, :2]) ==
+            u'([[0, 1], [4, 5]] : [2][2][16])')
+    assert _CryptolModule.to_expr(bits[0]) == u'([True, False, True] : [3])'
+
+def test_numpy_apply_many(cry):
+    numpy = pytest.importorskip('numpy')
+    prelude = cry.prelude(values='numpy')
+    inc = prelude.eval('\\(x : [8]) -> x + 1')
+    inputs = numpy.arange(256, dtype=numpy.uint8)
+    results = list(inc.map(inputs, chunk_size=100))
+    assert results == [(i + 1) % 256 for i in range(256)]
+    matrix = prelude.eval('[[1, 2], [3, 4]] : [2][2][32]')
+    assert matrix.dtype == numpy.uint32
+    assert matrix.tolist() == [[1, 2], [3, 4]]
+
+def test_compact_values():
+    from cryptol.cryptol import _CryptolModule, _to_value, _value_decoder
+    assert _to_value([True, False, True, True]) == (
+        {'word': {'bitvector': {'width': 4, 'value': 11}}})
+    assert _CryptolModule.to_expr([True, False, True]) == u'0b101'
+    assert _CryptolModule.to_expr(bytearray(b'\x00\xff')) == u'[0x00, 0xff]'
+    decode = _value_decoder('bytes')
+    data = bytes(bytearray(range(256)))
+    assert decode(_to_value(data)) == data
+    assert decode(_to_value(([Word(1, 8)], [Word(1, 9)]))) == (
+        b'\x01', [Word(1, 9)])
+    words = [BitVector(intVal=i, size=16) for i in range(3)]
+    assert _value_decoder('bitvector')(_to_value(words)) == words
+
+def test_bytes_values(cry):
+    prelude = cry.prelude(values='bytes')
+    assert prelude.eval('reverse ?', b'abc') == b'cba'
+    assert prelude.eval('?', [True] * 12) == Word(0xfff, 12)
+
+def test_codecs():
+    assert bv_bytes(0x1ff, 9) == b'\x01\xff'
+    assert bv_int(bv_bytes(5, 3)) == 5 and bv_int(u'7') == 7
+    msg = {'tag': 'applyFun', 'arg': {'tuple': [
+        {'word': {'bitvector': {'width': 128, 'value': 2**127 + 1}}}]}}
+    assert JSONCodec(engine='json').decode(JSONCodec().encode(msg)) == msg
+    with pytest.raises(ValueError):
+        get_codec('xml')
+    class NarrowJSON(object):
+        @staticmethod
+        def dumps(obj):
+            if any(abs(i) >= 2**64 for i in obj):
+                raise OverflowError('int too big to convert')
+            return json.dumps(obj)
+        loads = staticmethod(json.loads)
+    with pytest.raises(ValueError):
+        JSONCodec(engine=NarrowJSON)
+    pytest.importorskip('msgpack')
+    packed = get_codec('msgpack').decode(get_codec('msgpack').encode(msg))
+    bv = packed['arg']['tuple'][0]['word']['bitvector']
+    assert bv['value'] == b'\x80' + b'\x00' * 14 + b'\x01'
+
+def test_standin_codecs():
+    with StandinServer() as server:
+        cry = Cryptol(cryptol_server=None, port=server.port, codec='auto')
+        m = cry.load_module('Standin.cry')
+        assert int(m.key) == int(AES_KEY)
+        cry.exit()
+        pytest.importorskip('msgpack')
+        cry = Cryptol(cryptol_server=None, port=server.port, codec='msgpack')
+        with pytest.raises(CryptolServerError):
+            cry.prelude()
+        cry.exit()
+    with StandinServer(codecs=['msgpack', 'json']) as server:
+        cry = Cryptol(cryptol_server=None, port=server.port, codec='auto',
+                      values='int')
+        m = cry.load_module('Standin.cry')
+        assert m.key == Word(int(AES_KEY), 128)
+        assert [int(w) for w in m.table[:2]] == [0, 0x01010101]
+        assert m.echo((Word(3, 200), [True, False])) == (Word(3, 200),
+                                                         Word(2, 2))
+        assert server.requests[-1]['arg']['tuple'][0]['word'][
+            'bitvector']['value'] == b'\x00' * 24 + b'\x03'
+        m.enable_memo(max_bytes=4096)
+        assert [int(w) for w in m.eval('table')[:2]] == [0, 0x01010101]
+        assert int(m.eval('key')) == int(AES_KEY)
+        assert m.memo_stats()['entries'] == 1
+        cry.exit()
+
+def test_standin_timeout(standin):
+    cry, server = standin
+    m = cry.load_module('Standin.cry')
+    start = time.time()
+    with pytest.raises(CryptolTimeout):
+        m.eval('loop', timeout=0.2)
+    assert 0.15 <= time.time() - start < 2.0
+    assert int(m.zero) == 0
+    with pytest.raises(CryptolTimeout):
+        m.eval('loop', deadline=time.time() + 0.1)
+    assert m.echo(Word(5, 8), timeout=1.0) == Word(5, 8)
+    with pytest.raises(TypeError):
+        m.echo(Word(5, 8), timout=1.0)
+    interrupts = [msg for msg in server.requests
+                  if msg['tag'] == 'interrupt']
+    assert len(interrupts) == 2
+
+def test_clone_workers(tmpdir):
+    source = tmpdir.join('Standin.cry')
+    source.write('zero = 0 : [8]\n')
+    def tags(server, tag):
+        return len([msg for msg in server.requests if msg['tag'] == tag])
+    with StandinServer(clone=True) as server:
+        cry = Cryptol(cryptol_server=None, port=server.port)
+        mods = [cry.load_module(str(source)) for _ in range(4)]
+        assert [int(m.zero) for m in mods] == [0] * 4
+        assert tags(server, 'loadModule') == 1
+        assert tags(server, 'browse') == 1
+        # a new version of the file is loaded again
+        source.write('zero = 0 : [8]\n\n')
+        assert int(cry.load_module(str(source)).zero) == 0
+        assert tags(server, 'loadModule') == 2
+        # clones outlive the module they were cloned from
+        mods[0].exit()
+        del mods[0]
+        assert int(cry.load_module(str(source)).key) == int(AES_KEY)
+        cry.exit()
+    with StandinServer() as server:
+        cry = Cryptol(cryptol_server=None, port=server.port)
+        mods = [cry.load_module(str(source)) for _ in range(4)]
+        assert [int(m.zero) for m in mods] == [0] * 4
+        assert tags(server, 'loadModule') == 4
+        assert tags(server, 'browse') == 1
+        cry.exit()
+
+def standin_executable(tmpdir, *args):
+    script = tmpdir.join('standin-server')
+    script.write('#!/bin/sh\nexec {} {} {} "$@"\n'.format(
+        sys.executable,
+        os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                     'standin_server.py'),
+        ' '.join(args)))
+    script.chmod(0o755)
+    return str(script)
+
+def test_readiness(tmpdir):
+    slow = standin_executable(tmpdir, '--delay', '0.5')
+    cry = Cryptol(cryptol_server=slow, port=None)
+    assert cry.startup_latency() >= 0.5
+    assert int(cry.load_module('Standin.cry').zero) == 0
+    assert cry.shutdown_latency() is None
+    cry.exit()
+    assert cry.shutdown_latency() < 5.0
+    with pytest.raises(CryptolServerError):
+        Cryptol(cryptol_server='false', port=None)
+    # exit is bounded even once the server is gone
+    server = StandinServer()
+    cry = Cryptol(cryptol_server=None, port=server.port)
+    mod = cry.load_module('Standin.cry')
+    assert int(mod.zero) == 0
+    server.close()
+    cry.exit(timeout=0.2)
+    assert cry.shutdown_latency() < 1.0
+    with pytest.raises(CryptolServerError):
+        Cryptol(cryptol_server=slow, port=None, startup_timeout=0.1)
+
+def test_shared_server(tmpdir):
+    server = standin_executable(tmpdir)
+    registry = str(tmpdir.join('registry'))
+    first = SharedCryptol(server, idle_timeout=0.5, registry=registry)
+    second = SharedCryptol(server, idle_timeout=0.5, registry=registry)
+    assert first.port() == second.port()
+    assert running_server(server, registry=registry)['port'] == first.port()
+    first.exit()
+    assert int(second.load_module('Standin.cry').zero) == 0
+    second.exit()
+    deadline = time.time() + 10
+    while running_server(server, registry=registry) is not None:
+        assert time.time() < deadline
+        time.sleep(0.1)
+    third = SharedCryptol(server, idle_timeout=0.5, registry=registry)
+    assert int(third.load_module('Standin.cry').zero) == 0
+    third.exit()
+
+def test_module_pool(cry):
+    with ModulePool(cry, 'tests/AES.cry', workers=2) as pool:
+        cts = pool.map('aesEncrypt', [(pt, AES_KEY) for pt, _ in AES_TVS])
+        assert cts == [ct for _, ct in AES_TVS]
+        pending = [pool.submit('eval', '1+1'),
+                   pool.submit('check', '\\x -> (x : [4]) == x')]
+        assert int(pending[0].get()) == 0
+        assert pending[1].get().passed()
+        pt, ct = AES_TVS[0]
+        assert pool.call('aesEncrypt', (pt, AES_KEY)) == ct
+
+def test_prover_race(standin):
+    cry, server = standin
+    server.prover_delays = {'cvc4': None, 'z3': 0.2, 'yices': 0.5,
+                            'abc': 0.5}
+    with ModulePool(cry, 'Standin.cry', workers=3) as pool:
+        start = time.time()
+        result = pool.prove('valid', provers=[Provers.CVC4,
+                                              Provers.Z3,
+                                              Provers.YICES])
+        assert result.is_valid() and result.prover() == Provers.Z3
+        assert time.time() - start < 2.0
+        result = pool.sat('valid', provers=[Provers.YICES,
+                                            Provers.Z3])
+        assert not result.is_sat()
+        assert result.prover() == Provers.Z3
+        assert pool.prover_stats() == {'prove': {'z3': 1},
+                                       'sat': {'z3': 1}}
+        # with fewer workers, the past winners race
+        result = pool.prove('valid', provers=[
+            Provers.ABC, Provers.CVC4, Provers.YICES, Provers.Z3])
+        assert result.prover() == Provers.Z3
+        assert pool.prover_stats()['prove'] == {'z3': 2}
+        assert int(pool.eval('zero')) == 0
+    assert len([msg for msg in server.requests
+                if msg['tag'] == 'interrupt']) >= 3
+
+def test_check_parallel(standin):
+    cry, server = standin
+    with ModulePool(cry, 'Standin.cry', workers=4) as pool:
+        report = pool.check_parallel('always', limit=10)
+        assert report.passed() and report.tests_run() == 10
+        assert report.tests_possible() == 2**16
+        checks = [msg for msg in server.requests
+                  if msg['tag'] == 'setOpt' and msg['key'] == 'tests']
+        assert sorted(msg['value'] for msg in checks) == [
+            '2', '2', '3', '3']
+        report = pool.check_parallel('never', limit=1000)
+        assert not report.passed() and report.has_counterexample()
+        # limits covering the input space check exhaustively
+        for limit in (2**16, 2**17):
+            exhausts = len([msg for msg in server.requests
+                            if msg['tag'] == 'exhaust'])
+            report = pool.check_parallel('always', limit=limit)
+            assert report.passed() and report.is_exhaustive()
+            assert report.tests_run() == 2**16
+            assert report.coverage() == 1.0
+            assert len([msg for msg in server.requests
+                        if msg['tag'] == 'exhaust']) == exhausts + 4
+        report = pool.check_parallel('always', limit=2**16 - 1)
+        assert not report.is_exhaustive()
+        assert report.coverage() < 1.0
+        report = pool.check_parallel('always', limit=None)
+        assert report.passed() and report.is_exhaustive()
+        assert report.tests_run() == 2**16
+        # the failing range stops the others
+        server.check_delays = {'pass': 5.0, 'fail': 0.2}
+        start = time.time()
+        report = pool.check_parallel('unique', limit=None)
+        assert time.time() - start < 2.0
+        assert not report.passed()
+        assert report.get_counterexample() == (Word(0xbeef, 16),)
+        assert report.tests_possible() == 2**16
+        assert int(pool.eval('zero')) == 0
+    interrupts = [msg for msg in server.requests
+                  if msg['tag'] == 'interrupt']
+    assert len(interrupts) >= 3
+
+def test_iter_sat(standin):
+    cry, server = standin
+    m = cry.load_module('Standin.cry')
+    progress = []
+    solutions = m.iter_sat('sparse', split_bits=2,
+                           progress=lambda *p: progress.append(p))
+    assert next(solutions) == (Word(0, 16),)
+    assert progress == [(1, 4, 4)]
+    assert list(solutions) == [(Word(i * 4096, 16),)
+                               for i in range(1, 16)]
+    assert progress[-1] == (4, 4, 16)
+    chunks = list(m.iter_sat('sparse', split_bits=3, chunks=True))
+    assert [len(chunk) for chunk in chunks] == [2] * 8
+    assert list(m.iter_sat('never')) == []
+    # stopping early skips the remaining ranges
+    sats = len([msg for msg in server.requests
+                if msg['tag'] == 'sat'])
+    for _ in m.iter_sat('always'):
+        break
+    assert len([msg for msg in server.requests
+                if msg['tag'] == 'sat']) == sats + 1
+
+def test_synthesizer(standin):
+    cry, server = standin
+    server.prover_delays = {'z3': 0.3}
+    server.check_delays = {'fail': 0.05}
+    m = cry.load_module('Standin.cry')
+    synth = Synthesizer(m, 'mask_fits ?', 'mask_correct (?)',
+                        examples=[Word(0, 16)])
+    seen = []
+    result = synth.run(on_iteration=seen.append)
+    assert result.has_program()
+    assert result.get_program() == Word(0xf0, 16)
+    assert result.examples() == [Word(bit, 16)
+                                 for bit in (0, 0x10, 0x20, 0x40,
+                                             0x80)]
+    assert [str(step) for step in result.iterations()] == [
+        'counterexample'] * 4 + ['correct']
+    assert seen == result.iterations()
+    assert all(step.found_by() == 'prove' for step in seen)
+    # each query carries the examples found so far
+    queries = [msg['expr'] for msg in server.requests
+               if msg['tag'] == 'sat']
+    assert queries[0] == 'mask_fits [(0 : [16])]'
+    assert queries[-1] == ('mask_fits [(0 : [16]), (16 : [16]), '
+                           '(32 : [16]), (64 : [16]), (128 : [16])]')
+    assert seen[-1].query_size() == len(queries[-1])
+    result = Synthesizer(m, 'mask_fits ?', 'mask_correct (?)',
+                         examples=[Word(0, 16)]).run(max_iterations=2)
+    assert not result.has_program() and len(result.iterations()) == 2
+    # refutations found by testing stop the slower proofs
+    verifier = cry.load_module('Standin.cry')
+    synth = Synthesizer(m, 'mask_fits ?', 'mask_correct (?)',
+                        examples=[Word(0, 16)], verifier=verifier)
+    result = synth.run()
+    assert result.get_program() == Word(0xf0, 16)
+    assert [step.found_by() for step in result.iterations()] == [
+        'check'] * 4 + ['prove']
+    assert all(step.verify_time() < 0.25
+               for step in result.iterations()[:4])
+    interrupts = [msg for msg in server.requests
+                  if msg['tag'] == 'interrupt']
+    assert len(interrupts) == 4
+    with pytest.raises(ValueError):
+        Synthesizer(m, 'mask_fits', 'mask_correct (?)')
+
+def test_bind(standin):
+    cry, server = standin
+    m = cry.load_module('Standin.cry')
+    table = [Word(i, 32) for i in range(1024)]
+    bound = m.bind('table', table)
+    assert m.bindings() == ['table']
+    assert m.template('f ? ?', (bound, 1)) == (
+        'f ' + m.to_expr(table) + ' 1')
+    assert m.const(bound, Word(1, 8)) == table
+    assert m.const(bound, Word(2, 8)) == table
+    assert m.echo(bound) == table
+    # the table crossed the socket once for const, once for echo
+    applied = [msg for msg in server.requests
+               if msg['tag'] == 'applyFun']
+    assert len(applied) == 4
+    assert [len(msg['arg'].get('sequence', {}).get('elements', ()))
+            for msg in applied] == [1024, 0, 0, 1024]
+    # templates and tuples holding the handle send the table
+    # once, and never as text
+    start = len(server.requests)
+    for i in range(3):
+        assert m.eval('f ? ?', (bound, 1)) == table
+        assert m.echo((Word(i, 8), bound)) == table
+    sent = server.requests[start:]
+    assert not any(m.to_expr(table) in msg.get('expr', '')
+                   for msg in sent)
+    tables = [msg for msg in sent if msg['tag'] == 'applyFun' and
+              len(msg['arg'].get('sequence', {}).get('elements', ()))
+              == 1024]
+    assert len(tables) == 2
+    assert len([msg for msg in sent if msg['tag'] == 'evalExpr']) == 2
+    # binding the name again releases the old handle
+    key = m.bind(None, Word(7, 128))
+    assert key.name().startswith('pycryptol_bound_')
+    other = m.bind('table', table[:2])
+    assert bound.released() and not other.released()
+    with pytest.raises(ValueError):
+        m.to_expr(bound)
+    with pytest.raises(ValueError):
+        m.const(bound, Word(1, 8))
+    other.release()
+    assert m.bindings() == [key.name()]
+    # handles belong to the module that bound them
+    with pytest.raises(ValueError):
+        cry.prelude().const(key, Word(1, 8))
+    # handles go once nothing refers to them
+    del key
+    gc.collect()
+    assert m.bindings() == []
+
+def test_prepare(standin):
+    cry, server = standin
+    m = cry.load_module('Standin.cry')
+    encrypt = m.prepare('aesEncrypt (?, ?)')
+    assert encrypt.is_compiled() and encrypt.holes() == 2
+    pts = [Word(i, 128) for i in range(3)]
+    key = Word(7, 128)
+    assert [encrypt(pt, key) for pt in pts] == [(pt, key)
+                                                for pt in pts]
+    evaluated = [msg['expr'] for msg in server.requests
+                 if msg['tag'] == 'evalExpr']
+    assert evaluated == [
+        '\\(pycryptol_hole_0, pycryptol_hole_1) -> '
+        'aesEncrypt (pycryptol_hole_0, pycryptol_hole_1)']
+    applied = [msg['arg'] for msg in server.requests
+               if msg['tag'] == 'applyFun']
+    assert len(applied) == 3 and 'tuple' in applied[0]
+    single = m.prepare('echo ?')
+    assert single(Word(5, 8), timeout=5.0) == Word(5, 8)
+    with pytest.raises(TypeError):
+        encrypt(key)
+    with pytest.raises(TypeError):
+        single(key, deadline=None, retries=2)
+    # templates that do not typecheck are filled in as text
+    poly = m.prepare('poly ?')
+    assert not poly.is_compiled()
+    with pytest.raises(CryptolError):
+        poly(Word(1, 8))
+    assert server.requests[-1]['expr'] == 'poly 1 : [8]'
+    assert int(m.prepare('(zero)')()) == 0
+
+def test_standin_apply_many(standin):
+    cry, server = standin
+    # batches of results are decoded as single results are
+    m = cry.load_module('Standin.cry', values='bytes')
+    words = [Word(i, 8) for i in range(5)]
+    results = list(m.apply_many('id', words, chunk_size=2))
+    assert results == words
+    assert all(isinstance(result, Word) for result in results)
+    assert m.id(words[3]) == words[3]
+    pytest.importorskip('numpy')
+    m = cry.load_module('Standin.cry', values='numpy')
+    words = [Word(i, 12) for i in range(5)]
+    results = list(m.echo.map(words))
+    assert results == words
+    assert all(isinstance(result, Word) for result in results)
+    assert m.echo(words[0]) == words[0]
+
+def test_sharded():
+    with ShardedCryptol(shards=2) as cry:
+        ports = [shard.port() for shard in cry.shards()]
+        assert len(set(ports)) == 2
+        pool = ModulePool(cry, 'tests/AES.cry', workers=4)
+        cts = pool.map('aesEncrypt', [(pt, AES_KEY) for pt, _ in AES_TVS])
+        assert cts == [ct for _, ct in AES_TVS]
+        pool.close()
+
+@pytest.mark.skipif(sys.version_info < (3, 5),
+                    reason='the asyncio client requires Python 3.5')
+def test_async():
+    import asyncio
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    run = loop.run_until_complete
+    cry = AsyncCryptol(port=None)
+    try:
+        aes = run(cry.load_module('tests/AES.cry'))
+        cts = run(asyncio.gather(*[aes.call('aesEncrypt', (pt, AES_KEY))
+                                   for pt, _ in AES_TVS]))
+        assert cts == [ct for _, ct in AES_TVS]
+        assert run(aes.prove('\\x -> (x : [4]) == x')).is_valid()
+
+        m = run(cry.load_module('tests/inf.cry'))
+        pending = asyncio.ensure_future(m.eval('bot ()'))
+        run(asyncio.sleep(1))
+        pending.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            run(pending)
+        assert int(run(m.eval('1+1'))) == 0
+    finally:
+        run(cry.exit())
+        loop.close()
+
+@pytest.mark.skipif(sys.version_info < (3, 5),
+                    reason='the asyncio client requires Python 3.5')
+def test_async_standin():
+    import asyncio
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    run = loop.run_until_complete
+    with StandinServer() as server:
+        cry = AsyncCryptol(cryptol_server=None, port=server.port)
+        try:
+            m = run(cry.load_module('Standin.cry'))
+            results = run(asyncio.gather(
+                m.prove('valid', prover=Provers.Z3),
+                m.prove('valid', prover=Provers.CVC4),
+                m.sat('valid', sat_num=None, prover=Provers.Z3)))
+            assert results[0].is_valid() and results[1].is_valid()
+            # each query runs with the options set for it
+            sent = [(msg['tag'], msg.get('value')) for msg in server.requests
+                    if msg['tag'] in ('setOpt', 'prove', 'sat')]
+            assert sent == [('setOpt', 'z3'), ('prove', None),
+                            ('setOpt', 'cvc4'), ('prove', None),
+                            ('setOpt', 'all'), ('setOpt', 'z3'),
+                            ('sat', None)]
+        finally:
+            run(cry.exit())
+            loop.close()
+        assert len([msg for msg in server.requests
+                    if msg['tag'] == 'exit']) == 1
+
+@pytest.mark.skipif(sys.version_info < (3, 5),
+                    reason='the asyncio client requires Python 3.5')
+def test_async_exit_kills(tmpdir):
+    import asyncio
+    # a server that ignores SIGTERM, and outlives the exit message
+    pidfile = tmpdir.join('pid')
+    script = tmpdir.join('stubborn-server')
+    script.write('#!/bin/sh\n'
+                 'echo $$ > {}\n'
+                 "trap '' TERM\n"
+                 '{} {} "$@"\n'
+                 'exec sleep 60\n'.format(
+                     pidfile, sys.executable,
+                     os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  'standin_server.py')))
+    script.chmod(0o755)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        cry = AsyncCryptol(cryptol_server=str(script), port=None)
+        loop.run_until_complete(cry.exit(timeout=0.2))
+        assert cry.shutdown_latency() < 5.0
+    finally:
+        loop.close()
+    with pytest.raises(OSError):
+        os.kill(int(pidfile.read()), 0)
+
+def test_option_cache(cry):
+    m = cry.prelude()
+    m.prove('\\x -> (x : [4]) == x')
+    assert m.option_cache_stats() == {'hits': 0, 'misses': 1}
+    m.prove('\\x -> (x : [4]) == x')
+    assert m.option_cache_stats() == {'hits': 1, 'misses': 1}
+    m.prove('\\x -> (x : [4]) == x', prover=Provers.Z3)
+    assert m.option_cache_stats() == {'hits': 1, 'misses': 2}
+
+def test_result_cache(tmpdir):
+    cache = ResultCache(str(tmpdir))
+    prop = '\\x -> x +++ 0 == x'
+    with Cryptol(port=None, result_cache=cache) as cry:
+        m = cry.load_module('tests/idents.cry')
+        assert m.prove(prop).is_valid()
+        assert m.check(prop, limit=None).passed()
+        assert cache.stats() == {'hits': 0, 'misses': 2}
+    with Cryptol(port=None, result_cache=cache) as cry:
+        m = cry.load_module('tests/idents.cry')
+        assert m.prove(prop).is_valid()
+        assert m.check(prop, limit=None).is_exhaustive()
+        assert cache.stats() == {'hits': 2, 'misses': 2}
+        m.prove(prop, prover=Provers.Z3)
+        assert cache.stats() == {'hits': 2, 'misses': 3}
+
+def test_result_cache_eviction(tmpdir):
+    cache = ResultCache(str(tmpdir), max_bytes=1000)
+    keys = [cache.key(None, 'prove', str(i), {}) for i in range(10)]
+    for key in keys:
+        cache.put(key, ProofResult(False, (b'x' * 200,)))
+    assert cache.get(keys[-1]) is not None
+    assert cache.get(keys[0]) is None
+    cache.clear()
+    assert cache.get(keys[-1]) is None
+
+def test_module_digest(tmpdir):
+    tmpdir.join('Inner.cry').write('module Inner where\nx = True\n')
+    outer = tmpdir.join('Outer.cry')
+    outer.write('module Outer where\nimport Inner\ny = x\n')
+    before = module_digest(str(outer))
+    tmpdir.join('Inner.cry').write('module Inner where\nx = False\n')
+    assert module_digest(str(outer)) != before
+    # copies elsewhere share the digest
+    copy = tmpdir.mkdir('copy')
+    for name in ('Inner.cry', 'Outer.cry'):
+        tmpdir.join(name).copy(copy.join(name))
+    assert module_digest(str(copy.join('Outer.cry'))) == module_digest(
+        str(outer))
+
+def test_memo(cry):
+    m = cry.load_module('tests/idents.cry')
+    assert m.memo_stats() is None
+    m.enable_memo(capacity=2)
+    oplus = m.decl(u'⊕')
+    two = BitVector(intVal=2, size=4)
+    three = BitVector(intVal=3, size=4)
+    assert int(oplus(two, three)) == 5
+    assert int(oplus(two, three)) == 5
+    assert int(m.eval('0x3 +++ 0x4')) == 7
+    assert int(m.eval('0x3 +++ 0x4')) == 7
+    stats = m.memo_stats()
+    assert stats['hits'] == 2
+    assert stats['entries'] == 2
+
+def test_lru_cache():
+    lru = LRUCache(capacity=2)
+    lru.put('a', 1)
+    lru.put('b', 2)
+    assert lru.get('a') == 1
+    lru.put('c', 3)
+    assert lru.get('b') is None
+    assert lru.get('a') == 1
+    assert lru.stats()['hit_rate'] == 2.0 / 3
+    lru = LRUCache(capacity=10, max_bytes=10)
+    lru.put('a', 'x' * 6)
+    lru.put('b', 'y' * 6)
+    assert lru.get('a') is None
+    assert len(lru) == 1
+
+def test_decode_nested():
+    from cryptol.cryptol import _from_value
+    def word(value, width):
+        return {'word': {'bitvector': {'width': width, 'value': value}}}
+    bits = {'sequence': {'isWord': True,
+                         'elements': [{'bit': True}, {'bit': False},
+                                      {'bit': True}]}}
+    val = {'tuple': [
+        {'record': [[{'Name': 'x'}, word(-1, 4)],
+                    [{'Name': 'y'}, {'tuple': [bits, {'bit': False}]}]]},
+        {'sequence': {'isWord': False,
+                      'elements': [word(1, 8), word(2, 8)]}},
+        word(0, 0)]}
+    rec, seq, empty = _from_value(val)
+    assert rec['x'] == BitVector(intVal=15, size=4)
+    assert rec['y'] == (BitVector(intVal=5, size=3), False)
+    assert [int(w) for w in seq] == [1, 2]
+    assert empty is None
+    # flat sequences of words and of bits are decoded in one go
+    flat = {'tuple': [
+        {'sequence': {'isWord': False,
+                      'elements': [word(-1, 4), word(3, 4), word(0, 0),
+                                   word(5, 16)]}},
+        {'sequence': {'isWord': False,
+                      'elements': [{'bit': True}, {'bit': False}]}},
+        {'sequence': {'isWord': False, 'elements': []}}]}
+    assert _from_value(flat, Word) == (
+        [Word(15, 4), Word(3, 4), None, Word(5, 16)], [True, False], [])
+    deep = {'bit': True}
+    for _ in range(5000):
+        deep = {'tuple': [deep]}
+    deep = _from_value(deep)
+    for _ in range(5000):
+        deep = deep[0]
+    assert deep is True